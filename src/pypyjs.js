@@ -83,11 +83,13 @@ if (typeof FunctionPromise === 'undefined') {
 
 let fs;
 let path;
+let nodeCrypto;
 // Some extra goodies for nodejs.
 if (typeof process !== 'undefined') {
   if (Object.prototype.toString.call(process) === '[object process]') {
     fs = require('fs');
     path = require('path');
+    nodeCrypto = require('crypto');
   }
 }
 
@@ -202,11 +204,26 @@ function pypyjs(opts) {
   this._loadedModules = {};
   this._allModules = {};
 
+  // Start from a snapshot of another VM, if given, rather than
+  // going through the full startup sequence.
+  this._snapshot = _opts.snapshot || null;
+  if (this._snapshot) {
+    this.totalMemory = this._snapshot.heap.byteLength;
+  }
+
   // Allow opts to override default IO streams.
   this.stdin = _opts.stdin || stdio.stdin;
   this.stdout = _opts.stdout || stdio.stdout;
   this.stderr = _opts.stderr || stdio.stderr;
 
+  // Cache of release artifacts, used to avoid re-downloading them in full.
+  // Pass null to disable caching.
+  if (typeof _opts.artifactCache === 'undefined') {
+    this.artifactCache = pypyjs.defaultArtifactCache;
+  } else {
+    this.artifactCache = _opts.artifactCache;
+  }
+
   // Default to finding files relative to this very file.
   if (!this.rootURL && !pypyjs.rootURL) {
     pypyjs.rootURL = _dirname;
@@ -221,7 +238,13 @@ function pypyjs(opts) {
   // have to pay asmjs compilation overhead each time we create the VM.
 
   if (!pypyjs._vmBuilderPromise) {
-    pypyjs._vmBuilderPromise = this.fetch('pypyjs.vm.js').then((xhr) => {
+    let vmSourceP;
+    if (this.artifactCache) {
+      vmSourceP = this.fetchArtifact('pypyjs.vm.js').then(_decodeText);
+    } else {
+      vmSourceP = this.fetch('pypyjs.vm.js').then((xhr) => xhr.responseText);
+    }
+    pypyjs._vmBuilderPromise = vmSourceP.then((vmSource) => {
       // Parse the compiled code, hopefully asynchronously.
       // Unfortunately our use of Function constructor here doesn't
       // play very well with nodejs, where things like 'module' and
@@ -230,7 +253,7 @@ function pypyjs(opts) {
       const funcBody = [
 
         // This is the compiled code for the VM.
-        xhr.responseText,
+        vmSource,
         '\n',
 
         // Ensure that some functions are available on the Module,
@@ -244,9 +267,24 @@ function pypyjs(opts) {
         'Module._emjs_make_handle = _emjs_make_handle;',
         'Module._emjs_free = _emjs_free;',
 
+        // Allow runtime state that lives outside the heap to be
+        // captured and restored, for snapshots of the VM.
+        'Module._getRuntimeState = function() {',
+        '  var state = {};',
+        pypyjs._snapshotVariables.map((name) => {
+          return `  if (typeof ${name} !== 'undefined') state.${name} = ${name};`;
+        }).join('\r\n'),
+        '  return state;',
+        '};',
+        'Module._setRuntimeState = function(state, restore) {',
+        pypyjs._snapshotVariables.map((name) => {
+          return `  if (typeof ${name} !== 'undefined' && '${name}' in state) ${name} = restore(${name}, state.${name});`;
+        }).join('\r\n'),
+        '};',
+
         // Call dependenciesFulfilled if it won't be done automatically.
         'dependenciesFulfilled=function() { inDependenciesFulfilled(FS); };',
-        'if(typeof memoryInitializer==="undefined"||!memoryInitializer||(!ENVIRONMENT_IS_WEB&&!ENVIRONMENT_IS_WORKER))dependenciesFulfilled();',
+        'if(typeof memoryInitializer==="undefined"||!memoryInitializer||!runDependencies)dependenciesFulfilled();',
       ].join('\r\n');
       return new FunctionPromise('Module', 'inDependenciesFulfilled', 'require',
                              'module', '__filename', '_dirname', funcBody);
@@ -272,6 +310,59 @@ function pypyjs(opts) {
       return (this.rootURL || pypyjs.rootURL) + name;
     };
 
+    if (this._snapshot) {
+      // Start from a copy of the snapshot's heap, which already holds
+      // the initialized memory, so there's nothing more to load.
+      Module.buffer = this._snapshot.heap.slice(0);
+      Module.loadMemoryInitializer = (url, onload) => {
+        setTimeout(() => onload(null), 0);
+      };
+    } else {
+      // Start rebuilding the memory initializer from the artifact cache
+      // straight away, rather than waiting for the VM to ask for it once it
+      // has been loaded.  The name of the memory file comes from the release
+      // manifest, which is tiny.  If it's not cached then the data is null,
+      // and the VM downloads it itself, since its loader can decompress the
+      // file as it arrives.
+      const memoryDataP = this._fetchArtifactManifest().then((manifest) => {
+        const name = manifest.memoryInitializer;
+        if (!name) {
+          return null;
+        }
+        return this._fetchCachedArtifact(name).then((data) => ({ name, data }));
+      }).catch(() => null);
+
+      // Hand the memory initializer data to the VM when it asks for it.
+      // If it's not the file that the VM expects then let the VM load it
+      // the usual way.  If it's the right file but wasn't cached, then
+      // let the VM load it and keep a copy of what it got for the cache.
+      Module.loadMemoryInitializer = (url, onload, onerror, fallback) => {
+        memoryDataP.then((memoryData) => {
+          // Call back outside of the promise chain, so that errors
+          // thrown by the VM aren't swallowed.
+          setTimeout(() => {
+            const prefixURL = Module.memoryInitializerPrefixURL;
+            if (!memoryData || url !== prefixURL + memoryData.name) {
+              fallback(url, onload, onerror);
+            } else if (memoryData.data) {
+              onload(memoryData.data);
+            } else {
+              const chunks = [];
+              const onchunk = (chunk) => chunks.push(new Uint8Array(chunk));
+              fallback(url, (data) => {
+                // A streamed file comes in chunks, with empty data here.
+                const whole = (data && data.byteLength) ? new Uint8Array(data)
+                                                        : _concatBytes(chunks);
+                chunks.length = 0;
+                this._storeArtifact(memoryData.name, whole);
+                onload(data);
+              }, onerror, onchunk);
+            }
+          }, 0);
+        });
+      };
+    }
+
     // Don't start or stop the program, just set it up.
     // We'll call the API functions ourself.
     Module.noInitialRun = true;
@@ -317,11 +408,15 @@ function pypyjs(opts) {
       // Initialize the filesystem state.
       try {
         this.FS.init(stdin, stdout, stderr);
-        Module.FS_createPath('/', 'lib/pypyjs/lib_pypy', true, false);
-        // Hackery so the same file will work with py2 and py3.
-        // We only ever put our module files into lib_pypy.
-        Module.FS_createPath('/', 'lib/pypyjs/lib-python/2.7', true, false);
-        Module.FS_createPath('/', 'lib/pypyjs/lib-python/3', true, false);
+        if (this._snapshot) {
+          this._restoreFiles(this._snapshot.files);
+        } else {
+          Module.FS_createPath('/', 'lib/pypyjs/lib_pypy', true, false);
+          // Hackery so the same file will work with py2 and py3.
+          // We only ever put our module files into lib_pypy.
+          Module.FS_createPath('/', 'lib/pypyjs/lib-python/2.7', true, false);
+          Module.FS_createPath('/', 'lib/pypyjs/lib-python/3', true, false);
+        }
         initializedResolve();
       } catch (err) {
         initializedReject(err);
@@ -331,8 +426,8 @@ function pypyjs(opts) {
     // Begin fetching the metadata for available python modules.
     // With luck these can download while we jank around compiling
     // all of that javascript.
-    // XXX TODO: also load memory initializer this way.
-    const moduleDataP = this.fetch('modules/index.json');
+    // A snapshot already has the metadata, so it doesn't need fetching.
+    const moduleDataP = this._snapshot ? null : this.fetch('modules/index.json');
 
     pypyjs._vmBuilderPromise.then((vmBuilder) => {
       const args = [
@@ -348,6 +443,12 @@ function pypyjs(opts) {
       vmBuilder.apply(null, args);
       return initializedP;
     }).then(() => {
+      // Resume from the snapshot if we have one, skipping all of the
+      // startup code below since its effects are already in the heap.
+      if (this._snapshot) {
+        return this._restoreSnapshot(this._snapshot);
+      }
+
       // Continue with processing the downloaded module metadata.
       return moduleDataP.then((xhr) => {
         // Store the module index, and load any preload modules.
@@ -435,7 +536,12 @@ pypyjs.prototype.fetch = function fetch(relpath, responseType) {
     return new Promise((resolve, reject) => {
       fs.readFile(path.join(rootURL, relpath), (err, data) => {
         if (err) return reject(err);
-        resolve({ responseText: data.toString() });
+        if (responseType === 'arraybuffer') {
+          const end = data.byteOffset + data.length;
+          resolve({ response: data.buffer.slice(data.byteOffset, end) });
+        } else {
+          resolve({ responseText: data.toString() });
+        }
       });
     });
   }
@@ -443,16 +549,22 @@ pypyjs.prototype.fetch = function fetch(relpath, responseType) {
   // For spidermonkey, use snarf (which has a binary read mode).
   if (typeof snarf !== 'undefined') {
     return new Promise((resolve) => {
-      const data = snarf(rootURL + relpath);
-      resolve({ responseText: data });
+      if (responseType === 'arraybuffer') {
+        resolve({ response: snarf(rootURL + relpath, 'binary').buffer });
+      } else {
+        resolve({ responseText: snarf(rootURL + relpath) });
+      }
     });
   }
 
   // For d8, use read() and readbuffer().
   if (typeof read !== 'undefined' && typeof readbuffer !== 'undefined') {
     return new Promise((resolve) => {
-      const data = read(rootURL + relpath);
-      resolve({ responseText: data });
+      if (responseType === 'arraybuffer') {
+        resolve({ response: readbuffer(rootURL + relpath) });
+      } else {
+        resolve({ responseText: read(rootURL + relpath) });
+      }
     });
   }
 
@@ -461,6 +573,254 @@ pypyjs.prototype.fetch = function fetch(relpath, responseType) {
   });
 };
 
+// Fetch a release artifact as a Uint8Array, via the artifact cache.
+//
+// If we can't get it from the cache, as described for _fetchCachedArtifact
+// below, then we fetch the artifact in full, and cache it for next time.
+
+pypyjs.prototype.fetchArtifact = function fetchArtifact(name) {
+  return this._fetchCachedArtifact(name).then((data) => {
+    if (data) {
+      return data;
+    }
+    return this.fetch(name, 'arraybuffer').then((xhr) => {
+      return this._storeArtifact(name, new Uint8Array(xhr.response));
+    });
+  });
+};
+
+// Get a release artifact from the artifact cache, without downloading it
+// in full.  This resolves to a Uint8Array, or to null if that can't be done.
+//
+// If we have a cached copy of the artifact from an earlier release, and
+// the release manifest lists a delta from that version, then we rebuild
+// the artifact by fetching the delta and applying it to the cached copy.
+// The result is checked against the sha1 hash from the manifest before
+// it's used or cached.
+
+pypyjs.prototype._fetchCachedArtifact = function _fetchCachedArtifact(name) {
+  const cache = this.artifactCache;
+  return this._fetchArtifactManifest().then((manifest) => {
+    const entry = (manifest.artifacts || {})[name];
+    if (!cache || !entry) {
+      return null;
+    }
+    return Promise.resolve(cache.get(name)).then((cached) => {
+      if (!cached) {
+        return null;
+      }
+      if (cached.sha1 === entry.sha1) {
+        return cached.data;
+      }
+      const deltaPath = entry.deltas && entry.deltas[cached.sha1];
+      if (!deltaPath) {
+        return null;
+      }
+      return this.fetch(deltaPath, 'arraybuffer').then((xhr) => {
+        const data = pypyjs.applyDelta(cached.data, new Uint8Array(xhr.response));
+        return _sha1(data).then((sha1) => {
+          if (sha1 !== entry.sha1) {
+            throw new pypyjs.Error('ChecksumError', `bad checksum for ${name}`);
+          }
+          // Failing to update the cache shouldn't stop us using the data.
+          const done = () => data;
+          return Promise.resolve(cache.put(name, { sha1, data })).then(done, done);
+        });
+      });
+    });
+  }).catch(() => null);
+};
+
+// Store a downloaded artifact in the artifact cache, if its sha1 hash
+// matches the release manifest.  Failing to store it shouldn't stop us
+// using the data, so this always resolves to the data.
+
+pypyjs.prototype._storeArtifact = function _storeArtifact(name, data) {
+  const cache = this.artifactCache;
+  const done = () => data;
+  return this._fetchArtifactManifest().then((manifest) => {
+    const entry = (manifest.artifacts || {})[name];
+    if (!cache || !entry) {
+      return null;
+    }
+    return _sha1(data).then((sha1) => {
+      if (sha1 !== entry.sha1) {
+        return null;
+      }
+      return cache.put(name, { sha1, data });
+    });
+  }).then(done, done);
+};
+
+// Fetch the release manifest, which names the memory initializer file
+// and maps artifact names to their details.  Releases without a manifest
+// are treated as having an empty one.
+
+pypyjs.prototype._fetchArtifactManifest = function _fetchArtifactManifest() {
+  if (!this._artifactManifestP) {
+    this._artifactManifestP = this.fetch('artifacts.json').then((xhr) => {
+      return JSON.parse(xhr.responseText);
+    }).catch(() => ({}));
+  }
+  return this._artifactManifestP;
+};
+
+// Apply a delta generated by tools/make_release_delta.py to the given
+// source data, returning the resulting Uint8Array.  See that script for
+// a description of the format.
+
+pypyjs.applyDelta = function applyDelta(source, delta) {
+  let pos = 0;
+  const readVarint = () => {
+    let value = 0;
+    let scale = 1;
+    for (;;) {
+      if (pos >= delta.length) {
+        throw new pypyjs.Error('DeltaError', 'corrupt delta file');
+      }
+      const byte = delta[pos++];
+      value += (byte & 0x7F) * scale;
+      scale *= 128;
+      if (byte < 0x80) {
+        return value;
+      }
+    }
+  };
+
+  if (String.fromCharCode(delta[0], delta[1], delta[2], delta[3]) !== 'PJSD') {
+    throw new pypyjs.Error('DeltaError', 'not a delta file');
+  }
+  pos = 4;
+  const sourceSize = readVarint();
+  const targetSize = readVarint();
+  if (sourceSize !== source.length) {
+    throw new pypyjs.Error('DeltaError', 'delta is for a different source');
+  }
+
+  // The output starts with a copy of the source, so that copies
+  // can refer to the source and the target data alike.
+  const output = new Uint8Array(sourceSize + targetSize);
+  output.set(source);
+  let outPos = sourceSize;
+  let lastCopyEnd = 0;
+  while (pos < delta.length) {
+    const op = readVarint();
+    const length = Math.floor(op / 2);
+    if (outPos + length > output.length) {
+      throw new pypyjs.Error('DeltaError', 'corrupt delta file');
+    }
+    if (op % 2 === 0) {
+      output.set(delta.subarray(pos, pos + length), outPos);
+      pos += length;
+    } else {
+      const offset = readVarint();
+      const start = lastCopyEnd + (offset % 2 ? -(offset + 1) / 2 : offset / 2);
+      if (start < 0 || start >= outPos) {
+        throw new pypyjs.Error('DeltaError', 'corrupt delta file');
+      }
+      if (start + length <= outPos) {
+        output.set(output.subarray(start, start + length), outPos);
+      } else {
+        // The copy overlaps the data that it produces.
+        for (let i = 0; i < length; i++) {
+          output[outPos + i] = output[start + i];
+        }
+      }
+      lastCopyEnd = start + length;
+    }
+    outPos += length;
+  }
+  if (outPos !== output.length) {
+    throw new pypyjs.Error('DeltaError', 'corrupt delta file');
+  }
+  return output.subarray(sourceSize);
+};
+
+// A cache of release artifacts, stored in IndexedDB.
+// Each record is an object {sha1, data} keyed by artifact name.
+
+pypyjs.IndexedDBArtifactCache = function IndexedDBArtifactCache(dbName) {
+  this.dbName = dbName || 'pypyjs-artifacts';
+  this._dbP = null;
+};
+
+pypyjs.IndexedDBArtifactCache.prototype._request = function _request(mode, makeRequest) {
+  if (!this._dbP) {
+    this._dbP = new Promise((resolve, reject) => {
+      const req = indexedDB.open(this.dbName, 1);
+      req.onupgradeneeded = () => req.result.createObjectStore('artifacts');
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => reject(req.error);
+    });
+  }
+  return this._dbP.then((db) => {
+    return new Promise((resolve, reject) => {
+      const store = db.transaction('artifacts', mode).objectStore('artifacts');
+      const req = makeRequest(store);
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => reject(req.error);
+    });
+  });
+};
+
+pypyjs.IndexedDBArtifactCache.prototype.get = function get(name) {
+  return this._request('readonly', (store) => store.get(name));
+};
+
+pypyjs.IndexedDBArtifactCache.prototype.put = function put(name, record) {
+  return this._request('readwrite', (store) => store.put(record, name));
+};
+
+// Compute the hex sha1 hash of a Uint8Array, asynchronously.
+
+function _sha1(data) {
+  if (typeof nodeCrypto !== 'undefined') {
+    return Promise.resolve(nodeCrypto.createHash('sha1').update(data).digest('hex'));
+  }
+  if (typeof crypto !== 'undefined' && crypto.subtle) {
+    return Promise.resolve(crypto.subtle.digest('SHA-1', data)).then((digest) => {
+      const bytes = new Uint8Array(digest);
+      let hex = '';
+      for (let i = 0; i < bytes.length; i++) {
+        hex += (bytes[i] < 16 ? '0' : '') + bytes[i].toString(16);
+      }
+      return hex;
+    });
+  }
+  return Promise.reject(new pypyjs.Error('ChecksumError', 'sha1 not available'));
+}
+
+// Decode a Uint8Array of utf8 text into a string.
+
+function _decodeText(data) {
+  if (typeof TextDecoder !== 'undefined') {
+    return new TextDecoder('utf-8').decode(data);
+  }
+  if (typeof Buffer !== 'undefined') {
+    return Buffer.from(data.buffer, data.byteOffset, data.length).toString();
+  }
+  // The compiled VM is plain ascii, so this will do as a last resort.
+  const chunks = [];
+  for (let i = 0; i < data.length; i += 8192) {
+    chunks.push(String.fromCharCode.apply(null, data.subarray(i, i + 8192)));
+  }
+  return chunks.join('');
+}
+
+// Join a list of Uint8Arrays into one.
+
+function _concatBytes(chunks) {
+  let length = 0;
+  chunks.forEach((chunk) => { length += chunk.length; });
+  const data = new Uint8Array(length);
+  let offset = 0;
+  chunks.forEach((chunk) => {
+    data.set(chunk, offset);
+    offset += chunk.length;
+  });
+  return data;
+}
+
 function _escape(value) {
   return value.replace(/\\/g, '\\\\').replace(/'/g, '\\\'');
 }
@@ -529,6 +889,250 @@ pypyjs.prototype.ready = function ready() {
   return this._ready;
 };
 
+// Capture the state of the VM once it's ready, as a pypyjs.Snapshot.
+//
+// The snapshot holds a copy of the heap, the files in the virtual
+// filesystem, and the bits of runtime state that live outside the heap.
+// Passing it as the `snapshot` option when creating a new VM will give
+// a copy of this one, without repeating any of the startup work.
+
+pypyjs.prototype.snapshot = function snapshot() {
+  return this.ready().then(() => {
+    const Module = this._module;
+    const runtime = Module._getRuntimeState();
+    Object.keys(runtime).forEach((name) => {
+      runtime[name] = _copyRuntimeValue(runtime[name]);
+    });
+    return new pypyjs.Snapshot({
+      heap: Module.HEAPU8.buffer.slice(0),
+      files: this._snapshotFiles('/', []),
+      runtime,
+      allModules: JSON.parse(JSON.stringify(this._allModules)),
+      loadedModules: JSON.parse(JSON.stringify(this._loadedModules))
+    });
+  });
+};
+
+// Finish starting up a VM from a snapshot, once its heap and files are
+// in place.  The runtime state is restored before calling Module.run()
+// so that any memory allocated while initializing the runtime doesn't
+// collide with memory in use by the snapshot.
+
+pypyjs.prototype._restoreSnapshot = function _restoreSnapshot(snapshot) {
+  const Module = this._module;
+  Module._setRuntimeState(snapshot.runtime, _restoreRuntimeValue);
+  Module.run();
+  this._allModules = JSON.parse(JSON.stringify(snapshot.allModules));
+  this._loadedModules = JSON.parse(JSON.stringify(snapshot.loadedModules));
+};
+
+// Files under these paths are created by the runtime itself,
+// so they are not included in snapshots.
+const SNAPSHOT_SKIP_PATHS = { '/dev': true, '/proc': true };
+
+pypyjs.prototype._snapshotFiles = function _snapshotFiles(dirPath, files) {
+  const FS = this.FS;
+  FS.readdir(dirPath).forEach((name) => {
+    if (name === '.' || name === '..') {
+      return;
+    }
+    const filePath = (dirPath === '/' ? '' : dirPath) + '/' + name;
+    if (SNAPSHOT_SKIP_PATHS[filePath]) {
+      return;
+    }
+    const mode = FS.lstat(filePath).mode;
+    if (FS.isLink(mode)) {
+      files.push({ path: filePath, link: FS.readlink(filePath) });
+    } else if (FS.isDir(mode)) {
+      files.push({ path: filePath, dir: true });
+      this._snapshotFiles(filePath, files);
+    } else if (FS.isFile(mode)) {
+      const data = FS.readFile(filePath, { encoding: 'binary' });
+      files.push({ path: filePath, data });
+    }
+  });
+  return files;
+};
+
+pypyjs.prototype._restoreFiles = function _restoreFiles(files) {
+  const Module = this._module;
+  files.forEach((file) => {
+    if (file.dir) {
+      Module.FS_createPath('/', file.path.substr(1), true, true);
+    } else if (typeof file.link !== 'undefined') {
+      this.FS.symlink(file.link, file.path);
+    } else {
+      this.FS.writeFile(file.path, file.data, { encoding: 'binary' });
+    }
+  });
+};
+
+// The runtime variables captured in snapshots, in addition to the heap.
+// These are the top of the dynamically-allocated memory, and the table
+// of javascript objects that are referenced by handles from python code.
+// Names that don't exist in the compiled VM are ignored.
+
+pypyjs._snapshotVariables = ['DYNAMICTOP', 'EMJS'];
+
+// Runtime values are copied one level deep when captured or restored, so
+// that the running VM and the snapshot don't share any mutable arrays or
+// objects.  The javascript objects they refer to are shared, however.
+// Objects in the VM are updated in place, since functions in the runtime
+// may hold on to references to them.
+
+function _copyRuntimeValue(value) {
+  if (Array.isArray(value)) {
+    return value.slice();
+  }
+  if (value && typeof value === 'object' &&
+      Object.getPrototypeOf(value) === Object.prototype) {
+    const copy = {};
+    Object.keys(value).forEach((key) => {
+      copy[key] = Array.isArray(value[key]) ? value[key].slice() : value[key];
+    });
+    return copy;
+  }
+  return value;
+}
+
+function _restoreRuntimeValue(current, saved) {
+  if (current && typeof current === 'object' && !Array.isArray(current) &&
+      saved && typeof saved === 'object' && !Array.isArray(saved)) {
+    const copy = _copyRuntimeValue(saved);
+    Object.keys(copy).forEach((key) => {
+      current[key] = copy[key];
+    });
+    return current;
+  }
+  return _copyRuntimeValue(saved);
+}
+
+// A snapshot of a VM, as produced by pypyjs.prototype.snapshot().
+//
+// On nodejs a snapshot can be saved to a file, and loaded again by a
+// later process.  The file holds a JSON header describing the snapshot,
+// followed by the heap and then the contents of each file.  Saving fails
+// if python code holds handles to any javascript objects other than the
+// global object, since there's no way to persist them.
+
+pypyjs.Snapshot = function Snapshot(state) {
+  this.heap = state.heap;
+  this.files = state.files;
+  this.runtime = state.runtime;
+  this.allModules = state.allModules;
+  this.loadedModules = state.loadedModules;
+};
+
+const SNAPSHOT_MAGIC = 'PJSS';
+
+pypyjs.Snapshot.prototype.save = function save(filename) {
+  if (typeof fs === 'undefined') {
+    throw new pypyjs.Error('SnapshotError', 'snapshots can only be saved on nodejs');
+  }
+  const blobs = [Buffer.from(this.heap)];
+  const header = {
+    version: 1,
+    heapSize: this.heap.byteLength,
+    runtime: _serializeRuntimeValue(this.runtime),
+    allModules: this.allModules,
+    loadedModules: this.loadedModules,
+    files: this.files.map((file) => {
+      if (!file.data) {
+        return file;
+      }
+      blobs.push(Buffer.from(file.data.buffer, file.data.byteOffset, file.data.length));
+      return { path: file.path, size: file.data.length };
+    })
+  };
+  const headerData = Buffer.from(JSON.stringify(header), 'utf8');
+  const prefix = Buffer.alloc(8);
+  prefix.write(SNAPSHOT_MAGIC, 0, 'ascii');
+  prefix.writeUInt32LE(headerData.length, 4);
+  fs.writeFileSync(filename, Buffer.concat([prefix, headerData].concat(blobs)));
+};
+
+pypyjs.Snapshot.load = function load(filename) {
+  if (typeof fs === 'undefined') {
+    throw new pypyjs.Error('SnapshotError', 'snapshots can only be loaded on nodejs');
+  }
+  const data = fs.readFileSync(filename);
+  if (data.toString('ascii', 0, 4) !== SNAPSHOT_MAGIC) {
+    throw new pypyjs.Error('SnapshotError', `${filename} is not a snapshot`);
+  }
+  const headerSize = data.readUInt32LE(4);
+  const header = JSON.parse(data.toString('utf8', 8, 8 + headerSize));
+  let pos = 8 + headerSize;
+  const heap = new ArrayBuffer(header.heapSize);
+  new Uint8Array(heap).set(data.subarray(pos, pos + header.heapSize));
+  pos += header.heapSize;
+  const files = header.files.map((file) => {
+    if (typeof file.size === 'undefined') {
+      return file;
+    }
+    const fileData = new Uint8Array(data.subarray(pos, pos + file.size));
+    pos += file.size;
+    return { path: file.path, data: fileData };
+  });
+  return new pypyjs.Snapshot({
+    heap,
+    files,
+    runtime: _deserializeRuntimeValue(header.runtime),
+    allModules: header.allModules,
+    loadedModules: header.loadedModules
+  });
+};
+
+// Convert runtime values to and from JSON-compatible form, for saving.
+// Functions on objects are skipped, since the VM has its own copies.
+
+function _serializeRuntimeValue(value, inObject) {
+  if (typeof value === 'undefined') {
+    return { $: 'undefined' };
+  }
+  if (value === null || typeof value !== 'object') {
+    if (typeof value === 'function' && !inObject) {
+      throw new pypyjs.Error('SnapshotError', 'cannot save references to javascript functions');
+    }
+    return value;
+  }
+  if (value === globalScope || (typeof global !== 'undefined' && value === global)) {
+    return { $: 'global' };
+  }
+  if (Array.isArray(value)) {
+    return value.map((item) => _serializeRuntimeValue(item, false));
+  }
+  if (Object.getPrototypeOf(value) !== Object.prototype) {
+    throw new pypyjs.Error('SnapshotError', 'cannot save references to javascript objects');
+  }
+  const result = {};
+  Object.keys(value).forEach((key) => {
+    if (typeof value[key] !== 'function') {
+      result[key] = _serializeRuntimeValue(value[key], true);
+    }
+  });
+  return result;
+}
+
+function _deserializeRuntimeValue(value) {
+  if (value === null || typeof value !== 'object') {
+    return value;
+  }
+  if (Array.isArray(value)) {
+    return value.map(_deserializeRuntimeValue);
+  }
+  if (value.$ === 'undefined') {
+    return undefined;
+  }
+  if (value.$ === 'global') {
+    return typeof global !== 'undefined' ? global : globalScope;
+  }
+  const result = {};
+  Object.keys(value).forEach((key) => {
+    result[key] = _deserializeRuntimeValue(value[key]);
+  });
+  return result;
+}
+
 // Method to execute some python code.
 //
 // This passes the given python code to the VM for execution.
@@ -974,6 +1578,13 @@ pypyjs.stdin = stdio.stdin;
 pypyjs.stdout = stdio.stdout;
 pypyjs.stderr = stdio.stderr;
 
+// Cache release artifacts in IndexedDB by default, where available.
+if (typeof indexedDB !== 'undefined') {
+  pypyjs.defaultArtifactCache = new pypyjs.IndexedDBArtifactCache();
+} else {
+  pypyjs.defaultArtifactCache = null;
+}
+
 pypyjs._defaultVM = null;
 pypyjs._defaultStdin = function defaultStdin() { return pypyjs.stdin(...arguments); };
 pypyjs._defaultStdout = function defaultStdout() { return pypyjs.stdout(...arguments); };
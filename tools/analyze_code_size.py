@@ -1,48 +1,343 @@
+#
+#  Analyze code size for emscripten-compiled output.
+#
+#  This script lists the size of each function in the asmjs code, or with
+#  the --by-module option aggregates them by the prefix of their mangled
+#  name.  RPython names every function "pypy_g_" followed by the name of
+#  the function, which usually starts with its class or module name, so
+#  grouping on the first word or two of that name shows roughly which
+#  subsystem each function belongs to.  The --depth option gives how many
+#  words to use.
+#
+#  Given two files, it instead shows how the size of each function or
+#  module changed between them, largest growth first, which is handy for
+#  tracking down size regressions from one build to the next.  Either file
+#  may be a JSON file written by the --json option, so that the sizes from
+#  a previous build can be kept without keeping the build itself.
+#
+#  The code is read incrementally, and only the metrics for each function
+#  are kept, so this runs in roughly constant memory apart from those.
+#
+#  Besides its size, a few indicators of how expensive each function is to
+#  compile are collected: the number of statements, locals, switch cases,
+#  labels and loops, and the deepest nesting of loops.  The --cost option
+#  ranks functions by a rough estimate of compile cost based on these,
+#  which points at the huge functions behind "compiled slowly" warnings,
+#  and so at where outlining or a different --inline-threshold would help.
+#  The estimate has no units, and is only useful for comparing functions.
+#
 
 import os
 import re
 import sys
+import json
 import optparse
 
 MARKER_START_FUNCS = "// EMSCRIPTEN_START_FUNCS"
 MARKER_END_FUNCS = "// EMSCRIPTEN_END_FUNCS"
 
-FUNCTION_CODE_RE = re.compile(
-  r"function (?P<name>[a-zA-Z0-9_]+)(?P<defn>.*?)((?=function)|(?=$))"
-)
+FUNCTION_NAME_RE = re.compile(r"(?P<name>[a-zA-Z0-9_$]+)")
+
+# Patterns used to collect the compile-cost metrics.  The asmjs code within
+# functions has no strings, comments or regexp literals, so simple matching
+# on the text is good enough.  A label is an identifier and a colon at the
+# start of a statement, which can't be confused with a conditional.
+
+PARAMS_RE = re.compile(r"\((?P<params>[^)]*)\)")
+VAR_RE = re.compile(r"\bvar\s+(?P<decls>[^;]*);")
+CASE_RE = re.compile(r"\bcase\b|\bdefault\s*:")
+IF_RE = re.compile(r"\bif\b")
+LABEL_RE = re.compile(r"(?:^|[{};])\s*(?!default\b)[a-zA-Z_$][\w$]*\s*:")
+LOOP_TOKEN_RE = re.compile(r"[(){};]|\b(?:while|for|do)\b")
+
+# Compile time grows with the number of statements, but register allocation
+# grows with the number of locals times the number of basic blocks.  The
+# latter is weighted down by this factor when estimating compile cost.
+
+LOCALS_BLOCKS_PER_STATEMENT = 16
+
+# The metrics that are collected for each function, and shown by --cost.
+
+METRICS = ("size", "statements", "locals", "cases", "labels", "loops",
+           "loop_depth", "cost")
+
+# The code is read this many bytes at a time.
+
+CHUNK_SIZE = 1024 * 1024
+
+# Functions that RPython generated have this prefix on their name, and are
+# grouped by the words that follow it.  Anything else is grouped under its
+# own first word, which is usually some part of the emscripten runtime.
+
+RPYTHON_PREFIX = "pypy_g_"
+DEFAULT_DEPTH = 1
 
 
 def analyze_code_size(fileobj, opts):
-    funcs = {}
+    """Collect the metrics for each function in the given code.
+
+    This returns a dict mapping function names to FunctionMetrics objects.
+    If `fileobj` is a JSON file written by the --json option, the metrics
+    are loaded from it instead.
+    """
     name_re = None
     if opts.grep is not None:
-      name_re = re.compile(opts.grep, re.I)
-    # Split out and analyze the code for each individual function.
-    # XXX TODO: read incrementally to reduce memory usage.
-    data = fileobj.read()
-    pre_code, data = data.split(MARKER_START_FUNCS, 1)
-    data, post_code = data.split(MARKER_END_FUNCS, 1)
-    for match in FUNCTION_CODE_RE.finditer(data):
-        name = match.group("name")
-        defn = match.group("defn")
-        if name_re and not name_re.search(name):
-            continue
-        funcs[name] = FunctionMetrics(name, defn)
-    # Print summary metrics.
-    total = 0
-    funcs_by_size = ((f.size, f.name) for f in funcs.itervalues())
-    for (size, name) in sorted(funcs_by_size, reverse=True):
-        print size, name, human_readable(size)
-        total += size
-    print "Total size:", total, human_readable(total)
+        name_re = re.compile(opts.grep, re.I)
+    if getattr(fileobj, "name", "").endswith(".json"):
+        funcs = load_metrics(fileobj)
+    else:
+        funcs = {}
+        for name, defn in iter_functions(fileobj):
+            funcs[name] = FunctionMetrics(name, defn)
+    if name_re is not None:
+        for name in list(funcs):
+            if not name_re.search(name):
+                del funcs[name]
+    return funcs
+
+
+def iter_functions(fileobj, chunk_size=CHUNK_SIZE):
+    """Generate a (name, defn) pair for each function in the code.
+
+    The code is read incrementally, so that only a single function needs to
+    be held in memory at a time.  As in cromulate, we don't have to actually
+    *parse* the code, just chunk it up.
+    """
+    data = ""
+    started = seen_function = done = False
+    while not done:
+        chunk = fileobj.read(chunk_size)
+        data += chunk
+        if not started:
+            pos = data.find(MARKER_START_FUNCS)
+            if pos < 0:
+                if not chunk:
+                    raise ValueError("could not find start of functions")
+                data = data[-len(MARKER_START_FUNCS):]
+                continue
+            data = data[pos + len(MARKER_START_FUNCS):]
+            started = True
+        pos = data.find(MARKER_END_FUNCS)
+        done = pos >= 0 or not chunk
+        if pos >= 0:
+            data = data[:pos]
+        pieces = data.split("function ")
+        # Unless we're done, the last piece may be incomplete, so keep it
+        # for next time.  The first piece is just whitespace.
+        data = "" if done else pieces.pop()
+        if pieces and not seen_function:
+            pieces.pop(0)
+            seen_function = True
+        for piece in pieces:
+            yield split_function(piece)
+
+
+def split_function(piece):
+    match = FUNCTION_NAME_RE.match(piece)
+    if match is None:
+        raise ValueError("could not find function name: %r" % (piece[:40],))
+    return match.group("name"), piece[match.end():]
+
+
+def load_metrics(fileobj):
+    """Load function metrics from JSON written by the --json option."""
+    data = json.load(fileobj)
+    if "functions" not in data:
+        raise ValueError("%s does not contain function metrics" % (
+            getattr(fileobj, "name", "input"),))
+    funcs = {}
+    for name, metrics in data["functions"].iteritems():
+        funcs[name] = FunctionMetrics.from_dict(name, metrics)
+    return funcs
 
 
 class FunctionMetrics(object):
 
     def __init__(self, name, defn):
         self.name = name
-        self.defn = defn
         self.size = len(defn)
+        # Minified code leaves out the semicolon before a closing brace.
+        self.statements = defn.count(";") + defn.count("}")
+        self.locals = 0
+        match = PARAMS_RE.match(defn)
+        if match is not None and match.group("params").strip():
+            self.locals += match.group("params").count(",") + 1
+        for match in VAR_RE.finditer(defn):
+            self.locals += match.group("decls").count(",") + 1
+        self.cases = len(CASE_RE.findall(defn))
+        self.labels = len(LABEL_RE.findall(defn))
+        self.loops, self.loop_depth = count_loops(defn)
+        branches = len(IF_RE.findall(defn))
+        blocks = 1 + branches + self.cases + self.labels + self.loops
+        self.cost = self.statements + (self.locals * blocks //
+                                       LOCALS_BLOCKS_PER_STATEMENT)
+
+    @classmethod
+    def from_dict(cls, name, metrics):
+        self = cls.__new__(cls)
+        self.name = name
+        # Metrics that weren't saved, e.g. by older versions, are zero.
+        for metric in METRICS:
+            setattr(self, metric, metrics.get(metric, 0))
+        return self
+
+    def to_dict(self):
+        return dict((metric, getattr(self, metric)) for metric in METRICS)
+
+
+def count_loops(defn):
+    """Count the loops in a function, and find how deeply they're nested.
+
+    This tracks which braces open the body of a loop.  The "while" that
+    ends a do-loop is skipped, and a loop whose body is a single statement
+    still counts towards the nesting depth but doesn't open a level.
+    """
+    loops = max_depth = depth = parens = 0
+    braces = []
+    pending = None
+    after_do = False
+    for match in LOOP_TOKEN_RE.finditer(defn):
+        token = match.group()
+        if token == "(":
+            parens += 1
+            continue
+        if token == ")":
+            parens -= 1
+            continue
+        if parens > 0:
+            continue
+        ended_do = False
+        if token == "{":
+            braces.append(pending)
+            if pending is not None:
+                depth += 1
+            pending = None
+        elif token == "}":
+            kind = braces.pop() if braces else None
+            if kind is not None:
+                depth -= 1
+            ended_do = kind == "do"
+        elif token == ";":
+            ended_do = pending == "do"
+            pending = None
+        elif token != "while" or not after_do:
+            pending = token
+            loops += 1
+            max_depth = max(max_depth, depth + 1)
+        after_do = ended_do
+    return loops, max_depth
+
+
+def module_name(name, depth=DEFAULT_DEPTH):
+    """Get the module that a function belongs to, from its mangled name."""
+    name = name.lstrip("_")
+    prefix = ""
+    if name.startswith(RPYTHON_PREFIX):
+        prefix = RPYTHON_PREFIX
+        name = name[len(RPYTHON_PREFIX):]
+    words = [word for word in name.split("_") if word]
+    return prefix + "_".join(words[:max(depth, 1)])
+
+
+def aggregate_sizes(funcs, by_module=False, depth=DEFAULT_DEPTH,
+                    metric="size"):
+    """Get a dict mapping each function or module to its total size.
+
+    Any of the other METRICS may be totalled instead of size.
+    """
+    sizes = {}
+    for name, metrics in funcs.iteritems():
+        if by_module:
+            name = module_name(name, depth)
+        sizes[name] = sizes.get(name, 0) + getattr(metrics, metric)
+    return sizes
+
+
+def summarize(funcs, opts):
+    """Summarize the metrics of one build as a JSON-friendly dict."""
+    modules = {}
+    for name, metrics in funcs.iteritems():
+        module = modules.setdefault(module_name(name, opts.depth),
+                                    {"size": 0, "cost": 0, "count": 0})
+        module["size"] += metrics.size
+        module["cost"] += metrics.cost
+        module["count"] += 1
+    return {
+        "total": sum(metrics.size for metrics in funcs.itervalues()),
+        "functions": dict((name, metrics.to_dict())
+                          for name, metrics in funcs.iteritems()),
+        "modules": modules,
+    }
+
+
+def diff_sizes(old_funcs, new_funcs, by_module=False, depth=DEFAULT_DEPTH,
+               metric="size"):
+    """Compare the sizes of each function or module in two builds.
+
+    This returns a list of (name, old_size, new_size) tuples for those
+    that changed, in order of decreasing growth.
+    """
+    old_sizes = aggregate_sizes(old_funcs, by_module, depth, metric)
+    new_sizes = aggregate_sizes(new_funcs, by_module, depth, metric)
+    changes = []
+    for name in set(old_sizes) | set(new_sizes):
+        old_size = old_sizes.get(name, 0)
+        new_size = new_sizes.get(name, 0)
+        if old_size != new_size:
+            changes.append((name, old_size, new_size))
+    changes.sort(key=lambda change: (change[1] - change[2], change[0]))
+    return changes
+
+
+def print_sizes(funcs, opts, metric="size", output=sys.stdout):
+    total = 0
+    units = human_readable if metric == "size" else (lambda size: "")
+    sizes = aggregate_sizes(funcs, opts.by_module, opts.depth, metric)
+    by_size = ((size, name) for name, size in sizes.iteritems())
+    for (size, name) in sorted(by_size, reverse=True):
+        output.write("%d %s %s\n" % (size, name, units(size)))
+        total += size
+    output.write("Total %s: %d %s\n" % (metric, total, units(total)))
+
+
+def print_costs(funcs, opts, output=sys.stdout):
+    """Print the compile-cost metrics of each function, costliest first."""
+    by_cost = sorted(funcs.itervalues(), key=lambda m: (-m.cost, m.name))
+    if opts.limit > 0:
+        by_cost = by_cost[:opts.limit]
+    columns = METRICS[::-1]
+    output.write(" ".join("%10s" % (metric,) for metric in columns))
+    output.write(" name\n")
+    for metrics in by_cost:
+        output.write(" ".join("%10d" % (getattr(metrics, metric),)
+                              for metric in columns))
+        output.write(" %s\n" % (metrics.name,))
+    total = sum(metrics.cost for metrics in funcs.itervalues())
+    output.write("Total cost: %d\n" % (total,))
+
+
+def print_diff(changes, old_funcs, new_funcs, metric="size",
+               output=sys.stdout):
+    units = human_readable if metric == "size" else (lambda size: "")
+    for name, old_size, new_size in changes:
+        output.write("%+d %s (%d => %d) %s\n" % (
+            new_size - old_size, name, old_size, new_size,
+            units(abs(new_size - old_size)),
+        ))
+    old_total = sum(getattr(m, metric) for m in old_funcs.itervalues())
+    new_total = sum(getattr(m, metric) for m in new_funcs.itervalues())
+    added = len(set(new_funcs) - set(old_funcs))
+    removed = len(set(old_funcs) - set(new_funcs))
+    output.write("Functions added: %d, removed: %d\n" % (added, removed))
+    output.write("Total %s: %+d (%d => %d) %s\n" % (
+        metric, new_total - old_total, old_total, new_total,
+        units(abs(new_total - old_total)),
+    ))
+
+
+def write_json(data, output=sys.stdout):
+    json.dump(data, output, indent=2, separators=(",", ": "), sort_keys=True)
+    output.write("\n")
 
 
 def human_readable(size):
@@ -52,19 +347,61 @@ def human_readable(size):
         if size / scale > 0.1:
             return "(%.2f%s)" % (size / scale, unit)
     return ""
-    
 
 
 def main(args=None):
-    usage = "usage: %prog [options] file"
+    usage = "usage: %prog [options] file [new_file]"
     descr = "Analyze code size and complexity for emscripten-compiled output"
     parser = optparse.OptionParser(usage=usage, description=descr)
     parser.add_option("-g", "--grep", metavar="REGEXP",
                       help="only analyze functions matching this regexp")
+    parser.add_option("-m", "--by-module", action="store_true",
+                      help="aggregate sizes by module name prefix")
+    parser.add_option("-d", "--depth", type=int, default=DEFAULT_DEPTH,
+                      metavar="N",
+                      help="number of name words that identify a module")
+    parser.add_option("-c", "--cost", action="store_true",
+                      help="rank functions by estimated compile cost")
+    parser.add_option("-n", "--limit", type=int, default=0, metavar="N",
+                      help="only show the N costliest functions")
+    parser.add_option("-j", "--json", action="store_true",
+                      help="write metrics as JSON")
 
     opts, args = parser.parse_args(args)
-    with open(args[0], "r") as infile:
-        analyze_code_size(infile, opts)
+    if len(args) not in (1, 2):
+        parser.error("expected one file to analyze, or two to compare")
+    builds = []
+    for filename in args:
+        with open(filename, "r") as infile:
+            builds.append(analyze_code_size(infile, opts))
+
+    metric = "cost" if opts.cost else "size"
+    if len(builds) == 1:
+        if opts.json:
+            write_json(summarize(builds[0], opts))
+        elif opts.cost and not opts.by_module:
+            print_costs(builds[0], opts)
+        else:
+            print_sizes(builds[0], opts, metric)
+    else:
+        changes = diff_sizes(builds[0], builds[1], opts.by_module, opts.depth,
+                             metric)
+        if opts.json:
+            write_json({
+                "old": os.path.basename(args[0]),
+                "new": os.path.basename(args[1]),
+                "metric": metric,
+                "total": {
+                    "old": sum(getattr(m, metric)
+                               for m in builds[0].itervalues()),
+                    "new": sum(getattr(m, metric)
+                               for m in builds[1].itervalues()),
+                },
+                "changes": [{"name": name, "old": old_size, "new": new_size}
+                            for name, old_size, new_size in changes],
+            })
+        else:
+            print_diff(changes, builds[0], builds[1], metric)
     return 0
 
 
@@ -0,0 +1,66 @@
+
+import sys
+
+from rpython.rlib import jit
+from rpython.jit.codewriter.policy import JitPolicy
+
+from benchlib import clock, parse_iterations, report
+
+
+# Churns through dicts and lists, inserting, looking up and deleting
+# entries, the way that the interpreter does for namespaces, attribute
+# dicts and the lists of user programs.  This exercises hashing, resizing
+# and the shuffling of list items.
+
+TABLE_SIZE = 4096
+QUEUE_SIZE = 64
+
+jitdriver = jit.JitDriver(greens=[], reds="auto")
+
+def churn(keys, iterations):
+    checksum = 0
+    by_int = {}
+    by_str = {}
+    queue = []
+    i = 0
+    while i < iterations:
+        jitdriver.jit_merge_point()
+        n = (i * 7919) % TABLE_SIZE
+        key = keys[n]
+        if n in by_int:
+            checksum += by_int[n] + by_str[key]
+            del by_int[n]
+            del by_str[key]
+        else:
+            by_int[n] = i & 0xFFFF
+            by_str[key] = len(queue)
+        queue.append(n)
+        if len(queue) > QUEUE_SIZE:
+            checksum += queue.pop(0)
+            queue.insert(len(queue) // 2, queue.pop())
+        checksum &= 0xFFFFFFF
+        i += 1
+    return checksum + len(by_int) + len(by_str)
+
+
+def entry_point(argv):
+    iterations = parse_iterations(argv, 5000000)
+    keys = ["key%d" % (n,) for n in range(TABLE_SIZE)]
+
+    ts = clock()
+    checksum = churn(keys, iterations)
+    tdiff = clock() - ts
+    report("containers", iterations, tdiff, checksum)
+    return 0
+
+
+def jitpolicy(driver):
+    return JitPolicy()
+
+
+def target(*args):
+    return entry_point, None
+
+
+if __name__ == "__main__":
+    sys.exit(entry_point(sys.argv))
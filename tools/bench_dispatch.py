@@ -0,0 +1,137 @@
+
+import sys
+
+from rpython.rlib import jit
+from rpython.jit.codewriter.policy import JitPolicy
+
+from benchlib import clock, parse_iterations, report
+
+
+# A tiny stack-based bytecode interpreter, whose time goes almost entirely
+# into dispatching on opcodes.  This is the shape of the main loop of the
+# pypy interpreter itself, and hence of most of the code that the JIT sees.
+
+PUSH = 0
+LOAD = 1
+STORE = 2
+ADD = 3
+SUB = 4
+MUL = 5
+AND = 6
+XOR = 7
+JUMP = 8
+JUMP_IF_ZERO = 9
+HALT = 10
+
+NUM_REGISTERS = 4
+STACK_SIZE = 16
+
+
+class Code(object):
+
+    _immutable_fields_ = ["ops[*]", "args[*]"]
+
+    def __init__(self, ops, args):
+        self.ops = ops
+        self.args = args
+
+
+jitdriver = jit.JitDriver(greens=["pc", "code"], reds="auto")
+
+def interpret(code, regs):
+    stack = [0] * STACK_SIZE
+    sp = 0
+    pc = 0
+    while True:
+        jitdriver.jit_merge_point(pc=pc, code=code)
+        op = code.ops[pc]
+        arg = code.args[pc]
+        pc += 1
+        if op == PUSH:
+            stack[sp] = arg
+            sp += 1
+        elif op == LOAD:
+            stack[sp] = regs[arg]
+            sp += 1
+        elif op == STORE:
+            sp -= 1
+            regs[arg] = stack[sp]
+        elif op == ADD:
+            sp -= 1
+            stack[sp - 1] = stack[sp - 1] + stack[sp]
+        elif op == SUB:
+            sp -= 1
+            stack[sp - 1] = stack[sp - 1] - stack[sp]
+        elif op == MUL:
+            sp -= 1
+            stack[sp - 1] = stack[sp - 1] * stack[sp]
+        elif op == AND:
+            sp -= 1
+            stack[sp - 1] = stack[sp - 1] & stack[sp]
+        elif op == XOR:
+            sp -= 1
+            stack[sp - 1] = stack[sp - 1] ^ stack[sp]
+        elif op == JUMP:
+            pc = arg
+        elif op == JUMP_IF_ZERO:
+            sp -= 1
+            if stack[sp] == 0:
+                pc = arg
+        elif op == HALT:
+            break
+        else:
+            raise RuntimeError("bad opcode")
+
+
+def assemble(program):
+    ops = [op for op, _ in program]
+    args = [arg for _, arg in program]
+    return Code(ops, args)
+
+
+def entry_point(argv):
+    iterations = parse_iterations(argv, 10000000)
+
+    # Count register 0 down to zero, mixing it into register 1 as we go.
+    # The program must be built at runtime, or it gets eliminated at
+    # compile-time.
+    code = assemble([
+        (LOAD, 0),
+        (JUMP_IF_ZERO, 17),
+        (LOAD, 1),
+        (LOAD, 0),
+        (PUSH, 3),
+        (MUL, 0),
+        (ADD, 0),
+        (LOAD, 0),
+        (XOR, 0),
+        (PUSH, 0xFFFFFF),
+        (AND, 0),
+        (STORE, 1),
+        (LOAD, 0),
+        (PUSH, 1),
+        (SUB, 0),
+        (STORE, 0),
+        (JUMP, 0),
+        (HALT, 0),
+    ])
+    regs = [0] * NUM_REGISTERS
+    regs[0] = iterations
+
+    ts = clock()
+    interpret(code, regs)
+    tdiff = clock() - ts
+    report("dispatch", iterations, tdiff, regs[1])
+    return 0
+
+
+def jitpolicy(driver):
+    return JitPolicy()
+
+
+def target(*args):
+    return entry_point, None
+
+
+if __name__ == "__main__":
+    sys.exit(entry_point(sys.argv))
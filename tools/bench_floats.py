@@ -0,0 +1,138 @@
+
+import sys
+import math
+
+from rpython.rlib import jit
+from rpython.jit.codewriter.policy import JitPolicy
+
+from benchlib import clock, parse_iterations, report
+
+
+# The classic n-body simulation of the outer planets, which spends its
+# time in float arithmetic and square roots on the fields of a handful
+# of objects.  Only IEEE-exact operations are used, so every build should
+# arrive at exactly the same energy.
+
+PI = 3.14159265358979323
+SOLAR_MASS = 4 * PI * PI
+DAYS_PER_YEAR = 365.24
+
+
+class Body(object):
+
+    def __init__(self, x, y, z, vx, vy, vz, mass):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.vx = vx * DAYS_PER_YEAR
+        self.vy = vy * DAYS_PER_YEAR
+        self.vz = vz * DAYS_PER_YEAR
+        self.mass = mass * SOLAR_MASS
+
+
+def make_bodies():
+    bodies = [
+        # The sun.
+        Body(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0),
+        # Jupiter.
+        Body(4.84143144246472090e+00, -1.16032004402742839e+00,
+             -1.03622044471123109e-01, 1.66007664274403694e-03,
+             7.69901118419740425e-03, -6.90460016972063023e-05,
+             9.54791938424326609e-04),
+        # Saturn.
+        Body(8.34336671824457987e+00, 4.12479856412430479e+00,
+             -4.03523417114321381e-01, -2.76742510726862411e-03,
+             4.99852801234917238e-03, 2.30417297573763929e-05,
+             2.85885980666130812e-04),
+        # Uranus.
+        Body(1.28943695621391310e+01, -1.51111514016986312e+01,
+             -2.23307578892655734e-01, 2.96460137564761618e-03,
+             2.37847173959480950e-03, -2.96589568540237556e-05,
+             4.36624404335156298e-05),
+        # Neptune.
+        Body(1.53796971148509165e+01, -2.59193146099879641e+01,
+             1.79258772950371181e-01, 2.68067772490389322e-03,
+             1.62824170038242295e-03, -9.51592254519715870e-05,
+             5.15138902046611451e-05),
+    ]
+    # Offset the momentum of the sun so the system stays put.
+    px = py = pz = 0.0
+    for body in bodies:
+        px += body.vx * body.mass
+        py += body.vy * body.mass
+        pz += body.vz * body.mass
+    sun = bodies[0]
+    sun.vx = -px / SOLAR_MASS
+    sun.vy = -py / SOLAR_MASS
+    sun.vz = -pz / SOLAR_MASS
+    return bodies
+
+
+jitdriver = jit.JitDriver(greens=[], reds="auto")
+
+def advance(bodies, dt, steps):
+    n = len(bodies)
+    while steps > 0:
+        jitdriver.jit_merge_point()
+        for i in range(n):
+            b1 = bodies[i]
+            for j in range(i + 1, n):
+                b2 = bodies[j]
+                dx = b1.x - b2.x
+                dy = b1.y - b2.y
+                dz = b1.z - b2.z
+                d2 = dx * dx + dy * dy + dz * dz
+                mag = dt / (d2 * math.sqrt(d2))
+                b1m = b1.mass * mag
+                b2m = b2.mass * mag
+                b1.vx -= dx * b2m
+                b1.vy -= dy * b2m
+                b1.vz -= dz * b2m
+                b2.vx += dx * b1m
+                b2.vy += dy * b1m
+                b2.vz += dz * b1m
+        for body in bodies:
+            body.x += dt * body.vx
+            body.y += dt * body.vy
+            body.z += dt * body.vz
+        steps -= 1
+
+
+def energy(bodies):
+    e = 0.0
+    n = len(bodies)
+    for i in range(n):
+        b1 = bodies[i]
+        e += 0.5 * b1.mass * (b1.vx * b1.vx + b1.vy * b1.vy + b1.vz * b1.vz)
+        for j in range(i + 1, n):
+            b2 = bodies[j]
+            dx = b1.x - b2.x
+            dy = b1.y - b2.y
+            dz = b1.z - b2.z
+            e -= (b1.mass * b2.mass) / math.sqrt(dx * dx + dy * dy + dz * dz)
+    return e
+
+
+def entry_point(argv):
+    iterations = parse_iterations(argv, 2000000)
+    bodies = make_bodies()
+
+    ts = clock()
+    advance(bodies, 0.01, iterations)
+    tdiff = clock() - ts
+    # The energy stays close to its starting value of about -0.169,
+    # so its first nine decimal places make a good checksum.
+    report("floats", iterations, tdiff, int(energy(bodies) * -1e9))
+    return 0
+
+
+def jitpolicy(driver):
+    return JitPolicy()
+
+
+def target(*args):
+    return entry_point, None
+
+
+if __name__ == "__main__":
+    sys.exit(entry_point(sys.argv))
@@ -0,0 +1,84 @@
+
+import sys
+
+from rpython.rlib import jit
+from rpython.jit.codewriter.policy import JitPolicy
+
+from benchlib import clock, parse_iterations, report
+
+
+# Allocates lots of short-lived binary trees while a long-lived one stays
+# around, after the classic GCBench.  Most of the time goes into the
+# allocator and the collector, and the long-lived tree means that each
+# minor collection has old objects pointing at it to deal with.
+
+LONG_LIVED_DEPTH = 16
+SHORT_LIVED_DEPTH = 10
+
+
+class Node(object):
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+
+def make_tree(depth):
+    if depth <= 0:
+        return Node(None, None)
+    return Node(make_tree(depth - 1), make_tree(depth - 1))
+
+
+def count_nodes(node):
+    count = 1
+    if node.left is not None:
+        count += count_nodes(node.left)
+    if node.right is not None:
+        count += count_nodes(node.right)
+    return count
+
+
+jitdriver = jit.JitDriver(greens=[], reds="auto")
+
+def churn(long_lived, iterations):
+    checksum = 0
+    i = 0
+    while i < iterations:
+        jitdriver.jit_merge_point()
+        tree = make_tree(SHORT_LIVED_DEPTH)
+        checksum += count_nodes(tree)
+        # Point the old tree at the new one, so the collector has to
+        # trace from old objects into young ones.
+        node = long_lived
+        for _ in range(i % LONG_LIVED_DEPTH):
+            child = node.left if i & 1 else node.right
+            if child is None:
+                break
+            node = child
+        node.left = tree.left
+        checksum &= 0xFFFFFFF
+        i += 1
+    return checksum
+
+
+def entry_point(argv):
+    iterations = parse_iterations(argv, 20000)
+    long_lived = make_tree(LONG_LIVED_DEPTH)
+
+    ts = clock()
+    checksum = churn(long_lived, iterations)
+    tdiff = clock() - ts
+    report("gc", iterations, tdiff, checksum)
+    return 0
+
+
+def jitpolicy(driver):
+    return JitPolicy()
+
+
+def target(*args):
+    return entry_point, None
+
+
+if __name__ == "__main__":
+    sys.exit(entry_point(sys.argv))
@@ -0,0 +1,59 @@
+
+import sys
+
+from rpython.rlib import jit
+from rpython.rlib.rstring import StringBuilder
+from rpython.jit.codewriter.policy import JitPolicy
+
+from benchlib import clock, parse_iterations, report
+
+
+# Builds up strings from formatted numbers and slices of other strings,
+# the way that e.g. repr() and str.join() do in the interpreter.  This
+# exercises string allocation, copying and int-to-string conversion.
+
+LINE_LENGTH = 100
+
+jitdriver = jit.JitDriver(greens=[], reds="auto")
+
+def build_lines(words, iterations):
+    checksum = 0
+    builder = StringBuilder()
+    i = 0
+    while i < iterations:
+        jitdriver.jit_merge_point()
+        word = words[i % len(words)]
+        builder.append(word[:(i % len(word)) + 1])
+        builder.append(str(i))
+        builder.append_multiple_char(" ", (i & 3) + 1)
+        if builder.getlength() >= LINE_LENGTH:
+            line = builder.build()
+            checksum = (checksum * 31 + len(line) + ord(line[i % 8])) & 0xFFFFF
+            builder = StringBuilder()
+        i += 1
+    return checksum
+
+
+def entry_point(argv):
+    iterations = parse_iterations(argv, 5000000)
+    # The words must be built at runtime, or the slicing gets
+    # eliminated at compile-time.
+    words = "spam eggs ham sausage bacon lobster".split(" ")
+
+    ts = clock()
+    checksum = build_lines(words, iterations)
+    tdiff = clock() - ts
+    report("strings", iterations, tdiff, checksum)
+    return 0
+
+
+def jitpolicy(driver):
+    return JitPolicy()
+
+
+def target(*args):
+    return entry_point, None
+
+
+if __name__ == "__main__":
+    sys.exit(entry_point(sys.argv))
@@ -0,0 +1,35 @@
+#
+#  Helpers shared by the RPython benchmark targets.
+#
+#  Each target is a standalone RPython program like rematcher.py, which
+#  can be run untranslated or translated with either backend.  It takes an
+#  optional number of iterations on the command line, times the work, and
+#  prints a single result line for run_benchmarks.py to pick up:
+#
+#    benchmark: NAME iterations=N seconds=S checksum=C
+#
+#  The checksum summarizes whatever the benchmark computed, so the runner
+#  can check that every build got the same answer.  Benchmarks must keep it
+#  within 32 bits, since untranslated python would otherwise compute a
+#  different result from the overflowing machine ints of a translated one.
+#
+
+from time import time as clock
+
+
+CHECKSUM_MASK = 0x3FFFFFFF
+
+
+def parse_iterations(argv, default):
+    """Get the number of iterations from the command-line arguments."""
+    if len(argv) > 2:
+        raise RuntimeError("too many arguments")
+    if len(argv) > 1:
+        return int(argv[1])
+    return default
+
+
+def report(name, iterations, elapsed, checksum):
+    """Print the result line for a benchmark."""
+    print "benchmark: %s iterations=%d seconds=%f checksum=%d" % (
+        name, iterations, elapsed, checksum & CHECKSUM_MASK)
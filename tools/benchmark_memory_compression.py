@@ -0,0 +1,299 @@
+#
+#  Compare compression schemes for the memory initializer.
+#
+#  This script takes one or more memory images and reports the compressed
+#  size and decode throughput of each of several schemes, so that changes to
+#  the "zmem" format produced by `compress_memory_initializer` can be judged
+#  against the obvious alternatives.  The schemes are:
+#
+#    raw:          the dense memory image, uncompressed
+#    gzip-9:       gzip at maximum compression, as a web server might apply
+#    zlib-zdict:   zlib with a preset dictionary, e.g. from a previous build
+#    zmem:         our own format, using the native match finder
+#    zmem-zlib:    our own format, using matches found by zlib
+#    zmem-1block:  our own format, as a single block
+#
+#  Every scheme is round-tripped, and the script fails loudly if any of them
+#  doesn't reproduce the image.  For zmem this uses the reference decoder in
+#  `compress_memory_initializer`, which is much slower than the asmjs one
+#  that actually ships.  If node is available then the --node option will
+#  also time the asmjs decompressor on the same data, which is the number
+#  to compare against zlib's C implementation.
+#
+#  Images can be given as dense .mem files, sparse .mem files written by
+#  `extract_memory_initializer --sparse` (with the --sparse option), or
+#  .zmem files which are decoded first.  The --synthetic option adds some
+#  generated images with a mix of zeros, strings, pointer-like words and
+#  noise, roughly resembling real ones.  These are handy for a quick check
+#  since they need no build of the VM.
+#
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import tempfile
+import optparse
+import subprocess
+
+from extract_memory_initializer import find_segments, decode_segment_table
+from compress_memory_initializer import encode_zmem, decode_zmem, unzip_code
+
+
+VARIANTS = (
+    "raw",
+    "gzip-9",
+    "zlib-zdict",
+    "zmem",
+    "zmem-zlib",
+    "zmem-1block",
+)
+
+# Sizes of the images added by --synthetic, and zlib's maximum dictionary.
+
+SYNTHETIC_SIZES = (256 * 1024, 2 * 1024 * 1024)
+ZDICT_SIZE = 32 * 1024
+
+# Each decode is timed this many times, and the fastest is reported.
+
+REPEAT = 3
+
+
+def benchmark_image(memdata, variants=VARIANTS, zdict=None, repeat=REPEAT,
+                    node=None):
+    """Compress and decompress a memory image with each of the variants.
+
+    This returns a list of dicts giving the name, compressed size and decode
+    time in seconds of each variant, plus the asmjs decode time for zmem
+    variants if `node` names a node executable.  Variants that can't be run
+    here, such as zlib-zdict without a dictionary, are left out.
+    """
+    memdata = bytes(memdata)
+    segments = find_segments(memdata)
+    results = []
+    for name in variants:
+        if name == "raw":
+            compressed = memdata
+            decompress = bytearray
+        elif name == "gzip-9":
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            compressed = compressor.compress(memdata) + compressor.flush()
+            decompress = lambda data: zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif name == "zlib-zdict":
+            # Preset dictionaries aren't available in python2's zlib module.
+            if zdict is None or sys.version_info[0] < 3:
+                continue
+            compressor = zlib.compressobj(9, zdict=zdict)
+            compressed = compressor.compress(memdata) + compressor.flush()
+            decompress = lambda data: zlib.decompressobj(zdict=zdict).decompress(data)
+        elif name.startswith("zmem"):
+            matcher = "zlib" if name == "zmem-zlib" else "native"
+            kwds = {"block_size": 0} if name == "zmem-1block" else {}
+            compressed = bytes(encode_zmem(memdata, segments, matcher, **kwds))
+            decompress = decode_zmem
+        else:
+            raise ValueError("unknown variant: %s" % (name,))
+        elapsed = None
+        for _ in range(repeat):
+            start = time.time()
+            output = decompress(compressed)
+            duration = time.time() - start
+            if elapsed is None or duration < elapsed:
+                elapsed = duration
+        # The zmem format doesn't bother storing trailing zeros.
+        output = bytes(output)
+        if output + b"\x00" * (len(memdata) - len(output)) != memdata:
+            raise ValueError("%s did not round-trip the memory image" % (name,))
+        result = {"name": name, "size": len(compressed), "time": elapsed}
+        if node and name.startswith("zmem"):
+            result["asmjs_time"] = time_asmjs_decode(node, compressed,
+                                                     memdata, repeat)
+        results.append(result)
+    return results
+
+
+def time_asmjs_decode(node, zmemdata, memdata, repeat=REPEAT):
+    """Time the shipped asmjs decompressor on the given zmem data.
+
+    This lays out the heap just as the loader does, with the compressed data
+    following the decompressed image, and runs the decompressor under node.
+    It returns the fastest time in seconds, and checks the decoded image.
+    """
+    code = NODE_BENCHMARK_CODE.replace(
+        "{UNZIP_CODE}", unzip_code("HEAPU8", "HEAPU16", "HEAP32"))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filenames = []
+        for name, data in (("bench.js", code.encode("ascii")),
+                           ("data.zmem", zmemdata), ("image.mem", memdata)):
+            filenames.append(os.path.join(tmpdir, name))
+            with open(filenames[-1], "wb") as f:
+                f.write(data)
+        output = subprocess.check_output([node] + filenames + [str(repeat)])
+    finally:
+        shutil.rmtree(tmpdir)
+    result = json.loads(output.decode("ascii").strip().splitlines()[-1])
+    if not result["ok"]:
+        raise ValueError("asmjs decompressor did not reproduce the image")
+    return result["ms"] / 1000.0
+
+
+NODE_BENCHMARK_CODE = """
+var fs = require('fs');
+var zmem = fs.readFileSync(process.argv[2]);
+var image = fs.readFileSync(process.argv[3]);
+var repeat = parseInt(process.argv[4], 10);
+var base = 8;
+var zstart = base + ((image.length + 3) & ~3);
+var zend = zstart + zmem.length;
+var size = 16 * 1024 * 1024;
+while (size < zend + 8 * 1024 * 1024) size *= 2;
+var buffer = new ArrayBuffer(size);
+var asm = (function(global, env, buffer) {
+  'use asm';
+  var HEAPU8 = new global.Uint8Array(buffer);
+  var HEAPU16 = new global.Uint16Array(buffer);
+  var HEAP32 = new global.Int32Array(buffer);
+{UNZIP_CODE}
+  return {zmemblock: zmemblock};
+})(global, {}, buffer);
+var heap = new Uint8Array(buffer);
+heap.set(zmem, zstart);
+var count = zmem.readUInt32LE(0);
+var best = null;
+for (var r = 0; r < repeat; r++) {
+  var t = process.hrtime();
+  for (var i = 0; i < count; i++) {
+    asm.zmemblock(base + zmem.readUInt32LE(4 + 12 * i),
+                  zstart + zmem.readUInt32LE(8 + 12 * i), zend);
+  }
+  t = process.hrtime(t);
+  var ms = t[0] * 1e3 + t[1] / 1e6;
+  if (best === null || ms < best) best = ms;
+}
+var ok = true;
+for (var i = 0; i < image.length; i++) {
+  if (heap[base + i] !== image[i]) { ok = false; break; }
+}
+console.log(JSON.stringify({ok: ok, ms: best}));
+"""
+
+
+def synthetic_memory_image(size, seed=0):
+    """Generate a fake memory image with roughly realistic content.
+
+    The image is a random mix of runs of zeros, null-terminated identifier
+    strings, little-endian words that look like small integers or pointers,
+    and incompressible noise.
+    """
+    rng = random.Random(seed)
+    words = [b"pypy_g_", b"function", b"object", b"__init__", b"TypeError",
+             b"list", b"dict", b"str", b"rpython", b"W_Root", b"space"]
+    memdata = bytearray(size)
+    pos = 0
+    while pos < size:
+        kind = rng.random()
+        length = min(rng.randint(16, 4096), size - pos)
+        if kind < 0.25:
+            pass
+        elif kind < 0.55:
+            chunk = bytearray()
+            while len(chunk) < length:
+                chunk.extend(rng.choice(words) + b"\x00")
+            memdata[pos:pos + length] = chunk[:length]
+        elif kind < 0.85:
+            for i in range(pos, pos + length - 3, 4):
+                value = rng.choice((0, 1, 4, 8, rng.randint(0, 5000),
+                                    rng.randint(0, 2**20)))
+                memdata[i:i + 4] = bytearray((value & 0xFF, (value >> 8) & 0xFF,
+                                              (value >> 16) & 0xFF, value >> 24))
+        else:
+            for i in range(pos, pos + length):
+                memdata[i] = rng.randint(0, 255)
+        pos += length
+    return memdata
+
+
+def read_memory_image(filename, sparse=False):
+    """Read a memory image from a dense, sparse or compressed memory file."""
+    with open(filename, "rb") as f:
+        data = f.read()
+    if filename.endswith(".zmem"):
+        return decode_zmem(data)
+    if sparse:
+        return decode_segment_table(data)[0]
+    return bytearray(data)
+
+
+def print_results(label, memdata, results, output=sys.stdout):
+    """Print a table of benchmark results for one image."""
+    asmjs = any("asmjs_time" in result for result in results)
+    output.write("%s: %d bytes\n" % (label, len(memdata)))
+    output.write("variant            size   ratio  decode MB/s")
+    output.write("  asmjs MB/s\n" if asmjs else "\n")
+    mbytes = len(memdata) / (1024.0 * 1024.0)
+    for result in results:
+        output.write("%-12s  %10d  %5.1f%%  %11.1f" % (
+            result["name"], result["size"],
+            100.0 * result["size"] / max(len(memdata), 1),
+            mbytes / max(result["time"], 1e-6),
+        ))
+        if "asmjs_time" in result:
+            output.write("  %10.1f" % (mbytes / max(result["asmjs_time"], 1e-6),))
+        output.write("\n")
+    output.write("\n")
+
+
+def main(args=None):
+    usage = "usage: %prog [options] [memfile...]"
+    descr = "Compare compression schemes for the memory initializer"
+    parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("-s", "--sparse", action="store_true",
+                      help=".mem files are in sparse segment-table format")
+    parser.add_option("-S", "--synthetic", action="store_true",
+                      help="also benchmark some generated memory images")
+    parser.add_option("-z", "--zdict", metavar="FILE",
+                      help="memory file whose tail is used as zlib dictionary")
+    parser.add_option("-V", "--variants", default=",".join(VARIANTS),
+                      metavar="LIST",
+                      help="comma-separated list of variants to compare")
+    parser.add_option("-n", "--repeat", type=int, default=REPEAT,
+                      metavar="N",
+                      help="time the fastest of N decodes")
+    parser.add_option("--node", metavar="NODE", nargs=1,
+                      help="also time the asmjs decompressor using NODE")
+
+    opts, args = parser.parse_args(args)
+    if not args and not opts.synthetic:
+        parser.error("expected memory files, or --synthetic")
+    variants = [name.strip() for name in opts.variants.split(",")]
+    for name in variants:
+        if name not in VARIANTS:
+            parser.error("unknown variant: %s" % (name,))
+
+    zdict = None
+    if opts.zdict:
+        zdict = bytes(read_memory_image(opts.zdict, opts.sparse)[-ZDICT_SIZE:])
+
+    images = []
+    if opts.synthetic:
+        for i, size in enumerate(SYNTHETIC_SIZES):
+            images.append(("synthetic-%d" % (size,),
+                           synthetic_memory_image(size, i),
+                           synthetic_memory_image(ZDICT_SIZE, -1 - i)))
+    for filename in args:
+        images.append((filename, read_memory_image(filename, opts.sparse),
+                       zdict))
+
+    for label, memdata, image_zdict in images:
+        results = benchmark_image(memdata, variants, image_zdict, opts.repeat,
+                                  opts.node)
+        print_results(label, memdata, results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
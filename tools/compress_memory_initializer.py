@@ -17,27 +17,47 @@
 #
 #  Like deflate, literals and match lengths are combined into a single alphabet
 #  and compressed using a huffman code, while distances are compressed using
-#  a separate huffman code.  Unlike deflate, there are no block boundaries,
-#  no extra-bits for encoding distances, and we use a single huffman code for
-#  the entire string rather than constructing custom codes for each block.
+#  a separate huffman code.  Distances are grouped into buckets with extra bits
+#  as in deflate, extended to cover a much larger window, and the most popular
+#  distances may also be given codes of their own.  Match lengths have no extra
+#  bits.  The stream is divided into regions that each have their own pair of
+#  huffman codes, since e.g. code, string data and mostly-zero areas of the
+#  memory image have rather different statistics.
+#
+#  The literal/length alphabet also has a "skip" symbol, used to jump over
+#  runs of zeros between the non-zero segments of the memory image.  Fresh
+#  heap memory is already zeroed so the decompressor doesn't need to touch
+#  those bytes at all.  The memory file may be either a plain dense image or
+#  a sparse segment table as written by `extract_memory_initializer --sparse`.
 #
 #  The format of the compressed data is:
 #
-#    [huffman-coded data][literal huffman tree][distance huffman tree]
+#    [block count][output offset, block offset, block length]*[block]*
 #
-#  Where the tree data is in a format designed for easy direct lookup at
-#  runtime.  There's no way to determine the offset of the tree data in
-#  the memory file, this information is encoded directly in the decompression
-#  code inserted into the host javascript file.
+#  Where the counts, offsets and lengths are little-endian uint32 values,
+#  and each block covers about a megabyte of the memory image.  Blocks can
+#  be decompressed independently of each other, so the loader decompresses
+#  each one as soon as it has been downloaded rather than waiting for the
+#  entire file.  Each block contains a region table followed by the huffman
+#  codes for each of its regions.  The huffman codes are canonical, so they
+#  can be described compactly by the number of codes of each length and the
+#  symbols in code order.  The decompressor expands them into lookup tables
+#  that resolve most symbols with a single memory access.
 #
 #  Future iterations might use a different scheme.  This can be done without
 #  concern for backwards-compatibility - since we store the decompression code
 #  inline in the host javascript, we can change it at will.
 #
-#  To generate the compressed data, we actually run it through standard
-#  zlib compression, decode the zlib stream into an equivalent raw sequence
-#  of LZ77 operations, then re-compress it in the custom format.  This avoids
-#  having to take a dependency on any external compression software.
+#  To generate the compressed data, we run the data through standard zlib
+#  compression and decode the zlib stream into an equivalent raw sequence of
+#  LZ77 operations.  Alternatively, we can find LZ77 matches using our own
+#  hash-chain match finder, then choose between them with a cost-based
+#  optimal parse that is scored against the actual huffman code lengths of
+#  the output.  This allows a much larger window than deflate's 32K and
+#  matches longer than 258 bytes, but so far it has only saved a fraction of
+#  a percent for many times the compression time, so it's not the default.
+#  Either way we avoid having to take a dependency on any external
+#  compression software.
 #
 
 import os
@@ -45,8 +65,15 @@ import re
 import sys
 import zlib
 import heapq
+import struct
+import optparse
+from array import array
 from collections import defaultdict
 
+from extract_memory_initializer import find_segments, decode_segment_table, \
+                                       update_manifest
+from fold_functions import split_asm, join_asm
+
 
 # ZLIB meta-huffman-tree alphabet symbols, in datastream order.
 
@@ -54,7 +81,75 @@ CODELEN_ALPHABET = [16, 17, 18, 0, 8, 7, 9, 6, 10, 5,
                     11, 4, 12, 3, 13, 2, 14, 1, 15]
 
 
-def compress_memory_file(source_filename):
+# Special symbols in our literal/length alphabet.  Match lengths are
+# encoded as symbols starting at LENGTH_BASE_SYMBOL, for a length of 3.
+
+END_SYMBOL = 256
+SKIP_SYMBOL = 257
+LENGTH_BASE_SYMBOL = 258
+
+# Distances are encoded as a bucket plus some extra bits, with enough
+# buckets to cover a window of WINDOW_BITS bits.  Bucket symbols in the
+# distance code start at DISTANCE_BUCKET_SYMBOL, leaving the symbols below
+# it free to encode popular distances exactly.  Match lengths are limited
+# by the need to fit their symbol into 15 bits.
+
+WINDOW_BITS = 20
+MAX_DISTANCE = 2**WINDOW_BITS - 1
+NUM_DISTANCE_BUCKETS = 2 * WINDOW_BITS
+DISTANCE_BUCKET_SYMBOL = 0x8000 - 64
+MIN_MATCH_LENGTH = 4
+MAX_MATCH_LENGTH = 0x7FFF - LENGTH_BASE_SYMBOL + 3
+
+# Numbers of exact distance codes to try including in each distance code,
+# and the approximate amount of output covered by each candidate region
+# when deciding where to switch to a new set of huffman codes.
+
+EXACT_DISTANCE_COUNTS = (0, 8, 32, 128, 512, 2048)
+REGION_SIZE = 64 * 1024
+
+# The approximate amount of the memory image in each independently
+# decodable block, and the size of the chunks in which the loader reads
+# the compressed file when running under node.
+
+BLOCK_SIZE = 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+# Huffman codes are limited to MAX_CODE_LENGTH bits, so the decompressor
+# can always find enough bits for a code in its 32-bit buffer.  Symbols are
+# decoded using tables indexed by up to this many bits at a time, with
+# subtables for any longer codes.
+
+MAX_CODE_LENGTH = 15
+L_ROOT_BITS = 10
+D_ROOT_BITS = 8
+
+# How to find LZ77 matches by default: "zlib" or "native".
+
+DEFAULT_MATCHER = "zlib"
+
+# Tuning parameters for the match finder and optimal parser.
+
+HASH_BITS = 18
+MAX_CHAIN = 48
+NICE_MATCH_LENGTH = 258
+OPTIMAL_PASSES = 2
+
+# The loader code only applies the memory file segment-by-segment if it's
+# in the sparse format written by `extract_memory_initializer --sparse`.
+
+SPARSE_APPLY_RE = re.compile(r"applyMemorySegments\(data,\s*Runtime.GLOBAL_BASE\)")
+
+# The end of the object of exports that closes the asm module, just before
+# the EMSCRIPTEN_END_ASM marker.
+
+ZMEM_EXPORTS_RE = re.compile(r"};?\s*}\)\s*\Z")
+
+
+def compress_memory_file(source_filename, matcher=DEFAULT_MATCHER,
+                         max_chain=MAX_CHAIN, passes=OPTIMAL_PASSES,
+                         region_size=REGION_SIZE, block_size=BLOCK_SIZE,
+                         report=False):
     memory_filename = source_filename + ".mem"
     output_filename = source_filename + ".new"
     zmem_filename = source_filename + ".zmem"
@@ -64,108 +159,37 @@ def compress_memory_file(source_filename):
     with open(source_filename) as f:
         jsdata = f.read()
 
-    with open(memory_filename) as f:
+    with open(memory_filename, "rb") as f:
         memdata = f.read()
 
+    # If the memory file is in sparse format, expand it back out
+    # into a dense image so we can compress it.  Either way, zeros
+    # between the non-zero segments are skipped over at runtime.
+
+    if SPARSE_APPLY_RE.search(jsdata):
+        memdata, segments = decode_segment_table(memdata)
+        memdata = bytes(memdata)
+    else:
+        segments = find_segments(memdata)
+
     # Generate the compressed "zmem" file.
 
-    lzops = decode_zlib_stream(Bitstream(zlib.compress(memdata, 9)))
-    #lzops = merge_lz_operations(lzops)
-    zmemdata, l_tree, d_tree = zencode(lzops)
+    zmemdata = encode_zmem(memdata, segments, matcher, max_chain, passes,
+                           region_size, block_size, report)
 
-    with open(zmem_filename, "w") as zmem_file:
+    with open(zmem_filename, "wb") as zmem_file:
         zmem_file.write(zmemdata)
-        l_tree_root = zmem_file.tell()
-        if l_tree_root % 2:
-            zmem_file.write("\x00")
-            l_tree_root += 1
-        zmem_file.write(l_tree)
-        d_tree_root = zmem_file.tell()
-        if d_tree_root % 2:
-            zmem_file.write("\x00")
-            d_tree_root += 1
-        zmem_file.write(d_tree)
-        zmemsize = zmem_file.tell()
 
     # Generate the modified javascript code.
 
     try:
         with open(output_filename, "w") as output_file:
- 
-            assert "zmeminit" not in jsdata
-
-            # Tell it to load the compressed memory file, not the raw one.
-
-            jsdata = jsdata.replace(os.path.basename(memory_filename),
-                                    os.path.basename(zmem_filename))
-
-            # Find the (possibly minified) name of the Uint8 heap array,
-            # so we can refer to it in the decompressor source code.
-
-            r = re.compile(r"var ([a-zA-Z0-9]+)\s*=\s*new\s+global.Uint8Array")
-            match = r.search(jsdata)
-            if match is None:
-                raise ValueError("heap view could not be found")
-            HEAPU8 = match.group(1)
-
-            r = re.compile(r"var ([a-zA-Z0-9]+)\s*=\s*new\s+global.Uint16Array")
-            match = r.search(jsdata)
-            if match is None:
-                raise ValueError("heap view could not be found")
-            HEAPU16 = match.group(1)
-
-            # Add an function to the asmjs module that will decompress the
-            # memory data in-place.  It's a hand-written asmjs decompressor.
-
-            r = re.compile(r"}\s*// EMSCRIPTEN_END_FUNCS", re.MULTILINE)
-            match = r.search(jsdata)
-            if match is None:
-                raise ValueError("EMSCRIPTEN_END_FUNCS not found")
-
-            output_file.write(jsdata[:match.start()])
-            output_file.write("}")
-            output_file.write(UNZIP_CODE\
-               .replace("{HEAPU8}", HEAPU8)
-               .replace("{HEAPU16}", HEAPU16)
-               .replace("{L_TREE_ROOT}", str(l_tree_root))
-               .replace("{D_TREE_ROOT}", str(d_tree_root))
-            )
-            output_file.write(match.group(0)[1:])
-            jsdata = jsdata[match.end():]
-
-            # Export the function for use by shell code.
-
-            r = re.compile(r"};?\s*}\)\s*// EMSCRIPTEN_END_ASM", re.MULTILINE)
-            match = r.search(jsdata)
-            if match is None:
-                raise ValueError("EMSCRIPTEN_END_ASM not found")
-
-            output_file.write(jsdata[:match.start()])
-            output_file.write(",zmeminit:zmeminit")
-            output_file.write(match.group(0))
-            jsdata = jsdata[match.end():]
-
-            # Find any code that loads the heap data, and have it write at
-            # appropriate offset and call the decompressor function.
-            # We arrange for the compressed data to sit at the end of
-            # the final memory region, poking out just slightly past the
-            # end.  This allows it to be decompressed in-place without
-            # the possibility of overwriting un-processed data.
-
-            zset = "HEAPU8.set(data, Runtime.GLOBAL_BASE+{zstart});"
-            zset += "asm[\"zmeminit\"](Runtime.GLOBAL_BASE,"
-            zset += "Runtime.GLOBAL_BASE+{zstart},Runtime.GLOBAL_BASE+{zend})"
-            zstart = len(memdata)
-            if zstart % 2 == 1:
-                zstart += 1
-            assert zmemsize % 2 == 0
-            jsdata = re.sub(r"HEAPU8.set\(data,\s*Runtime.GLOBAL_BASE\)", zset.format(
-              zstart=zstart,
-              zend=zstart + zmemsize,
-            ), jsdata)
-            output_file.write(jsdata)
-
-
+            assert "zmemblock" not in jsdata
+            parts = add_zmem_decompressor(split_asm(jsdata),
+                                          os.path.basename(memory_filename),
+                                          os.path.basename(zmem_filename),
+                                          len(memdata), len(zmemdata))
+            output_file.write(join_asm(*parts))
     except BaseException:
         os.unlink(output_filename)
         os.unlink(zmem_filename)
@@ -173,97 +197,508 @@ def compress_memory_file(source_filename):
     else:
         os.rename(output_filename, source_filename)
         os.unlink(memory_filename)
+        update_manifest(os.path.dirname(source_filename),
+                        memoryInitializer=os.path.basename(zmem_filename))
+
+
+def add_zmem_decompressor(parts, memory_basename, zmem_basename, memsize,
+                          zmemsize):
+    """Have the code decompress a zmem file in place of the memory file.
+
+    This takes and returns the parts of the code as given by split_asm,
+    along with the names of the memory file and its compressed version, the
+    size of the dense memory image and the size of the compressed data.
+    """
+    pre_code, functions, asm_tail, post_code = parts
+
+    # Tell it to load the compressed memory file, not the raw one.
+
+    pre_code = pre_code.replace(memory_basename, zmem_basename)
+    post_code = post_code.replace(memory_basename, zmem_basename)
+
+    # Find the (possibly minified) name of the Uint8 heap array,
+    # so we can refer to it in the decompressor source code.
+
+    heap_views = []
+    for view in ("Uint8Array", "Uint16Array", "Int32Array"):
+        r = re.compile(r"var ([a-zA-Z0-9]+)\s*=\s*new\s+global.%s" % (view,))
+        match = r.search(pre_code)
+        if match is None:
+            raise ValueError("heap view could not be found")
+        heap_views.append(match.group(1))
+
+    # Add an function to the asmjs module that will decompress the
+    # memory data in-place.  It's a hand-written asmjs decompressor.
+    # It goes after the last function, ahead of any whitespace before
+    # the EMSCRIPTEN_END_FUNCS marker.
+
+    last = functions[-1]
+    body = last.rstrip()
+    if len(functions) < 2 or not body.endswith("}"):
+        raise ValueError("EMSCRIPTEN_END_FUNCS not found")
+    code = body + unzip_code(*heap_views) + last[len(body):]
+    functions = functions[:-1] + code.split("function ")
+
+    # Export the functions for use by shell code.
+
+    match = ZMEM_EXPORTS_RE.search(asm_tail)
+    if match is None:
+        raise ValueError("EMSCRIPTEN_END_ASM not found")
+    asm_tail = "".join((
+        asm_tail[:match.start()],
+        ",zmemblock:zmemblock,zmemzero:zmemzero",
+        asm_tail[match.start():],
+    ))
+
+    # Add code to feed the compressed data to the decompressor as
+    # it arrives.  We arrange for the compressed data to sit at the
+    # end of the final memory region, poking out past the end.  This
+    # allows it to be decompressed in-place without the possibility
+    # of overwriting un-processed data.
+
+    r = re.compile(r"memoryInitializer\s*=\s*Module\['memoryInitializerPrefixURL'\]")
+    match = r.search(post_code)
+    if match is None:
+        raise ValueError("memory initializer loader not found")
+
+    zstart = memsize
+    zstart += -zstart % 4
+    assert zmemsize % 4 == 0
+    loader = ZMEM_LOADER_CODE\
+        .replace("{ZSTART}", str(zstart))\
+        .replace("{ZEND}", str(zstart + zmemsize))\
+        .replace("{CHUNK_SIZE}", str(READ_CHUNK_SIZE))\
+        .lstrip()
+
+    # Have the loading code read the data with the above functions,
+    # and find any code that writes it into the heap, and have it
+    # hand off to the decompressor instead.
+
+    code = post_code[match.start():]
+    code = re.sub(r"Module\['readBinary'\]\(memoryInitializer\)",
+                  "zmemRead(memoryInitializer)", code)
+    code = re.sub(r"Module\['readBinary'\]\(url\)",
+                  "zmemRead(url, onchunk)", code)
+    code = re.sub(r"Browser.asyncLoad\(url,\s*onload,\s*onerror\)",
+                  "zmemFetch(url, onload, onerror, onchunk)", code)
+    code = re.sub(r"(HEAPU8.set|applyMemorySegments)\(data,\s*Runtime.GLOBAL_BASE\)", "zmemApply(data)", code)
+    post_code = "".join((
+        post_code[:match.start()],
+        loader,
+        "\n        ",
+        code,
+    ))
+
+    return pre_code, functions, asm_tail, post_code
+
+
+def encode_zmem(memdata, segments, matcher=DEFAULT_MATCHER,
+                max_chain=MAX_CHAIN, passes=OPTIMAL_PASSES,
+                region_size=REGION_SIZE, block_size=BLOCK_SIZE, report=False):
+    """Compress a dense memory image into the "zmem" format.
+
+    The result is a sequence of independent blocks preceded by an index
+    giving their location in the file and in the decompressed output.
+    Only the given (offset, length) segments of the image are encoded,
+    and the zeros between them are skipped over.
+    """
+    blocks = split_blocks(segments, block_size)
+    zmemdata = bytearray(struct.pack("<I", len(blocks)))
+    zmemdata.extend(b"\x00" * (12 * len(blocks)))
+    for i, (start, end) in enumerate(blocks):
+        if report:
+            sys.stdout.write("block %d: bytes %d to %d\n" % (i, start, end))
+        block = compress_block(memdata[start:end],
+                               clip_segments(segments, start, end),
+                               matcher, max_chain, passes, region_size, report)
+        struct.pack_into("<III", zmemdata, 4 + 12 * i,
+                         start, len(zmemdata), len(block))
+        zmemdata.extend(block)
+    return zmemdata
+
+
+def split_blocks(segments, block_size=BLOCK_SIZE):
+    """Divide the non-zero segments of a memory image into blocks.
+
+    This returns a list of (start, end) pairs giving blocks that each cover
+    about `block_size` bytes of the image.  Blocks end at the end of a
+    segment where possible, while segments longer than `block_size` are
+    split across several blocks.  If `block_size` is zero then everything
+    goes into a single block.
+    """
+    blocks = []
+    start = end = None
+    for offset, length in segments:
+        if start is not None and block_size and offset - start >= block_size:
+            blocks.append((start, end))
+            start = None
+        if start is None:
+            start = offset
+        end = offset + length
+        while block_size and end - start > block_size:
+            blocks.append((start, start + block_size))
+            start += block_size
+    if start is not None:
+        blocks.append((start, end))
+    return blocks
+
+
+def clip_segments(segments, start, end):
+    """Get the parts of the given segments between start and end.
+
+    The resulting segments have offsets relative to start.
+    """
+    clipped = []
+    for offset, length in segments:
+        seg_start = max(offset, start)
+        seg_end = min(offset + length, end)
+        if seg_start < seg_end:
+            clipped.append((seg_start - start, seg_end - seg_start))
+    return clipped
+
+
+def compress_block(memdata, segments, matcher=DEFAULT_MATCHER,
+                   max_chain=MAX_CHAIN, passes=OPTIMAL_PASSES,
+                   region_size=REGION_SIZE, report=False):
+    """Compress a single block of the memory image.
 
+    The block can be decompressed independently of any other, since its
+    matches only refer back to earlier data in the same block.  The format
+    of each block is:
 
-def zencode(lzops):
+      [region table offset][huffman-coded data][region table][huffman codes]*
+
+    Where the region table is a count followed by the offsets of the literal
+    and distance codes for each region.  The region table offset and all of
+    these are little-endian uint32 values relative to the start of the block.
+    """
+    if matcher == "zlib":
+        lzops = decode_zlib_stream(Bitstream(zlib.compress(memdata, 9)))
+    else:
+        lzops = find_lz_operations(memdata, max_chain, passes)
+    #lzops = merge_lz_operations(lzops)
+    lzops = skip_lz_gaps(lzops, memdata, segments)
+    zdata, regions = zencode(lzops, region_size)
+    if report:
+        print_region_report(regions)
+
+    # Add the region table and the huffman codes for each region.  The
+    # table is aligned so that the decompressor can read 32-bit integers.
+
+    block = bytearray(4)
+    block.extend(zdata)
+    block.extend(b"\x00" * (-len(block) % 4))
+    region_table = len(block)
+    struct.pack_into("<I", block, 0, region_table)
+    code_offset = region_table + 4 + 8 * len(regions)
+    codes = bytearray()
+    block.extend(struct.pack("<I", len(regions)))
+    for region in regions:
+        for lengths in (region.tables.l_lengths, region.tables.d_lengths):
+            block.extend(struct.pack("<I", code_offset + len(codes)))
+            codes.extend(lengths)
+    block.extend(codes)
+    block.extend(b"\x00" * (-len(block) % 4))
+    return block
+
+
+def zencode(lzops, region_size=REGION_SIZE):
     """Translate the given LZ operations into our deflate-like encoding.
 
     This function encodes the literals and (length,distance) pairs of the
     LZ operation stream into a sequence of bytes, using a huffman-coding
-    scheme similar to deflate.  It returns a three tuple (data, l_tree, d_tree)
-    giving the encoded bytes, and encoded tree structures for decoding the
-    literals/lengths and distances respectively.
+    scheme similar to deflate.  The stream is divided into regions that
+    each get their own huffman codes, and every region is terminated by
+    END_SYMBOL.  It returns a two-tuple (data, regions) giving the encoded
+    bytes and the list of ZRegion objects that were used to encode them.
     """
-    lzops = list(clamp_lz_operations(lzops, 2**15-1))
-    # Calculate frequencies for huffman coding trees.
-    l_freqs = defaultdict(lambda: 0.0)
-    d_freqs = defaultdict(lambda: 0.0)
-    for op in lzops:
-        if isinstance(op, LZLiteral):
-            for c in op.data:
-                l_freqs[ord(c)] += 1
-        else:
-            l_freqs[op.length - 3 + 257] += 1
-            d_freqs[op.distance] += 1
-    l_freqs[256] += 1
-    # XXX TODO: try using extra-bits encoding as used by deflate.
-    # Lit/len tree is generally small enough to include in full.
-    l_codes, l_tree = enhuffen(l_freqs)
-    # The distance tree has a lot of unique entries, so we only
-    # include the most popular and encode the rest directly.
-    # XXX TODO: dynamically decide how many to include.
-    d_top = set()
-    for f,d in sorted(((f,d) for (d,f) in d_freqs.iteritems()), reverse=True):
-        d_top.add(d)
-        if len(d_top) >= 1024:
-            break
-    d_top_freqs = defaultdict(lambda: 0.0)
-    for (d,f) in d_freqs.iteritems():
-        if d in d_top:
-            d_top_freqs[d] = f
+    lzops = list(clamp_lz_operations(lzops, MAX_MATCH_LENGTH + 1))
+    regions = split_regions(lzops, region_size)
+    # Build the final binary string, packing the bits for each
+    # code directly into bytes as we go.
+    output = BitWriter()
+    for region in regions:
+        l_codes = region.tables.l_codes
+        for op in lzops[region.start:region.end]:
+            if isinstance(op, LZLiteral):
+                for c in bytearray(op.data):
+                    output.write(*l_codes[c])
+            elif isinstance(op, LZSkip):
+                output.write(*l_codes[SKIP_SYMBOL])
+                output.write(op.length, 15)
+            else:
+                output.write(*l_codes[op.length - 3 + LENGTH_BASE_SYMBOL])
+                region.tables.write_distance(output, op.distance)
+        output.write(*l_codes[END_SYMBOL])
+    return output.getvalue(), regions
+
+
+def split_regions(lzops, region_size=REGION_SIZE):
+    """Divide LZ operations into regions with their own huffman codes.
+
+    The operations are first cut into chunks producing about `region_size`
+    bytes of output each.  Working forward through the chunks, each one is
+    merged into the current region if that is no more expensive than giving
+    it its own codes, taking the size of the code descriptions into account.
+    This returns a list of ZRegion objects covering all the operations.
+    """
+    chunks = []
+    start = size = 0
+    for i, op in enumerate(lzops):
+        size += op.length
+        if size >= region_size:
+            chunks.append((start, i + 1))
+            start = i + 1
+            size = 0
+    if start < len(lzops) or not chunks:
+        chunks.append((start, len(lzops)))
+    regions = []
+    region = None
+    for (start, end) in chunks:
+        counts = count_lz_symbols(lzops[start:end])
+        chunk = ZRegion(start, end, counts)
+        if region is not None:
+            merged = ZRegion(region.start, end,
+                             merge_lz_symbol_counts(region.counts, counts))
+            if merged.tables.bits <= region.tables.bits + chunk.tables.bits:
+                region = merged
+                continue
+            regions.append(region)
+        region = chunk
+    regions.append(region)
+    return regions
+
+
+class ZRegion(object):
+    """A run of LZ operations encoded using the same huffman codes.
+
+    The operations are lzops[start:end], and `counts` is the pair of
+    literal/length and distance frequencies from count_lz_symbols().
+    """
+
+    def __init__(self, start, end, counts):
+        self.start = start
+        self.end = end
+        self.counts = counts
+        self.tables = ZTables(*counts)
+
+
+class ZTables(object):
+    """Huffman codes for encoding LZ operations with the given frequencies.
+
+    Distances are coded much like in deflate, as one of a fixed set of
+    buckets followed by extra bits to select a distance within the bucket,
+    but with more buckets to cover our larger window.  The most popular
+    distances can also get codes of their own so that they don't need any
+    extra bits.  Several different numbers of these exact distances are
+    tried, and whichever gives the smallest output is kept.
+
+    In the distance code, an exact distance is stored directly as its
+    symbol while bucket N is stored as symbol DISTANCE_BUCKET_SYMBOL + N.
+    The estimated size in bits of the encoded data plus its codes is
+    available as the `bits` attribute.
+    """
+
+    def __init__(self, l_freqs, d_freqs):
+        l_freqs = dict(l_freqs)
+        l_freqs[END_SYMBOL] = l_freqs.get(END_SYMBOL, 0) + 1
+        self.l_codes, self.l_lengths = enhuffen(l_freqs)
+        l_bits = 15 * l_freqs.get(SKIP_SYMBOL, 0)
+        for symbol, f in l_freqs.items():
+            l_bits += f * self.l_codes[symbol][1]
+        # Only distances that fit below the bucket symbols can be exact,
+        # and it's only worth considering those that are used repeatedly.
+        popular = sorted(((f, d) for (d, f) in d_freqs.items()
+                          if d < DISTANCE_BUCKET_SYMBOL and f > 1),
+                         reverse=True)
+        best = None
+        for num_exact in EXACT_DISTANCE_COUNTS:
+            num_exact = min(num_exact, len(popular))
+            exact = frozenset(d for (_, d) in popular[:num_exact])
+            dsym_freqs = defaultdict(lambda: 0)
+            d_bits = 0
+            for d, f in d_freqs.items():
+                if d in exact:
+                    dsym_freqs[d] += f
+                else:
+                    bucket, nextra, _ = distance_bucket(d)
+                    dsym_freqs[DISTANCE_BUCKET_SYMBOL + bucket] += f
+                    d_bits += f * nextra
+            d_codes, d_lengths = enhuffen(dsym_freqs)
+            for symbol, f in dsym_freqs.items():
+                d_bits += f * d_codes[symbol][1]
+            d_bits += 8 * len(d_lengths)
+            if best is None or d_bits < best[0]:
+                best = (d_bits, exact, d_codes, d_lengths)
+            if num_exact == len(popular):
+                break
+        d_bits, self.exact, self.d_codes, self.d_lengths = best
+        # Each region also costs an entry in the region table.
+        self.bits = l_bits + 8 * len(self.l_lengths) + d_bits + 64
+
+    def write_distance(self, output, distance):
+        """Write the code for the given distance to a BitWriter."""
+        if distance in self.exact:
+            output.write(*self.d_codes[distance])
         else:
-            d_top_freqs[0] += f
-    d_top_codes, d_top_tree = enhuffen(d_top_freqs)
-    # Build the final binary string.  This is a giant string of
-    # "1" and "0" chars, which is pretty terrible but is easy to
-    # work with in python.
-    output = []
+            bucket, nextra, extra = distance_bucket(distance)
+            output.write(*self.d_codes[DISTANCE_BUCKET_SYMBOL + bucket])
+            if nextra:
+                output.write(extra, nextra)
+
+    def encoded_bits(self, l_freqs, d_freqs):
+        """Size in bits of encoding the given frequencies with these codes.
+
+        This doesn't include the size of the codes.  All the symbols must
+        have codes, e.g. because the frequencies were included when these
+        tables were constructed.
+        """
+        bits = 15 * l_freqs.get(SKIP_SYMBOL, 0) + self.l_codes[END_SYMBOL][1]
+        for symbol, f in l_freqs.items():
+            bits += f * self.l_codes[symbol][1]
+        for d, f in d_freqs.items():
+            if d in self.exact:
+                bits += f * self.d_codes[d][1]
+            else:
+                bucket, nextra, _ = distance_bucket(d)
+                bucket += DISTANCE_BUCKET_SYMBOL
+                bits += f * (self.d_codes[bucket][1] + nextra)
+        return bits
+
+
+def distance_bucket(distance):
+    """Find the bucket for encoding the given match distance.
+
+    This returns a three-tuple (bucket, nextra, extra) giving the bucket
+    number, the number of extra bits and the value of those extra bits.
+    As in deflate, the first four buckets hold a single distance each and
+    then each pair of buckets has one more extra bit than the last.
+    """
+    v = distance - 1
+    if v < 4:
+        return v, 0, 0
+    nextra = v.bit_length() - 2
+    bucket = 2 * nextra + 2 + ((v >> nextra) & 1)
+    return bucket, nextra, v & ((1 << nextra) - 1)
+
+
+def distance_bucket_range(bucket):
+    """Get the smallest distance and number of extra bits for a bucket."""
+    if bucket < 4:
+        return bucket + 1, 0
+    nextra = (bucket >> 1) - 1
+    return ((2 | (bucket & 1)) << nextra) + 1, nextra
+
+
+def count_lz_symbols(lzops):
+    """Count the symbols needed for encoding the given LZ operations.
+
+    This returns a two-tuple (l_freqs, d_freqs) of dicts, the first mapping
+    literal/length symbols to their frequency and the second mapping raw
+    match distances to their frequency.
+    """
+    l_freqs = defaultdict(lambda: 0)
+    d_freqs = defaultdict(lambda: 0)
     for op in lzops:
         if isinstance(op, LZLiteral):
-            for c in op.data:
-                output.append(l_codes[ord(c)])
+            for c in bytearray(op.data):
+                l_freqs[c] += 1
+        elif isinstance(op, LZSkip):
+            l_freqs[SKIP_SYMBOL] += 1
         else:
-            output.append(l_codes[op.length - 3 + 257])
-            if op.distance in d_top_codes:
-                output.append(d_top_codes[op.distance])
-            else:
-                output.append(d_top_codes[0])
-                # Encode in 15 bits; top bit is always zero
-                output.append(bin(op.distance)[2:].rjust(15, "0"))
-    output.append(l_codes[256])
-    output = "".join(output)
-    # Translate each eight bits into an actul byte.
-    final = []
-    for i in xrange(0, len(output), 8):
-        byte = output[i:i+8].ljust(8, "0")
-        final.append(chr(int(byte, 2)))
-    final = "".join(final)
-    return final, l_tree, d_top_tree
+            l_freqs[op.length - 3 + LENGTH_BASE_SYMBOL] += 1
+            d_freqs[op.distance] += 1
+    return dict(l_freqs), dict(d_freqs)
+
+
+def merge_lz_symbol_counts(counts1, counts2):
+    """Add together two sets of counts from count_lz_symbols()."""
+    merged = []
+    for (freqs1, freqs2) in zip(counts1, counts2):
+        freqs = dict(freqs1)
+        for symbol, f in freqs2.items():
+            freqs[symbol] = freqs.get(symbol, 0) + f
+        merged.append(freqs)
+    return tuple(merged)
+
+
+def print_region_report(regions, output=sys.stdout):
+    """Print how much each region gains by having its own huffman codes.
+
+    Each region is compared against encoding the same operations with a
+    single set of codes built for the whole stream, which is only
+    counted once in the total.  All sizes are in bytes.
+    """
+    total = regions[0].counts
+    for region in regions[1:]:
+        total = merge_lz_symbol_counts(total, region.counts)
+    single = ZTables(*total)
+    output.write("region       start         end      data  codes"
+                 "    single      gain\n")
+    own_bits = 0
+    for i, region in enumerate(regions):
+        tables = region.tables
+        data_bits = tables.encoded_bits(*region.counts)
+        shared_bits = single.encoded_bits(*region.counts)
+        own_bits += tables.bits
+        output.write("%6d  %10d  %10d  %8d  %5d  %8d  %8d\n" % (
+            i, region.start, region.end, data_bits // 8,
+            (tables.bits - data_bits) // 8, shared_bits // 8,
+            (shared_bits - tables.bits) // 8,
+        ))
+    output.write("total: %d bytes in %d regions, %d with a single region\n"
+                 % (own_bits // 8, len(regions), single.bits // 8))
 
 
 def enhuffen(frequencies):
     """Produce huffman encoding for the given symbol:frequency map.
 
-    This function constructs a huffman tree to encode the symbols.  It returns
-    a dict mapping symbols to their corresponding code as a string of "0" and
-    "1" characters, and a string encoding a tree lookup structure for decoding
-    with the tree at runtime.
-
-    All symbols are assumed to fit in 15 bytes, and the tree is encoded for
-    lookup as follows.  Each node of the tree occupies four bytes in the
-    lookup structure.  The first two bytes encoding the child for a "0" and
-    the second two bytes encode the child for a "1".  If the high bit is set
-    on those bytes then it's a leaf node, with the low 15 bits giving the
-    symbol.  If not then it's the offset of the next node in the tree, whose
-    data can be read at offset*2 bytes from the start of the string.
+    This function constructs a canonical huffman code for the symbols, with
+    no code longer than MAX_CODE_LENGTH bits.  It returns a dict mapping
+    symbols to their corresponding code as a (code, length) tuple of integers,
+    and a string describing the code for the decompressor.
+
+    Since the code is canonical, the decompressor only needs to know the
+    number of codes of each length and the symbols in order of their codes.
+    The description is 16 little-endian uint16 values giving the number of
+    codes of length 0 to 15, followed by a uint16 for each symbol in order.
+    The decompressor uses this to build lookup tables at runtime.
     """
-    total = sum(f for f in frequencies.itervalues())
+    codelens = huffman_code_lengths(frequencies)
+    codelens = limit_code_lengths(codelens, MAX_CODE_LENGTH)
+    # Assign consecutive codes to the symbols in order of code length, so
+    # that the codes sharing any given prefix form a contiguous range.
+    symbols = sorted(codelens, key=lambda c: (codelens[c], c))
+    codes = {}
+    counts = [0] * (MAX_CODE_LENGTH + 1)
+    code = 0
+    prevlen = 0
+    for symbol in symbols:
+        codelen = codelens[symbol]
+        code <<= codelen - prevlen
+        codes[symbol] = (code, codelen)
+        counts[codelen] += 1
+        code += 1
+        prevlen = codelen
+    description = counts + symbols
+    return codes, struct.pack("<%dH" % len(description), *description)
+
+
+def huffman_code_lengths(frequencies):
+    """Find the length of each symbol's code in a huffman code.
+
+    A lone symbol still gets a one-bit code for the decoder to read.
+    """
+    if len(frequencies) <= 1:
+        return dict((c, 1) for c in frequencies)
+
+    total = sum(f for f in frequencies.values()) or 1.0
     in_queue = []
     for c in frequencies:
-        in_queue.append((frequencies[c] / total, [c]))
+        in_queue.append((float(frequencies[c]) / total, [c]))
     in_queue.sort()
     queue = []
-    codes = defaultdict(lambda: "")
+    codelens = dict((c, 0) for c in frequencies)
 
     def popmin():
         if not queue:
@@ -274,56 +709,81 @@ def enhuffen(frequencies):
             return heapq.heappop(queue)
         return heapq.heappop(in_queue)
 
+    # Each merge adds a bit to the codes of all symbols in the merged subtrees.
     while len(in_queue) > 0 or len(queue) > 1:
         (p1, s1) = popmin()
         (p2, s2) = popmin()
         for c in s1:
-            codes[c] = "0" + codes[c]
+            codelens[c] += 1
         for c in s2:
-            codes[c] = "1" + codes[c]
+            codelens[c] += 1
         heapq.heappush(queue, (p1 + p2, s1 + s2))
 
-    def encode_symbol(n):
-        assert n < 0x8000, "symbol too big: " + str(n)
-        return chr(n & 0xFF) + chr(0x80 | (n >> 8))
+    return codelens
 
-    def encode_subtree(n):
-        assert n < 0x8000, "subtree too big: " + str(n)
-        return chr(n & 0xFF) + chr(n >> 8)
 
-    NULL = encode_subtree(0)
-    tree = [NULL, NULL]
+def limit_code_lengths(codelens, maxlen):
+    """Adjust huffman code lengths so that none is longer than maxlen.
 
-    branch0 = []
-    branch1 = []
-    for symbol, code in codes.iteritems():
-        if code[0] == "0":
-            branch0.append((code[1:], symbol))
-        else:
-            branch1.append((code[1:], symbol))
-    pending_subtrees = [(0, branch0), (1, branch1)]
-
-    while pending_subtrees:
-        (idx, subtree) = pending_subtrees.pop()
-        assert tree[idx] == NULL
-        if len(subtree) == 1:
-            assert subtree[0][0] == ""
-            tree[idx] = encode_symbol(subtree[0][1])
-        else:
-            branch0 = []
-            branch1 = []
-            for code_suffix, symbol in subtree:
-                if code_suffix[0] == "0":
-                    branch0.append((code_suffix[1:], symbol))
-                else:
-                    branch1.append((code_suffix[1:], symbol))
-            tree[idx] = encode_subtree(len(tree))
-            pending_subtrees.append((len(tree), branch0))
-            tree.append(NULL)
-            pending_subtrees.append((len(tree), branch1))
-            tree.append(NULL)
+    This uses the method from Annex K.3 of the JPEG specification, which
+    repeatedly moves a pair of symbols up from the longest code length and
+    splits a shorter code to make room for them.  Symbols keep their
+    relative order, so the more popular symbols still get shorter codes.
+    """
+    longest = max(codelens.values() or [0])
+    if longest <= maxlen:
+        return codelens
+    counts = [0] * (longest + 1)
+    for codelen in codelens.values():
+        counts[codelen] += 1
+    for i in range(longest, maxlen, -1):
+        while counts[i] > 0:
+            j = i - 2
+            while counts[j] == 0:
+                j -= 1
+            counts[i] -= 2
+            counts[i - 1] += 1
+            counts[j + 1] += 2
+            counts[j] -= 1
+    symbols = sorted(codelens, key=lambda c: (codelens[c], c))
+    codelens = {}
+    for codelen, count in enumerate(counts):
+        for symbol in symbols[:count]:
+            codelens[symbol] = codelen
+        symbols = symbols[count:]
+    return codelens
+
+
+class BitWriter(object):
+    """Write a stream of bits into a bytearray.
+
+    Bits are accumulated into an integer and flushed out a byte at a time,
+    filling each byte starting from its most significant bit.  This is the
+    order in which our asmjs decompressor consumes them.
+    """
 
-    return codes, "".join(tree)
+    def __init__(self):
+        self._output = bytearray()
+        self._acc = 0
+        self._nbits = 0
+
+    def write(self, code, nbits):
+        """Write the low `nbits` bits of `code`, most significant first."""
+        acc = (self._acc << nbits) | code
+        nbits += self._nbits
+        output = self._output
+        while nbits >= 8:
+            nbits -= 8
+            output.append((acc >> nbits) & 0xFF)
+        self._acc = acc & ((1 << nbits) - 1)
+        self._nbits = nbits
+
+    def getvalue(self):
+        """Get the output bytes, zero-padding any trailing partial byte."""
+        output = bytearray(self._output)
+        if self._nbits:
+            output.append((self._acc << (8 - self._nbits)) & 0xFF)
+        return output
 
 
 class LZLiteral(object):
@@ -342,28 +802,45 @@ class LZMatch(object):
         self.distance = distance
 
 
+class LZSkip(object):
+    """A run of zeros to skip over without writing to the output."""
+
+    def __init__(self, length):
+        self.length = length
+
+
 class Bitstream(object):
     """Read a string as a stream of bits.
 
     This is a simple iterator-like class to process a string as a stream
     of bits in the correct order for deflate decompression.  It visits
     the zeroth through seventh bit in each byte in order.
+
+    Bits are buffered in an integer so that callers can peek at several
+    bits at once and then consume only as many as they actually used,
+    which is what makes table-driven huffman decoding possible.  Reading
+    past the end of the data produces zero bits.
     """
 
     def __init__(self, data):
-        self._data = data
-        self._byte_offset = 0
-        self._bit_offset = 0
-        self._byte = ord(self._data[0])
-
-    def _next(self):
-        if self._bit_offset > 7:
-            self._bit_offset = 0
-            self._byte_offset += 1
-            self._byte = ord(self._data[self._byte_offset])
-        bit = (self._byte & (2**self._bit_offset)) >> self._bit_offset
-        self._bit_offset += 1
-        return bit
+        self._data = bytearray(data)
+        self._pos = 0
+        self._bitbuf = 0
+        self._nbits = 0
+
+    def peek(self, num):
+        """Look at the next `num` bits without consuming them."""
+        while self._nbits < num:
+            if self._pos < len(self._data):
+                self._bitbuf |= self._data[self._pos] << self._nbits
+            self._pos += 1
+            self._nbits += 8
+        return self._bitbuf & ((1 << num) - 1)
+
+    def consume(self, num):
+        """Discard `num` bits, which must previously have been peeked."""
+        self._bitbuf >>= num
+        self._nbits -= num
 
     def read(self, num=1):
         """Read one or more bits from the stream.
@@ -371,17 +848,25 @@ class Bitstream(object):
         Multi-bit reads are returns as reading the least significant bit
         first.
         """
-        out = 0
-        for i in xrange(num):
-            out |= self._next() << i
+        out = self.peek(num)
+        self._bitbuf >>= num
+        self._nbits -= num
         return out
 
     def byte_align(self):
         """Skip ahead to the next whole-byte boundary in the stream."""
-        if self._bit_offset > 0:
-            self._bit_offset = 0
-            self._byte_offset += 1
-            self._byte = ord(self._data[self._byte_offset])
+        self.consume(self._nbits % 8)
+
+    def read_bytes(self, num):
+        """Read `num` whole bytes from a byte-aligned position."""
+        assert self._nbits % 8 == 0
+        # Un-read any bytes that are sitting in the bit buffer.
+        self._pos -= self._nbits // 8
+        self._bitbuf = 0
+        self._nbits = 0
+        out = self._data[self._pos:self._pos + num]
+        self._pos += num
+        return bytes(out)
 
 
 class HuffmanDecoder(object):
@@ -390,11 +875,15 @@ class HuffmanDecoder(object):
     Deflate encodes an alphabet of symbols from 0 to N as a huffman code
     that is uniquely identified by a list of N code lengths, one for each
     symbol in the alphabet in order.  This class takes such a list of
-    code lengths and generates a decoder tree.
+    code lengths and generates a canonical-code lookup table.
+
+    The table is indexed by the next `maxlen` bits of input, in the order
+    they appear in the stream.  Each entry holds the decoded symbol and the
+    length of its code, packed as (symbol << 4) | length, so every symbol
+    can be decoded with a single peek and lookup.
     """
 
     def __init__(self, codelens):
-        self.root = [None, None]
         self.codes = {}
         # Find out how many codes we need of each length.
         codelen_counts = defaultdict(lambda: 0)
@@ -406,14 +895,14 @@ class HuffmanDecoder(object):
         codelen_counts[0] = 0
         # Sanity-check that we're not creating a code that would defy
         # the basic laws of information theory.
-        for codelen, count in codelen_counts.iteritems():
+        for codelen, count in codelen_counts.items():
             if count > 2**codelen:
                 msg = "cant have %d codes of length %d" % (count, codelen)
                 raise ValueError(msg)
         # Construct the lexicographically first code of each length.
         code = 0
         next_code = {}
-        for codelen in xrange(1, codelen_max + 1):
+        for codelen in range(1, codelen_max + 1):
             code = (code + codelen_counts[codelen - 1]) << 1
             next_code[codelen] = code
         # Assign a unique code to each symbol in the alphabet.
@@ -421,29 +910,222 @@ class HuffmanDecoder(object):
             if codelen > 0:
                 self.codes[symbol] = next_code[codelen]
                 next_code[codelen] += 1
-        # Build the decoder tree.
-        for symbol, code in self.codes.iteritems():
-            bits = bin(code)[2:].rjust(codelens[symbol], '0')
-            node = self.root
-            for bit in bits[:-1]:
-                bit = int(bit)
-                if node[bit] is None:
-                    node[bit] = [None, None]
-                node = node[bit]
-                if not isinstance(node, list):
-                    msg = "code conflict between %d and %d" % (symbol, node)
-                    raise ValueError(msg)
-            node[int(bits[-1])] = symbol
+        # Build the lookup table.  Codes are stored most-significant-bit
+        # first but read from the stream one bit at a time, so we index
+        # by the bit-reversed code and fill in every entry that shares it
+        # as a prefix.
+        self.maxlen = max(codelen_max, 1)
+        table = [None] * (1 << self.maxlen)
+        for symbol, code in self.codes.items():
+            codelen = codelens[symbol]
+            idx = int(bin(code)[2:].rjust(codelen, "0")[::-1], 2)
+            if table[idx] is not None:
+                msg = "code conflict between %d and %d" % (
+                    symbol, table[idx] >> 4)
+                raise ValueError(msg)
+            step = 1 << codelen
+            table[idx::step] = [(symbol << 4) | codelen] * len(table[idx::step])
+        self.table = table
 
     def decode(self, bits):
-        bit = bits.read()
-        node = self.root[bit]
-        while isinstance(node, list):
-            bit = bits.read()
-            node = node[bit]
-        return node
+        entry = self.table[bits.peek(self.maxlen)]
+        bits.consume(entry & 0xF)
+        return entry >> 4
+
+
+def find_lz_operations(data, max_chain=MAX_CHAIN, passes=OPTIMAL_PASSES):
+    """Find a good sequence of LZ operations for generating the given data.
+
+    This runs our own match finder over the data, makes an initial greedy
+    choice of matches, and then repeatedly re-parses the data to minimize
+    its encoded size given the huffman code lengths from the previous pass.
+    It returns a list of LZLiteral() and LZMatch() objects.
+    """
+    data = bytes(data)
+    matches = find_lz_matches(data, max_chain)
+    lzops = parse_lz_greedy(data, matches)
+    for _ in range(passes):
+        costs = LZCostModel(lzops)
+        lzops = parse_lz_optimal(data, matches, costs)
+    return lzops
+
+
+def find_lz_matches(data, max_chain=MAX_CHAIN, nice_length=NICE_MATCH_LENGTH):
+    """Find candidate LZ77 matches at each position in the data.
+
+    This uses hash chains keyed by the next MIN_MATCH_LENGTH bytes, walking
+    back through up to `max_chain` previous occurrences within the window.
+    For each position it records every candidate that is longer than all
+    the closer ones, so nearer (and hence cheaper) distances are kept for
+    shorter lengths.  Once a match of at least `nice_length` is found we
+    take it and skip ahead without looking for matches inside it.
+
+    The result is a three-tuple (starts, lengths, distances) of arrays,
+    where the candidates for position i are at indices starts[i] through
+    starts[i+1] - 1 of the lengths and distances arrays.
+    """
+    n = len(data)
+    starts = array("i", [0]) * (n + 1)
+    lengths = array("i")
+    distances = array("i")
+    head = array("i", [-1]) * (1 << HASH_BITS)
+    prev = array("i", [-1]) * n
+    buf = bytearray(data)
+    hash_mask = (1 << HASH_BITS) - 1
+    i = 0
+    while i <= n - MIN_MATCH_LENGTH:
+        starts[i] = len(lengths)
+        key = (buf[i] << 24) | (buf[i + 1] << 16) | (buf[i + 2] << 8) | buf[i + 3]
+        key = ((key * 2654435761) >> 13) & hash_mask
+        cand = head[key]
+        head[key] = i
+        prev[i] = cand
+        maxlen = min(MAX_MATCH_LENGTH, n - i)
+        best = MIN_MATCH_LENGTH - 1
+        chain = max_chain
+        while cand >= 0 and i - cand <= MAX_DISTANCE and chain > 0:
+            # Candidates that can't beat the best match so far are rejected
+            # with a single comparison.  This also weeds out hash collisions.
+            if data[cand:cand + best + 1] == data[i:i + best + 1]:
+                length = match_length(data, cand, i, best + 1, maxlen)
+                best = length
+                lengths.append(length)
+                distances.append(i - cand)
+                if length >= nice_length or length == maxlen:
+                    break
+            cand = prev[cand]
+            chain -= 1
+        if best >= nice_length:
+            starts[i + 1:i + best] = array("i", [len(lengths)]) * (best - 1)
+            i += best
+        else:
+            i += 1
+    starts[i:] = array("i", [len(lengths)]) * (n + 1 - i)
+    return starts, lengths, distances
+
+
+def match_length(data, a, b, length, maxlen):
+    """Count the matching bytes at offsets a and b, up to maxlen.
+
+    The first `length` bytes are already known to match.
+    """
+    for step in (256, 16):
+        while length + step <= maxlen and \
+              data[a + length:a + length + step] == \
+              data[b + length:b + length + step]:
+            length += step
+    while length < maxlen and data[a + length] == data[b + length]:
+        length += 1
+    return length
+
+
+class LZCostModel(object):
+    """Estimated cost in bits of each possible LZ operation.
+
+    The costs are taken from the code lengths that our huffman coding
+    would assign when encoding the given sequence of LZ operations.
+    Symbols that don't appear in that sequence are assumed to be expensive.
+    The distance costs are a flat array indexed by distance, including any
+    extra bits needed to encode it.
+    """
+
+    MISSING_SYMBOL_COST = 16
+
+    def __init__(self, lzops):
+        lzops = clamp_lz_operations(lzops, MAX_MATCH_LENGTH + 1)
+        tables = ZTables(*count_lz_symbols(lzops))
+        l_codes = tables.l_codes
+        d_codes = tables.d_codes
+        missing = self.MISSING_SYMBOL_COST
+        self.literals = [l_codes.get(c, (0, missing))[1] for c in range(256)]
+        self.lengths = [missing] * (MAX_MATCH_LENGTH + 1)
+        for symbol, (_, codelen) in l_codes.items():
+            if symbol >= LENGTH_BASE_SYMBOL:
+                self.lengths[symbol - LENGTH_BASE_SYMBOL + 3] = codelen
+        self.distances = distances = array("d", [0]) * (MAX_DISTANCE + 1)
+        for bucket in range(NUM_DISTANCE_BUCKETS):
+            start, nextra = distance_bucket_range(bucket)
+            end = min(start + (1 << nextra), MAX_DISTANCE + 1)
+            symbol = DISTANCE_BUCKET_SYMBOL + bucket
+            cost = d_codes.get(symbol, (0, missing))[1] + nextra
+            distances[start:end] = array("d", [cost]) * (end - start)
+        for d in tables.exact:
+            distances[d] = d_codes[d][1]
+
+
+def parse_lz_greedy(data, matches):
+    """Produce LZ operations by always taking the longest available match."""
+    starts, lengths, distances = matches
+    n = len(data)
+    lzops = []
+    literal_start = i = 0
+    while i < n:
+        if starts[i] == starts[i + 1]:
+            i += 1
+            continue
+        if literal_start < i:
+            lzops.append(LZLiteral(data[literal_start:i]))
+        k = starts[i + 1] - 1
+        lzops.append(LZMatch(lengths[k], distances[k]))
+        i += lengths[k]
+        literal_start = i
+    if literal_start < n:
+        lzops.append(LZLiteral(data[literal_start:n]))
+    return lzops
+
+
+def parse_lz_optimal(data, matches, costs):
+    """Produce LZ operations of minimal cost under the given cost model.
+
+    This is a shortest-path search forward through the data, where each
+    position can be left by a literal or by any of its candidate matches.
+    """
+    starts, lengths, distances = matches
+    n = len(data)
+    INF = float("inf")
+    cost = array("d", [INF]) * (n + 1)
+    cost[0] = 0
+    step_length = array("i", [0]) * (n + 1)
+    step_distance = array("i", [0]) * (n + 1)
+    lit_costs = costs.literals
+    len_costs = costs.lengths
+    dist_costs = costs.distances
+    for i, c in enumerate(bytearray(data)):
+        here = cost[i]
+        if here == INF:
+            continue
+        there = here + lit_costs[c]
+        if there < cost[i + 1]:
+            cost[i + 1] = there
+            step_length[i + 1] = 1
+            step_distance[i + 1] = 0
+        for k in range(starts[i], starts[i + 1]):
+            length = lengths[k]
+            distance = distances[k]
+            there = here + len_costs[length] + dist_costs[distance]
+            if there < cost[i + length]:
+                cost[i + length] = there
+                step_length[i + length] = length
+                step_distance[i + length] = distance
+    # Walk back along the cheapest path, then emit it in order.
+    steps = []
+    i = n
+    while i > 0:
+        steps.append(i)
+        i -= step_length[i]
+    lzops = []
+    literal_start = 0
+    for end in reversed(steps):
+        if step_distance[end]:
+            start = end - step_length[end]
+            if literal_start < start:
+                lzops.append(LZLiteral(data[literal_start:start]))
+            lzops.append(LZMatch(step_length[end], step_distance[end]))
+            literal_start = end
+    if literal_start < n:
+        lzops.append(LZLiteral(data[literal_start:n]))
+    return lzops
 
-        
 
 def merge_lz_operations(lzops):
     """Merge consecutive LZ operations into single ops if possible."""
@@ -469,6 +1151,62 @@ def merge_lz_operations(lzops):
         pass
 
 
+def skip_lz_gaps(lzops, memdata, segments):
+    """Replace the output of lz operations between segments with skips.
+
+    The gaps between the given (offset, length) segments of the memory image
+    are all zeros, so rather than writing them out we can emit LZSkip()
+    operations that just advance the output position.  Later matches may
+    still copy from skipped regions since they read back as zeros.
+    """
+    gaps = []
+    end = 0
+    for offset, length in segments:
+        if offset > end:
+            gaps.append((end, offset))
+        end = offset + length
+    if end < len(memdata):
+        gaps.append((end, len(memdata)))
+    gaps.reverse()
+    pos = 0
+    for op in lzops:
+        op_end = pos + op.length
+        while gaps and gaps[-1][0] < op_end:
+            gap_start, gap_end = gaps[-1]
+            # Emit whatever part of the operation precedes the gap.
+            if gap_start > pos:
+                for piece in slice_lz_operation(op, memdata, pos, gap_start):
+                    yield piece
+                pos = gap_start
+            # Skip over as much of the gap as this operation covers.
+            if gap_end > op_end:
+                yield LZSkip(op_end - pos)
+                gaps[-1] = (op_end, gap_end)
+                pos = op_end
+                break
+            yield LZSkip(gap_end - pos)
+            gaps.pop()
+            pos = gap_end
+        if pos < op_end:
+            for piece in slice_lz_operation(op, memdata, pos, op_end):
+                yield piece
+            pos = op_end
+
+
+def slice_lz_operation(op, memdata, start, end):
+    """Produce lz operations generating memdata[start:end] as part of op.
+
+    Matches keep their distance, unless the slice is too short to encode
+    as a match in which case it is emitted as a literal.
+    """
+    if start >= end:
+        return
+    if isinstance(op, LZMatch) and end - start >= 3:
+        yield LZMatch(end - start, op.distance)
+    else:
+        yield LZLiteral(memdata[start:end])
+
+
 def clamp_lz_operations(lzops, maxlen):
     """Clamp lengths in lz operations to a maximum value."""
     for op in lzops:
@@ -476,6 +1214,12 @@ def clamp_lz_operations(lzops, maxlen):
             while op.length >= maxlen:
                 yield LZLiteral(op.data[:maxlen-1])
                 op.data = op.data[maxlen-1:]
+                op.length = len(op.data)
+            yield op
+        elif isinstance(op, LZSkip):
+            while op.length >= maxlen:
+                yield LZSkip(maxlen-1)
+                op.length -= maxlen-1
             yield op
         else:
             while op.length >= maxlen:
@@ -539,7 +1283,7 @@ def decode_huffman_data(bits):
     assert HCLEN + 4 <= 32
     # Read the huffman tree for the huffman tree data.
     codelen_codelens = [0] * len(CODELEN_ALPHABET)
-    for i in xrange(HCLEN + 4):
+    for i in range(HCLEN + 4):
         codelen_codelens[CODELEN_ALPHABET[i]] = bits.read(3)
     h_codelen = HuffmanDecoder(codelen_codelens)
     # Read all the codelengths for litlen and dist trees.
@@ -574,59 +1318,73 @@ def decode_literal_block(bits):
     LEN = bits.read(16)
     NLEN = bits.read(16)
     assert LEN == ~NLEN & 0xFFFF
-    chars = []
-    for _ in xrange(LEN):
-        chars.append(chr(bits.read(8)))
-    yield LZLiteral("".join(chars))
+    # Stored data is byte-aligned, so we can slice it out in one go.
+    yield LZLiteral(bits.read_bytes(LEN))
 
 
 def decode_huffman_block(bits, h_litlen, h_dist):
     """Decode a DEFLATE huffman block using the given decoders."""
-    literals = []
+    literals = bytearray()
+    # Pull these into locals, since this is the innermost loop.
+    l_table = h_litlen.table
+    l_maxlen = h_litlen.maxlen
+    peek = bits.peek
+    consume = bits.consume
     while True:
         # Read a literal, length, or end-of-block symbol.
-        litlen = h_litlen.decode(bits)
-        if litlen == 256:
+        entry = l_table[peek(l_maxlen)]
+        consume(entry & 0xF)
+        litlen = entry >> 4
+        if litlen < 256:
+            # LZLiteral char, buffer it to yield runs as a single string.
+            literals.append(litlen)
+        elif litlen == 256:
             # End of block.
             if literals:
-                yield LZLiteral("".join(literals))
+                yield LZLiteral(bytes(literals))
             break
-        elif litlen < 256:
-            # LZLiteral char, buffer it to yield runs as a single string.
-            literals.append(chr(litlen))
         else:
             # Yield any buffered literal data.
             if literals:
-                yield LZLiteral("".join(literals))
-                literals = []
+                yield LZLiteral(bytes(literals))
+                literals = bytearray()
             length = decode_extra_length(bits, litlen)
             dist = h_dist.decode(bits)
             dist = decode_extra_distance(bits, dist)
             yield LZMatch(length, dist)
 
 
+# Base values and number of extra bits for each DEFLATE length symbol
+# from 257 onwards, and for each distance symbol.
+
+LENGTH_BASES = [3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 17, 19, 23, 27, 31,
+                35, 43, 51, 59, 67, 83, 99, 115, 131, 163, 195, 227, 258]
+LENGTH_EXTRA_BITS = [0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2,
+                     3, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 5, 0]
+
+DISTANCE_BASES = [1, 2, 3, 4, 5, 7, 9, 13, 17, 25, 33, 49, 65, 97, 129, 193,
+                  257, 385, 513, 769, 1025, 1537, 2049, 3073, 4097, 6145,
+                  8193, 12289, 16385, 24577]
+DISTANCE_EXTRA_BITS = [0, 0, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6,
+                       7, 7, 8, 8, 9, 9, 10, 10, 11, 11, 12, 12, 13, 13]
+
+
 def decode_extra_length(bits, length):
     """Decode extra bits for a match length symbol."""
-    if length == 285:
-        return 258
-    extra = (length - 257) / 4 - 1
-    length = length - 254
-    if extra > 0:
-        ebits = bits.read(extra)
-        length = 2**(extra+2) + 3 + (((length + 1) % 4) * (2**extra)) + ebits
-    return length
+    length -= 257
+    extra = LENGTH_EXTRA_BITS[length]
+    if extra:
+        return LENGTH_BASES[length] + bits.read(extra)
+    return LENGTH_BASES[length]
 
 
 def decode_extra_distance(bits, dist):
     """Decode extra bits for a match distance symbol."""
     assert dist <= 29
-    if dist >= 4:
-        extra = (dist - 2) / 2
-        if extra:
-            ebits = bits.read(extra)
-            dist = 2**(extra+1) + ((dist % 2) * (2**extra)) + ebits
-    dist += 1
-    return dist
+    extra = DISTANCE_EXTRA_BITS[dist]
+    if extra:
+        return DISTANCE_BASES[dist] + bits.read(extra)
+    return DISTANCE_BASES[dist]
 
 
 DEFAULT_LITLEN_DECODER = HuffmanDecoder(
@@ -638,76 +1396,466 @@ DEFAULT_DISTANCE_DECODER = HuffmanDecoder(
 )
 
 
+
+def decode_zmem(zmemdata):
+    """Decode a "zmem" file back into a dense memory image.
+
+    This is a straightforward reference implementation of the format, for
+    checking the output of `encode_zmem` and the behaviour of the asmjs
+    decompressor.  The image ends with the last byte produced by any block,
+    so trailing zeros are not included.
+    """
+    zmemdata = bytearray(zmemdata)
+    count, = struct.unpack_from("<I", zmemdata, 0)
+    memdata = bytearray()
+    for i in range(count):
+        start, offset, length = struct.unpack_from("<III", zmemdata, 4 + 12 * i)
+        output = decode_zmem_block(zmemdata[offset:offset + length])
+        if start > len(memdata):
+            memdata.extend(b"\x00" * (start - len(memdata)))
+        memdata[start:start + len(output)] = output
+    return memdata
+
+
+def decode_zmem_block(block):
+    """Decode a single block of a "zmem" file into a bytearray."""
+    region_table, = struct.unpack_from("<I", block, 0)
+    nregions, = struct.unpack_from("<I", block, region_table)
+    bits = ZBitReader(block[4:region_table])
+    output = bytearray()
+    for region in range(nregions):
+        l_offset, d_offset = struct.unpack_from("<II", block,
+                                                region_table + 4 + 8 * region)
+        l_decoder = ZCodeDecoder(block, l_offset)
+        d_decoder = ZCodeDecoder(block, d_offset)
+        while True:
+            symbol = l_decoder.decode(bits)
+            if symbol < END_SYMBOL:
+                output.append(symbol)
+            elif symbol == END_SYMBOL:
+                break
+            elif symbol == SKIP_SYMBOL:
+                output.extend(b"\x00" * bits.read(15))
+            else:
+                length = symbol - LENGTH_BASE_SYMBOL + 3
+                distance = d_decoder.decode(bits)
+                if distance >= DISTANCE_BUCKET_SYMBOL:
+                    distance, nextra = distance_bucket_range(
+                        distance - DISTANCE_BUCKET_SYMBOL)
+                    distance += bits.read(nextra)
+                if distance > len(output):
+                    raise ValueError("match distance out of range")
+                # The match may overlap the data it produces.
+                start = len(output) - distance
+                while length > 0:
+                    chunk = output[start:start + min(length, distance)]
+                    output.extend(chunk)
+                    length -= len(chunk)
+    return output
+
+
+class ZBitReader(object):
+    """Read a string as a stream of bits, most significant bit first.
+
+    This is the order in which BitWriter writes them.  Reading past the end
+    of the data produces zero bits, just like in the asmjs decompressor.
+    """
+
+    def __init__(self, data):
+        self._data = bytearray(data)
+        self._pos = 0
+        self._bitbuf = 0
+        self._nbits = 0
+
+    def peek(self, num):
+        """Look at the next `num` bits without consuming them."""
+        while self._nbits < num:
+            self._bitbuf <<= 8
+            if self._pos < len(self._data):
+                self._bitbuf |= self._data[self._pos]
+            self._pos += 1
+            self._nbits += 8
+        return self._bitbuf >> (self._nbits - num)
+
+    def consume(self, num):
+        """Discard `num` bits, which must previously have been peeked."""
+        self._nbits -= num
+        self._bitbuf &= (1 << self._nbits) - 1
+
+    def read(self, num):
+        out = self.peek(num)
+        self.consume(num)
+        return out
+
+
+class ZCodeDecoder(object):
+    """Decoder for a canonical huffman code as described by `enhuffen`.
+
+    The description at the given offset in `data` gives the number of codes
+    of each length followed by the symbols in code order.  Each symbol is
+    decoded by comparing the leading bits of input against the first code
+    of each length in turn, as in zlib's "puff" reference decoder.
+    """
+
+    def __init__(self, data, offset):
+        self.counts = struct.unpack_from("<%dH" % (MAX_CODE_LENGTH + 1),
+                                         data, offset)
+        offset += 2 * (MAX_CODE_LENGTH + 1)
+        self.symbols = struct.unpack_from("<%dH" % sum(self.counts),
+                                          data, offset)
+
+    def decode(self, bits):
+        peeked = bits.peek(MAX_CODE_LENGTH)
+        first = index = 0
+        for codelen in range(1, MAX_CODE_LENGTH + 1):
+            code = peeked >> (MAX_CODE_LENGTH - codelen)
+            count = self.counts[codelen]
+            if code - first < count:
+                bits.consume(codelen)
+                return self.symbols[index + code - first]
+            index += count
+            first = (first + count) << 1
+        raise ValueError("invalid huffman code")
+
+
+def unzip_code(HEAPU8, HEAPU16, HEAP32):
+    """Get the asmjs decompressor code, using the given heap view names."""
+    return (UNZIP_CODE
+        .replace("{HEAPU8}", HEAPU8)
+        .replace("{HEAPU16}", HEAPU16)
+        .replace("{HEAP32}", HEAP32)
+        .replace("{L_ROOT_BITS}", str(L_ROOT_BITS))
+        .replace("{D_ROOT_BITS}", str(D_ROOT_BITS))
+        .replace("{D_BUCKET_SYMBOL}", str(DISTANCE_BUCKET_SYMBOL))
+    )
+
+
 # The following is custom asmjs code to inflat a stream compressed
-# by the `zencode` function above.  It processes the input data
-# one bit at a time, looking up each symbol in the inline huffman trees.
+# by the `zencode` function above.  It keeps the next few bytes of input
+# in a 32-bit bit buffer, and decodes each symbol by indexing the lookup
+# table for the current region with the leading bits of the buffer.  The
+# buffer is refilled before reading each code and each set of extra bits,
+# which never need more than 25 bits between them.  We move on to the next
+# region's tables whenever END_SYMBOL is decoded.  Matches are copied a
+# word at a time where possible, which covers the common cases of runs of
+# a single repeated byte and copies of whole words of data.
+#
+# The lookup tables are built by `zmemtable` from the canonical huffman
+# codes written by `enhuffen`, in scratch memory just past the end of the
+# compressed data.  Each table starts with its number of root bits, and is
+# indexed by that many bits of input.  If the code starting with those bits
+# fits within the root then the entry is (symbol << 8) | length.  Otherwise
+# the entry is (offset << 8) | 0x80 | subbits, and the next `subbits` bits
+# index into a subtable at the given offset, whose entries give the symbol
+# and the remaining length of its code.  All subtables are the same size,
+# big enough to resolve the longest code.
+
+UNZIP_REFILL_CODE = """
+        while((bitcount|0) < 25) {
+          bitbuf=(bitbuf<<8)|({HEAPU8}[zcur]|0)
+          zcur=zcur+1|0
+          bitcount=bitcount+8|0
+        }"""
+
+UNZIP_LOOKUP_CODE = """
+        entry={HEAP32}[({TABLE}+(((bitbuf>>>(bitcount-{ROOT}|0))&((1<<{ROOT})-1))<<2))>>2]|0
+        if(entry&0x80) {
+          bitcount=bitcount-{ROOT}|0
+          nbits=entry&0x1F
+          entry={HEAP32}[({TABLE}+(((entry>>8)+((bitbuf>>>(bitcount-nbits|0))&((1<<nbits)-1))|0)<<2))>>2]|0
+        }
+        bitcount=bitcount-(entry&0x0F)|0
+        sym=entry>>8"""
 
 UNZIP_CODE = """
-  function zmeminit(base, zstart, zend) {
-    base=base|0
-    zstart=zstart|0
-    zend=zend|0
-    var zcur=0,byte=0,bit=0,shift=0,tree=0,node=0,mlen=0,mxbits=0
-    zcur=zstart
-    tree=zstart+{L_TREE_ROOT}|0
-    Z:while(1) {
-      byte={HEAPU8}[zcur]|0
-      zcur=zcur+1|0
-      shift=7
-      while(shift>>0 >= 0) {
-        bit=(byte>>shift) & 0x01
-        shift=shift-1|0
-        if(mxbits>>0 > 0) {
-          node=(node<<1)|bit
-          mxbits=mxbits-1|0
-          if(mxbits>>0 > 0) {
-            continue
-          }
+  function zmemtable(codes, table, rootbits) {
+    codes=codes|0
+    table=table|0
+    rootbits=rootbits|0
+    var maxlen=0,root=0,len=0,count=0,ptr=0,code=0,sym=0,entry=0
+    var i=0,end=0,next=0,sub=0,prefix=0,lastprefix=0,subtable=0
+    // Find the longest code length in use.
+    maxlen=15
+    while((maxlen|0) > 1) {
+      if({HEAPU16}[(codes+(maxlen<<1))>>1]|0) { break }
+      maxlen=maxlen-1|0
+    }
+    root=rootbits
+    if((maxlen|0) < (root|0)) { root=maxlen }
+    {HEAP32}[table>>2]=root
+    table=table+4|0
+    next=1<<root
+    sub=maxlen-root|0
+    lastprefix=-1
+    ptr=codes+32|0
+    len=1
+    while((len|0) <= (maxlen|0)) {
+      count={HEAPU16}[(codes+(len<<1))>>1]|0
+      while((count|0) > 0) {
+        sym={HEAPU16}[ptr>>1]|0
+        ptr=ptr+2|0
+        if((len|0) <= (root|0)) {
+          entry=(sym<<8)|len
+          i=code<<(root-len)
+          end=(code+1)<<(root-len)
         } else {
-          node={HEAPU16}[(tree+node+node+bit+bit)>>1]|0
-          if((node & 0x8000) == 0) {
-            continue
+          // Codes sharing a prefix are consecutive, so they all
+          // go into the most recently allocated subtable.
+          prefix=code>>(len-root)
+          if((prefix|0) != (lastprefix|0)) {
+            {HEAP32}[(table+(prefix<<2))>>2]=(next<<8)|0x80|sub
+            subtable=next
+            next=next+(1<<sub)|0
+            lastprefix=prefix
+          }
+          entry=(sym<<8)|(len-root)
+          i=subtable+((code&((1<<(len-root))-1))<<(maxlen-len))|0
+          end=i+(1<<(maxlen-len))|0
+        }
+        while((i|0) < (end|0)) {
+          {HEAP32}[(table+(i<<2))>>2]=entry
+          i=i+1|0
+        }
+        code=code+1|0
+        count=count-1|0
+      }
+      code=code<<1
+      len=len+1|0
+    }
+    return (next<<2)+4|0
+  }
+
+  function zmemblock(base, block, scratch) {
+    base=base|0
+    block=block|0
+    scratch=scratch|0
+    var zcur=0,bitbuf=0,bitcount=0,regions=0,region=0,nregions=0,scratchend=0
+    var ltab=0,lroot=0,dtab=0,droot=0,entry=0,sym=0,nbits=0,mlen=0,word=0
+    regions=block+({HEAP32}[block>>2]|0)|0
+    nregions={HEAP32}[regions>>2]|0
+    zcur=block+4|0
+    scratchend=scratch
+    Z:while((region|0) < (nregions|0)) {
+      // Build the lookup tables for the next region.
+      ltab=scratch
+      sym=block+({HEAP32}[(regions+4+(region<<3))>>2]|0)|0
+      dtab=ltab+(zmemtable(sym|0, ltab|0, {L_ROOT_BITS})|0)|0
+      sym=block+({HEAP32}[(regions+8+(region<<3))>>2]|0)|0
+      sym=dtab+(zmemtable(sym|0, dtab|0, {D_ROOT_BITS})|0)|0
+      if((sym|0) > (scratchend|0)) { scratchend=sym }
+      lroot={HEAP32}[ltab>>2]|0
+      droot={HEAP32}[dtab>>2]|0
+      ltab=ltab+4|0
+      dtab=dtab+4|0
+      region=region+1|0
+      while(1) {""" + UNZIP_REFILL_CODE + \
+      UNZIP_LOOKUP_CODE.replace("{TABLE}", "ltab").replace("{ROOT}", "lroot") + """
+        if((sym|0) < 256) {
+          {HEAPU8}[base]=sym
+          base=base+1|0
+          continue
+        }
+        if((sym|0) == 256) {
+          continue Z
+        }""" + UNZIP_REFILL_CODE + """
+        if((sym|0) == 257) {
+          // Skip over zeros, they're already in place.
+          bitcount=bitcount-15|0
+          base=base+((bitbuf>>>bitcount)&0x7FFF)|0
+          continue
+        }
+        mlen=sym-258+3|0""" + \
+        UNZIP_LOOKUP_CODE.replace("{TABLE}", "dtab").replace("{ROOT}", "droot") + """
+        if((sym|0) >= {D_BUCKET_SYMBOL}) {
+          // Find the bucket's base distance and add in the extra bits.
+          sym=sym-{D_BUCKET_SYMBOL}|0
+          if((sym|0) < 4) {
+            sym=sym+1|0
+          } else {""" + UNZIP_REFILL_CODE.replace("\n", "\n  ") + """
+            nbits=(sym>>1)-1|0
+            bitcount=bitcount-nbits|0
+            sym=(((2|(sym&1))<<nbits)+1|0)+((bitbuf>>>bitcount)&((1<<nbits)-1))|0
           }
-          node=node & 0x7FFF
         }
-        if(tree>>0 == zstart+{L_TREE_ROOT}>>0) {
-          if (node>>0 == 256) { break Z }
-          if (node>>0 < 256) {
-            {HEAPU8}[base] = node|0
-            base=base+1|0;
-            node=0
-          } else {
-            mlen=node-257+3|0
-            tree=zstart+{D_TREE_ROOT}|0
-            node=0
+        // Copy match data to output, a word at a time if we can.
+        if((sym|0) == 1) {
+          word={HEAPU8}[(base-1|0)]|0
+          word=word|(word<<8)
+          word=word|(word<<16)
+          while(base&3) {
+            if((mlen|0) == 0) { break }
+            {HEAPU8}[base]=word
+            base=base+1|0
+            mlen=mlen-1|0
           }
-        } else {
-          if(node>>0 == 0) {
-            // decode extra distance
-            mxbits = 15
-          } else {
-            // Copy match data to output.
-            while(mlen>>0 != 0) {
-              {HEAPU8}[base]={HEAPU8}[(base - node)>>0]|0;
-              base=base+1|0;
-              mlen=mlen-1|0;
-            }
-            tree=zstart+{L_TREE_ROOT}|0
-            node=0
+          while((mlen|0) >= 4) {
+            {HEAP32}[base>>2]=word
+            base=base+4|0
+            mlen=mlen-4|0
+          }
+        } else if((sym&3) == 0) {
+          while(base&3) {
+            if((mlen|0) == 0) { break }
+            {HEAPU8}[base]={HEAPU8}[(base-sym|0)]|0
+            base=base+1|0
+            mlen=mlen-1|0
           }
+          while((mlen|0) >= 4) {
+            {HEAP32}[base>>2]={HEAP32}[(base-sym|0)>>2]|0
+            base=base+4|0
+            mlen=mlen-4|0
+          }
+        }
+        while((mlen|0) > 0) {
+          {HEAPU8}[base]={HEAPU8}[(base-sym|0)]|0
+          base=base+1|0
+          mlen=mlen-1|0
         }
       }
     }
-    // zero out remaining compressed data
-    while((base|0) < (zend|0)) {
-      {HEAPU8}[base]=0;
-      base=base+1|0;
+    return scratchend|0
+  }
+
+  function zmemzero(start, end) {
+    start=start|0
+    end=end|0
+    while(start&3) {
+      if((start|0) >= (end|0)) { return }
+      {HEAPU8}[start]=0
+      start=start+1|0
+    }
+    while((start+4|0) <= (end|0)) {
+      {HEAP32}[start>>2]=0
+      start=start+4|0
+    }
+    while((start|0) < (end|0)) {
+      {HEAPU8}[start]=0
+      start=start+1|0
     }
   }
 """
 
 
+# And this is the javascript code that feeds the compressed data to the
+# decompressor.  The data is copied into the heap as it arrives, and each
+# block is decompressed as soon as all of it is available.  Under node we
+# read the file in chunks, while in browsers that support it we stream it
+# using fetch().  Otherwise, it all arrives at once from the usual loader.
+# Once everything has been decompressed, the compressed data and lookup
+# tables are cleared out of the heap.
+
+ZMEM_LOADER_CODE = """
+        var zmemStart = Runtime.GLOBAL_BASE + {ZSTART};
+        var zmemEnd = Runtime.GLOBAL_BASE + {ZEND};
+        var zmemScratchEnd = zmemEnd;
+        var zmemReceived = 0;
+        var zmemNextBlock = 0;
+        var zmemU32 = function(i) {
+          i += zmemStart;
+          return (HEAPU8[i] | (HEAPU8[i+1] << 8) | (HEAPU8[i+2] << 16) | (HEAPU8[i+3] << 24)) >>> 0;
+        };
+        var zmemDecodeBlocks = function() {
+          if (zmemReceived < 4) return;
+          var count = zmemU32(0);
+          while (zmemNextBlock < count && zmemReceived >= 4 + count * 12) {
+            var entry = 4 + zmemNextBlock * 12;
+            var offset = zmemU32(entry + 4);
+            if (zmemReceived < offset + zmemU32(entry + 8)) return;
+            var scratchEnd = asm["zmemblock"](Runtime.GLOBAL_BASE + zmemU32(entry),
+                                              zmemStart + offset, zmemEnd);
+            zmemScratchEnd = Math.max(zmemScratchEnd, scratchEnd);
+            zmemNextBlock++;
+          }
+        };
+        var zmemPush = function(data) {
+          HEAPU8.set(data, zmemStart + zmemReceived);
+          zmemReceived += data.length;
+          zmemDecodeBlocks();
+        };
+        var zmemApply = function(data) {
+          zmemPush(data);
+          asm["zmemzero"](zmemStart, zmemScratchEnd);
+        };
+        var zmemRead = function(filename, onchunk) {
+          if (!ENVIRONMENT_IS_NODE) {
+            return Module['readBinary'](filename);
+          }
+          var fs = require('fs');
+          var chunk = Buffer.alloc ? Buffer.alloc({CHUNK_SIZE}) : new Buffer({CHUNK_SIZE});
+          var fd = fs.openSync(filename, 'r');
+          try {
+            var size;
+            while ((size = fs.readSync(fd, chunk, 0, chunk.length, null)) > 0) {
+              zmemPush(chunk.slice(0, size));
+              if (onchunk) onchunk(chunk.slice(0, size));
+            }
+          } finally {
+            fs.closeSync(fd);
+          }
+          return new Uint8Array(0);
+        };
+        var zmemFetch = function(url, onload, onerror, onchunk) {
+          if (typeof fetch !== 'function' || typeof ReadableStream === 'undefined') {
+            return Browser.asyncLoad(url, onload, onerror);
+          }
+          // The callbacks are called outside of the promise chain, so that
+          // errors thrown by them aren't mistaken for a failed download.
+          // If streaming fails then we start again with the usual loader.
+          fetch(url).then(function(response) {
+            if (!response.ok || !response.body) {
+              throw new Error('could not stream ' + url);
+            }
+            var reader = response.body.getReader();
+            var pump = function() {
+              return reader.read().then(function(result) {
+                if (result.done) return;
+                zmemPush(result.value);
+                if (onchunk) onchunk(result.value);
+                return pump();
+              });
+            };
+            return pump();
+          }).then(function() {
+            setTimeout(function() { onload(new Uint8Array(0)); }, 0);
+          }, function() {
+            setTimeout(function() {
+              zmemReceived = 0;
+              Browser.asyncLoad(url, onload, onerror);
+            }, 0);
+          });
+        };"""
+
+
+def main(args=None):
+    usage = "usage: %prog [options] file"
+    descr = "Compress memory initializer for emscripten-compiled file"
+    parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("-m", "--matcher", choices=("zlib", "native"),
+                      default=DEFAULT_MATCHER,
+                      help="how to find LZ77 matches: zlib or native")
+    parser.add_option("-c", "--max-chain", type=int, default=MAX_CHAIN,
+                      metavar="N",
+                      help="native matcher: max hash-chain entries per position")
+    parser.add_option("-p", "--passes", type=int, default=OPTIMAL_PASSES,
+                      metavar="N",
+                      help="native matcher: number of optimal parsing passes")
+    parser.add_option("-r", "--region-size", type=int, default=REGION_SIZE,
+                      metavar="N",
+                      help="bytes of output per candidate huffman-code region")
+    parser.add_option("-b", "--block-size", type=int, default=BLOCK_SIZE,
+                      metavar="N",
+                      help="bytes of memory per independent block, or 0 for one")
+    parser.add_option("-v", "--report", action="store_true",
+                      help="print the size gained by each region's codes")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("expected a single file argument")
+    compress_memory_file(args[0], opts.matcher, opts.max_chain, opts.passes,
+                         opts.region_size, opts.block_size, opts.report)
+    return 0
+
+
 if __name__ == "__main__":
-    source_filename = sys.argv[1]
-    compress_memory_file(source_filename)
+    sys.exit(main())
 
@@ -2,48 +2,363 @@
 #  Improve compressibility of emscripten-generated javascript,
 #  by moving similar functions closer together in the source.
 #
+#  The functions are laid out greedily, by repeatedly picking the pending
+#  function that compresses best alongside the function at either end of
+#  the output so far.  Scoring every pending function with zlib at every
+#  step is very slow for large windows, so the --sketch option instead
+#  summarizes each function with a MinHash signature of its shingles (the
+#  set of short substrings that it contains) and buckets the signatures in
+#  a locality-sensitive hash index.  Each step then looks up the nearest
+#  neighbours of the two end functions in the index, and computes the exact
+#  zlib score for only the few most similar of them.  This makes the cost
+#  of a step roughly independent of the window size, so the whole file can
+#  be used as the window.
+#
+#  The scores are independent of each other, so with the --jobs option they
+#  are computed by a pool of worker processes, each holding its own copy of
+#  the functions, as are the compressed lengths of the functions and their
+#  signatures for the --sketch index.  The choice between the scores is
+#  always made in the main process, in order of function index, so the
+#  output does not depend on the number of workers.
+#
+#  The greedy ordering can then be improved by a few passes of local search
+#  with the --refine option.  This tries reversing short runs of functions,
+#  and moving short runs next to similar functions elsewhere in the file,
+#  keeping each change that reduces the real compressed size of the code
+#  surrounding it.  Passes stop once one fails to shrink the whole file,
+#  and in any case the reordered code is only used if it compresses better
+#  than the original, unless one of the options below asks for a particular
+#  layout.
+#
+#  Most functions are unchanged from one build to the next, so rather than
+#  starting from scratch, the --previous option takes the cromulated output
+#  of a previous build, or an ordering file written by --save-order, and
+#  keeps the functions whose code is unchanged in their previous order.
+#  Each new or changed function is then placed next to whichever of its
+#  nearest unchanged neighbours it compresses best with, and any that are
+#  unlike all of them are cromulated separately and added at the end.  This
+#  is much faster than a full cromulation, and keeps the unchanged parts of
+#  the file stable so that release deltas stay small.  For the same reason,
+#  the extended order is used even if it compresses a little worse than the
+#  order that the functions came in, and the difference is reported.  An
+#  ordering file just lists the sha1 hash of the code of each function, one
+#  per line.
+#
+#  Compressibility isn't the only thing that matters, since the browser
+#  can start parsing and compiling the code as it streams in.  With the
+#  --profile option, the functions named in a usage profile are grouped
+#  together at the start of the function table, and the rest after them,
+#  with each group cromulated separately.  The profile is a list of the
+#  function names that are used at startup or by common workloads, such as
+#  can be collected by logging function entry in a debug build, optionally
+#  with a use count after each name.  Note that release builds may minify
+#  function names, in which case the profile must give the minified ones.
+#  A report compares how much of the file must be downloaded before all of
+#  the hot functions are available, before and after the new layout.
+#
 
 import os
 import sys
 import zlib
+import hashlib
 import optparse
 import tempfile
+import multiprocessing
+from bisect import bisect_left
 from collections import deque
+from itertools import islice
 
 MARKER_START_FUNCS = "// EMSCRIPTEN_START_FUNCS"
 MARKER_END_FUNCS = "// EMSCRIPTEN_END_FUNCS"
 
+# Parameters for the --sketch mode.  Each signature holds SKETCH_SIZE
+# hash values computed over the SHINGLE_SIZE-byte substrings of a function,
+# and is split into bands of SKETCH_BAND_SIZE values for indexing.  Two
+# functions whose shingle sets have a Jaccard similarity of just 0.2 share
+# at least one band about three quarters of the time.
+
+SHINGLE_SIZE = 6
+SKETCH_SIZE = 64
+SKETCH_BAND_SIZE = 2
+
+# The number of nearest neighbours of each end function that are given an
+# exact score, and a limit on how many functions are looked at in any one
+# bucket, to bound the cost of a step when many functions are alike.
+
+SHORTLIST_SIZE = 8
+MAX_BUCKET_SCAN = 256
+
+# With --jobs, the work at each step is split into this many batches per
+# worker, to even out the load.  Any step with at least MIN_PARALLEL_ITEMS
+# pieces of work is handed to the workers, so that even the few scores that
+# are needed at each step in --sketch mode are spread across them.
 
-def cromulate(fileobj, opts, on_progress=None):
+BATCHES_PER_JOB = 4
+MIN_PARALLEL_ITEMS = 2
+
+# Parameters for the --refine mode.  Each change is judged on the code that
+# it touches plus at least REFINE_CONTEXT bytes either side of it, which is
+# as far as deflate will look back.  Runs of up to REFINE_MAX_REVERSE
+# functions are tried in reverse, and runs of up to REFINE_MAX_MOVE are
+# tried next to each of their REFINE_NEIGHBOURS nearest neighbours.
+
+REFINE_CONTEXT = 32 * 1024
+REFINE_MAX_REVERSE = 6
+REFINE_MAX_MOVE = 3
+REFINE_NEIGHBOURS = 2
+
+# The zlib compress level used to judge whether the file got smaller,
+# regardless of the level used for scoring.
+
+FINAL_COMPRESS_LEVEL = 9
+
+
+def cromulate(fileobj, opts, on_progress=None, on_report=None):
     # Split out the code for each individual function.
     # We don't have to actually *parse* it, just chunk it up.
     # XXX TODO: read incrementally to reduce memory usage.
-    data = fileobj.read()
+    original = fileobj.read()
+    pre_code, functions, post_code = split_functions(original)
+    functions = cromulate_functions(pre_code, functions, post_code, opts,
+                                    on_progress, on_report)
+    return join_functions(pre_code, functions, post_code)
+
+
+def cromulate_functions(pre_code, functions, post_code, opts,
+                        on_progress=None, on_report=None):
+    """Cromulate the parts returned by split_functions.
+
+    This returns the functions in their new order, or the original list
+    of functions if the new order doesn't compress any better.  The new
+    order is always used with a profile or a previous order, and on_report
+    is called with a report comparing the two layouts.
+    """
+    # With a profile, the hot and cold functions are ordered separately.
+    groups = [range(1, len(functions))]
+    hot_names = None
+    if opts.profile:
+        hot_names = read_profile(opts.profile)
+        groups = [[], []]
+        for i in xrange(1, len(functions)):
+            groups[function_name(functions[i]) not in hot_names].append(i)
+        # A stale profile may match none of the functions, or all of them.
+        groups = [group for group in groups if group]
+
+    previous_order = None
+    if opts.previous:
+        previous_order = read_order(opts.previous)
+    order = []
+    for group in groups:
+        order.extend(order_group(functions, group, opts, previous_order,
+                                 on_progress))
+
+    # Add the leading whitespace to ensure overall bytelength stays constant.
+    reordered_functions = [functions[0]]
+    reordered_functions.extend(functions[i] for i in order)
+
+    # Sanity-check that we haven't accidentally a function.
+    assert set(functions) == set(reordered_functions)
+
+    # That's it.  Re-assemble the full code string, but only use it if it
+    # actually compresses better than what we started with, unless we were
+    # asked for a particular layout.  Going back to the original order from
+    # a previous one would change the whole layout, and so the whole of the
+    # release delta.
+    original = join_functions(pre_code, functions, post_code)
+    output = join_functions(pre_code, reordered_functions, post_code)
+    if hot_names is not None or previous_order is not None:
+        if on_report is not None:
+            on_report(layout_report(original, output, hot_names))
+    elif final_compressed_length(output) >= final_compressed_length(original):
+        return functions
+    return reordered_functions
+
+
+def final_compressed_length(data):
+    return len(zlib.compress(data, FINAL_COMPRESS_LEVEL))
+
+
+def order_group(functions, group, opts, previous_order=None,
+                on_progress=None):
+    """Order a group of the functions, given as a list of their indices.
+
+    This cromulates just those functions, as though they were the only ones
+    in the file, and returns their indices in the new order.
+    """
+    if not group:
+        return []
+    group_functions = [functions[0]]
+    group_functions.extend(functions[i] for i in group)
+    scorer = PairScorer(group_functions, opts.compress_level, opts.jobs)
+    try:
+        if previous_order is not None:
+            order = extend_order(group_functions, previous_order, scorer, opts,
+                                 on_progress)
+        else:
+            order = order_functions(group_functions, scorer, opts,
+                                    on_progress)
+        if opts.refine > 0:
+            order = refine_order(group_functions, order, opts, on_progress,
+                                 scorer)
+    finally:
+        scorer.close()
+    return [group[i - 1] for i in order]
+
+
+def function_name(func):
+    return func.split("(", 1)[0].strip()
+
+
+def read_profile(filename):
+    """Read a function-usage profile, returning the set of hot names.
+
+    Each line gives a function name, optionally followed by the number of
+    times that it was used.  Names with a zero count aren't hot, and blank
+    lines and lines starting with "#" are ignored.
+    """
+    hot_names = set()
+    with open(filename, "r") as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) == 1 or int(fields[1]) > 0:
+                hot_names.add(fields[0])
+    return hot_names
+
+
+def layout_report(original, output, hot_names=None):
+    """Measure how soon the hot functions are available in each layout.
+
+    This returns a dict giving the number and size of the hot functions,
+    the profiled names that weren't found, and for each of the original
+    and new layouts, the offset at which the last hot function ends, the
+    compressed size of everything up to that point, and the compressed size
+    of the whole file.  Without any hot names, it just gives the compressed
+    size of each layout.
+    """
+    report = {}
+    if hot_names is None:
+        for label, data in (("original", original), ("new", output)):
+            report[label] = {"compressed": final_compressed_length(data)}
+        return report
+    for label, data in (("original", original), ("new", output)):
+        pre_code, functions, _ = split_functions(data)
+        offset = len(pre_code) + len(MARKER_START_FUNCS) + len(functions[0])
+        hot_end = None
+        hot_count = hot_size = 0
+        found = set()
+        for func in functions[1:]:
+            offset += len("function ") + len(func)
+            name = function_name(func)
+            if name in hot_names:
+                found.add(name)
+                hot_end = offset
+                hot_count += 1
+                hot_size += len("function ") + len(func)
+        report[label] = {
+            "hot_end": hot_end or 0,
+            "hot_end_compressed": final_compressed_length(data[:hot_end or 0]),
+            "compressed": final_compressed_length(data),
+        }
+    report["hot_functions"] = hot_count
+    report["hot_size"] = hot_size
+    report["missing"] = sorted(hot_names - found)
+    return report
+
+
+def print_layout_report(report, output=sys.stdout):
+    """Print the report from a profile-guided or previous layout."""
+    rows = [("Whole file compressed size", "compressed")]
+    if "hot_functions" in report:
+        output.write("Hot functions: %d (%d bytes)\n" % (
+            report["hot_functions"], report["hot_size"]))
+        if report["missing"]:
+            output.write("Profiled functions not found: %d (e.g. %s)\n" % (
+                len(report["missing"]), ", ".join(report["missing"][:5])))
+        rows[:0] = [("Hot code ends at byte", "hot_end"),
+                    ("  compressed size to there", "hot_end_compressed")]
+    output.write("%-30s %12s %12s\n" % ("", "original", "new"))
+    for label, key in rows:
+        output.write("%-30s %12d %12d\n" % (label, report["original"][key],
+                                            report["new"][key]))
+
+
+def split_functions(data):
+    """Split code into the text before, the functions, and the text after.
+
+    Note that the first item in the list of functions is the whitespace
+    that precedes the first function, not a real function.
+    """
     pre_code, data = data.split(MARKER_START_FUNCS, 1)
     data, post_code = data.split(MARKER_END_FUNCS, 1)
-    functions = data.split("function ")
-
-    def get_compressed_length(data):
-        return len(zlib.compress(data, opts.compress_level))
-
-    # Pre-calculate the compressed length of each individual function.
-    # Note that functions[0] is leading whitespace, not a real function.
-    compressed_lengths = [0]
-    for i in xrange(1, len(functions)):
-        compressed_lengths.append(get_compressed_length(functions[i]))
-
-    # We will judge the utility of having A and B adjacent by the difference
-    # between their individual compressed sizes, and their size when
-    # compressed together.  Smaller values are better.
-    def score_func_pair(i, j, flip=False):
-        func1 = functions[i]
-        func2 = functions[j]
-        original = compressed_lengths[i] + compressed_lengths[j]
-        if not flip:
-            combined = get_compressed_length(func1 + func2)
-        else:
-            combined = get_compressed_length(func2 + func1)
-        return combined - original
+    return pre_code, data.split("function "), post_code
+
+
+def join_functions(pre_code, functions, post_code):
+    """Re-assemble the parts returned by split_functions."""
+    return "".join((
+        pre_code,
+        MARKER_START_FUNCS,
+        "function ".join(functions),
+        MARKER_END_FUNCS,
+        post_code,
+    ))
+
+
+def function_hash(func):
+    return hashlib.sha1(func).hexdigest()
+
+
+def read_order(filename):
+    """Read the hashes of functions in order, from code or an order file."""
+    with open(filename, "r") as f:
+        data = f.read()
+    if MARKER_START_FUNCS in data:
+        return [function_hash(func) for func in split_functions(data)[1][1:]]
+    return data.split()
+
+
+def write_order(filename, data):
+    """Write an order file giving the order of the functions in data."""
+    functions = split_functions(data)[1]
+    with open(filename + ".new", "w") as f:
+        for func in functions[1:]:
+            f.write(function_hash(func) + "\n")
+    os.rename(filename + ".new", filename)
+
+
+def order_functions(functions, scorer, opts, on_progress=None):
+    """Greedily order the functions for compressibility.
+
+    This returns a list giving the indices of the functions in their new
+    order.  Note that functions[0] is leading whitespace, not a real
+    function, so it does not appear in the list.
+    """
+    if len(functions) < 2:
+        return []
+    # Scores against the current head and tail are cached until that end
+    # changes, since only one of them changes at each step.  Each candidate
+    # is scored against the last few functions at either end, as given by
+    # the --lookahead option.
+    head_scores = {}
+    tail_scores = {}
+    lookahead = max(opts.lookahead, 1)
+
+    def score_candidates(candidates):
+        tail_context = tuple(islice(reversed(reordered_functions), lookahead))
+        head_context = tuple(islice(reordered_functions, lookahead))
+        pairs = [(tail_context[::-1], (func,)) for func in candidates
+                 if func not in tail_scores]
+        num_tail_pairs = len(pairs)
+        pairs.extend(((func,), head_context) for func in candidates
+                     if func not in head_scores)
+        scores = scorer.score_pairs(pairs)
+        for (_, (func,)), score in zip(pairs[:num_tail_pairs], scores):
+            tail_scores[func] = score
+        for ((func,), _), score in zip(pairs[num_tail_pairs:],
+                                       scores[num_tail_pairs:]):
+            head_scores[func] = score
 
     # Use a deque so that we can add at either head or tail.
     reordered_functions = deque()
@@ -57,36 +372,66 @@ def cromulate(fileobj, opts, on_progress=None):
     else:
         seen = min(opts.window_size + 2, len(functions))
     pending = set(range(2, seen))
-    reordered_functions.appendleft(functions[head])
+    reordered_functions.appendleft(head)
+
+    # In sketch mode, the index holds every function not yet written, and
+    # we fall back to the earliest pending function if neither end has any
+    # neighbours in the index.
+    index = None
+    if opts.sketch:
+        index = SketchIndex(functions, first=1,
+                            signatures=scorer.minhash_signatures())
+        index.remove(head)
+        next_func = 2
+
+        def in_window(func):
+            return func < seen
 
     # While we have functions left to append, pick the one that gives
     # the best compression either at head of tail of the deque.
-    # XXX TODO: consider several funcs from head/tail when choosing?
-    on_progress(0, len(functions))
+    if on_progress is not None:
+        on_progress(0, len(functions))
     while pending:
-        # Find the best pending function.
+        # Find the candidate functions to be scored, in order of index so
+        # that ties are always broken the same way.
+        if index is None:
+            candidates = sorted(pending)
+        else:
+            candidates = set(index.nearest(tail, opts.shortlist, in_window))
+            candidates.update(index.nearest(head, opts.shortlist, in_window))
+            if not candidates:
+                while next_func not in pending:
+                    next_func += 1
+                candidates.add(next_func)
+            candidates = sorted(candidates)
+        # Find the best of them.
+        score_candidates(candidates)
         best_score = float("inf")
-        best_func = iter(pending).next()
+        best_func = candidates[0]
         best_is_tail = True
-        for func in pending:
-            score_tail = score_func_pair(tail, func)
-            if score_tail < best_score:
-                best_score = score_tail
+        for func in candidates:
+            score = tail_scores[func]
+            if score < best_score:
+                best_score = score
                 best_func = func
                 best_is_tail = True
-            score_head = score_func_pair(head, func, flip=True)
-            if score_head < best_score:
-                best_score = score_head
+            score = head_scores[func]
+            if score < best_score:
+                best_score = score
                 best_func = func
                 best_is_tail = False
         # Append it on the appropriate end of the deque.
         pending.remove(best_func)
+        if index is not None:
+            index.remove(best_func)
         if best_is_tail:
             tail = best_func
-            reordered_functions.append(functions[tail])
+            tail_scores.clear()
+            reordered_functions.append(tail)
         else:
             head = best_func
-            reordered_functions.appendleft(functions[head])
+            head_scores.clear()
+            reordered_functions.appendleft(head)
         # Slurp in another pending function to replace it.
         if seen < len(functions):
             pending.add(seen)
@@ -94,31 +439,439 @@ def cromulate(fileobj, opts, on_progress=None):
         if on_progress is not None:
             on_progress(len(reordered_functions), len(functions))
 
-    # Add the leading whitespace to ensure overall bytelength stays constant.
-    reordered_functions.appendleft(functions[0])
+    return list(reordered_functions)
 
-    # Sanity-check that we haven't accidentally a function.
-    assert set(functions) == set(reordered_functions)
 
-    # That's it.  Re-assemble the full code string.
-    return "".join((
-        pre_code,
-        MARKER_START_FUNCS,
-        "function ".join(reordered_functions),
-        MARKER_END_FUNCS,
-        post_code,
-    ))
+def extend_order(functions, previous_order, scorer, opts, on_progress=None):
+    """Order the functions by extending a previous ordering.
+
+    Functions whose hash appears in previous_order keep their relative
+    order, and the others are placed around them.  This returns a list of
+    function indices, just like order_functions.
+    """
+    # Match the functions up with their previous positions.  Functions
+    # with identical code are matched up in turn.
+    previous_positions = {}
+    for pos, digest in enumerate(previous_order):
+        previous_positions.setdefault(digest, []).append(pos)
+    kept = []
+    new = []
+    for func in xrange(1, len(functions)):
+        positions = previous_positions.get(function_hash(functions[func]))
+        if positions:
+            kept.append((positions.pop(0), func))
+        else:
+            new.append(func)
+    kept = [func for _, func in sorted(kept)]
+
+    # Score each new function before and after each of its nearest
+    # unchanged neighbours, all in one batch so that it can be spread
+    # across the workers.
+    is_kept = [False] * len(functions)
+    for func in kept:
+        is_kept[func] = True
+    index = SketchIndex(functions, first=1,
+                        signatures=scorer.minhash_signatures())
+    pairs = []
+    placements = []
+    leftovers = []
+    before = {}
+    after = {}
+    for func in new:
+        neighbours = index.nearest(func, opts.shortlist, is_kept.__getitem__)
+        if not neighbours:
+            leftovers.append(func)
+        for neighbour in neighbours:
+            pairs.append(((neighbour,), (func,)))
+            placements.append((func, after, neighbour))
+            pairs.append(((func,), (neighbour,)))
+            placements.append((func, before, neighbour))
+    scores = scorer.score_pairs(pairs)
+
+    # Attach each new function to the best of them.  When several are
+    # attached to the same side of a function, they stay in index order.
+    best = {}
+    for placement, score in zip(placements, scores):
+        func = placement[0]
+        if func not in best or score < best[func][0]:
+            best[func] = (score, placement)
+    for func in new:
+        if func in best:
+            _, side, neighbour = best[func][1]
+            side.setdefault(neighbour, []).append(func)
+
+    order = []
+    for func in kept:
+        order.extend(before.get(func, ()))
+        order.append(func)
+        order.extend(after.get(func, ()))
+
+    # Cromulate the functions that are unlike any of the unchanged ones on
+    # their own, and add them to the end.
+    if leftovers:
+        leftover_functions = [functions[0]]
+        leftover_functions.extend(functions[func] for func in leftovers)
+        leftover_scorer = PairScorer(leftover_functions, opts.compress_level,
+                                     opts.jobs)
+        try:
+            leftover_order = order_functions(leftover_functions,
+                                             leftover_scorer, opts)
+        finally:
+            leftover_scorer.close()
+        order.extend(leftovers[i - 1] for i in leftover_order)
+
+    if on_progress is not None:
+        on_progress(len(order), len(functions) - 1)
+    return order
+
+
+def refine_order(functions, order, opts, on_progress=None, scorer=None):
+    """Improve an ordering of the functions by local search.
+
+    This makes up to opts.refine passes over the ordering, stopping early
+    if a pass fails to reduce the compressed size of the whole function
+    table, and returns the best ordering found.  If a PairScorer for the
+    functions is given, its workers are used to build the sketch index.
+    """
+    lengths = [len(func) for func in functions]
+    signatures = None
+    if scorer is not None:
+        signatures = scorer.minhash_signatures()
+    index = SketchIndex(functions, first=1, signatures=signatures)
+    level = opts.compress_level
+    costs = {}
+
+    def cost(lo, hi, new_order=None):
+        # The compressed size of order[lo:hi], which is cached until the
+        # ordering changes, or of the given replacement for it.
+        if new_order is None:
+            if (lo, hi) not in costs:
+                costs[lo, hi] = cost(lo, hi, order[lo:hi])
+            return costs[lo, hi]
+        text = "function ".join(functions[i] for i in new_order)
+        return len(zlib.compress(text, level))
+
+    def extent(lo, hi):
+        # Widen order[lo:hi] by the context that deflate can see.
+        size = 0
+        while lo > 0 and size < opts.refine_context:
+            lo -= 1
+            size += lengths[order[lo]]
+        size = 0
+        while hi < len(order) and size < opts.refine_context:
+            size += lengths[order[hi]]
+            hi += 1
+        return lo, hi
+
+    def try_reverse(start, end):
+        lo, hi = extent(start, end)
+        new_order = order[lo:start] + order[start:end][::-1] + order[end:hi]
+        if cost(lo, hi, new_order) >= cost(lo, hi):
+            return False
+        order[start:end] = order[start:end][::-1]
+        for pos in xrange(start, end):
+            positions[order[pos]] = pos
+        return True
+
+    def try_move(start, end, dest):
+        # Move order[start:end] to just before order[dest].
+        if start <= dest <= end:
+            return False
+        segment = order[start:end]
+        lo1, hi1 = extent(start, end)
+        lo2, hi2 = extent(dest, dest)
+        if lo2 < hi1 and lo1 < hi2:
+            lo, hi = min(lo1, lo2), max(hi1, hi2)
+            if dest < start:
+                new_order = order[lo:dest] + segment + order[dest:start]
+            else:
+                new_order = order[lo:start] + order[end:dest] + segment
+            new_order.extend(order[max(end, dest):hi])
+            old_cost = cost(lo, hi)
+            new_cost = cost(lo, hi, new_order)
+        else:
+            old_cost = cost(lo1, hi1) + cost(lo2, hi2)
+            new_cost = cost(lo1, hi1, order[lo1:start] + order[end:hi1])
+            new_cost += cost(lo2, hi2, order[lo2:dest] + segment +
+                             order[dest:hi2])
+        if new_cost >= old_cost:
+            return False
+        if dest < start:
+            order[dest:end] = segment + order[dest:start]
+        else:
+            order[start:dest] = order[end:dest] + segment
+        for pos in xrange(min(start, dest), max(end, dest)):
+            positions[order[pos]] = pos
+        return True
+
+    best_order = list(order)
+    best_length = final_compressed_length("function ".join(
+        functions[i] for i in order))
+    for _ in xrange(opts.refine):
+        positions = [0] * len(functions)
+        for pos, func in enumerate(order):
+            positions[func] = pos
+        for start in xrange(len(order)):
+            changed = False
+            for size in xrange(2, REFINE_MAX_REVERSE + 1):
+                if start + size > len(order):
+                    break
+                if try_reverse(start, start + size):
+                    changed = True
+                    break
+            for size in xrange(1, REFINE_MAX_MOVE + 1):
+                if changed or start + size > len(order):
+                    break
+                # Try putting the run after the neighbours of its first
+                # function, or before the neighbours of its last.
+                first, last = order[start], order[start + size - 1]
+                for func in index.nearest(first, REFINE_NEIGHBOURS):
+                    if try_move(start, start + size, positions[func] + 1):
+                        changed = True
+                        break
+                if changed:
+                    break
+                for func in index.nearest(last, REFINE_NEIGHBOURS):
+                    if try_move(start, start + size, positions[func]):
+                        changed = True
+                        break
+            if changed:
+                costs.clear()
+            if on_progress is not None:
+                on_progress(start + 1, len(order), "Refined")
+        length = final_compressed_length("function ".join(
+            functions[i] for i in order))
+        if length >= best_length:
+            break
+        best_order = list(order)
+        best_length = length
+    return best_order
+
+
+# The functions, as held by each worker process.  The main process also
+# holds them, to deal with small batches itself.
+
+_functions = None
+_compress_level = None
+
+# The number of compressed lengths of the runs of functions used as context
+# with --lookahead that are cached.  These only change when an end of the
+# output changes.
+
+MAX_CONTEXT_LENGTHS = 16
+
+
+def _init_worker(functions, compress_level):
+    global _functions, _compress_level
+    _functions = functions
+    _compress_level = compress_level
+
+
+def _get_compressed_lengths(indices):
+    return [len(zlib.compress(_functions[i], _compress_level))
+            for i in indices]
 
 
-def print_percent_complete(done, total):
+def _get_combined_lengths(pairs):
+    return [len(zlib.compress("".join(_functions[i] for i in run1 + run2),
+                              _compress_level))
+            for run1, run2 in pairs]
+
+
+def _get_signatures(indices):
+    return [minhash_signature(_functions[i]) for i in indices]
+
+
+class PairScorer(object):
+    """Scores pairs of functions, optionally using a pool of processes.
+
+    Each worker is started with its own copy of the functions, and the
+    compressed length of each individual function is calculated up front.
+    The workers only ever compress functions, and the scores are worked out
+    from their results in the main process.
+    """
+
+    def __init__(self, functions, compress_level, jobs=1):
+        self.pool = None
+        self.jobs = jobs
+        if jobs <= 0:
+            self.jobs = multiprocessing.cpu_count()
+        self.functions = functions
+        self.compress_level = compress_level
+        self.context_lengths = {}
+        if self.jobs > 1:
+            self.pool = multiprocessing.Pool(self.jobs, _init_worker,
+                                             (functions, compress_level))
+        # Note that functions[0] is leading whitespace, not a real function.
+        self.lengths = [0]
+        self.lengths.extend(self.map(_get_compressed_lengths,
+                                     range(1, len(functions))))
+
+    def _batches(self, items):
+        num_batches = self.jobs * BATCHES_PER_JOB
+        size = max((len(items) + num_batches - 1) // num_batches, 1)
+        return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+    def map(self, func, items):
+        """Call func on batches of the items, and join up the results.
+
+        The batches are handed to the workers if there are enough items,
+        and otherwise func is called on all of them in this process.
+        """
+        if self.pool is None or len(items) < MIN_PARALLEL_ITEMS:
+            _init_worker(self.functions, self.compress_level)
+            return func(items)
+        results = []
+        for batch in self.pool.map(func, self._batches(items)):
+            results.extend(batch)
+        return results
+
+    def run_length(self, run):
+        """Get the compressed length of a run of functions."""
+        if len(run) == 1:
+            return self.lengths[run[0]]
+        length = self.context_lengths.get(run)
+        if length is None:
+            if len(self.context_lengths) >= MAX_CONTEXT_LENGTHS:
+                self.context_lengths.clear()
+            text = "".join(self.functions[i] for i in run)
+            length = len(zlib.compress(text, self.compress_level))
+            self.context_lengths[run] = length
+        return length
+
+    def score_pairs(self, pairs):
+        """Score each (run1, run2) pair, for run2 immediately following run1.
+
+        Each run is a tuple of function indices.  We judge the utility of
+        having run1 followed by run2 by the difference between their
+        individual compressed sizes, and their size when compressed
+        together.  Smaller values are better.
+        """
+        combined = self.map(_get_combined_lengths, pairs)
+        return [length - self.run_length(run1) - self.run_length(run2)
+                for (run1, run2), length in zip(pairs, combined)]
+
+    def minhash_signatures(self):
+        """Compute the signature of each function, for a SketchIndex."""
+        return self.map(_get_signatures, range(1, len(self.functions)))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+def minhash_signature(text, size=SKETCH_SIZE, shingle_size=SHINGLE_SIZE):
+    """Compute a MinHash signature of the set of shingles in text.
+
+    This uses one-permutation hashing: each shingle is hashed just once, the
+    hash space is split into `size` equal bins, and the signature gives the
+    smallest hash in each bin relative to the start of the bin.  Empty bins
+    borrow the value of the next non-empty bin, offset by the distance to
+    it, so that the signatures of small functions remain comparable.
+    """
+    crc32 = zlib.crc32
+    last = max(len(text) - shingle_size + 1, 1)
+    hashes = sorted(set(crc32(text[i:i + shingle_size]) & 0xFFFFFFFF
+                        for i in xrange(last)))
+    bin_width = (1 << 32) // size
+    signature = [None] * size
+    pos = 0
+    for j in xrange(size):
+        pos = bisect_left(hashes, j * bin_width, pos)
+        if pos < len(hashes) and hashes[pos] < (j + 1) * bin_width:
+            signature[j] = hashes[pos] - j * bin_width
+    filled = [j for j in xrange(size) if signature[j] is not None]
+    for j in xrange(size):
+        if signature[j] is None:
+            k = filled[bisect_left(filled, j) % len(filled)]
+            signature[j] = signature[k] + ((k - j) % size) * bin_width
+    return signature
+
+
+class SketchIndex(object):
+    """Locality-sensitive hash index of function signatures.
+
+    Each signature is split into bands, and functions are bucketed by the
+    hash of each band, so that similar functions are likely to share at
+    least one bucket.  Functions are removed once they've been placed.
+    The signatures of texts[first:] may be given if they've already been
+    computed, e.g. by PairScorer.minhash_signatures.
+    """
+
+    def __init__(self, texts, first=0, band_size=SKETCH_BAND_SIZE,
+                 signatures=None):
+        self.band_size = band_size
+        if signatures is None:
+            signatures = [minhash_signature(texts[i])
+                          for i in xrange(first, len(texts))]
+        self.signatures = [None] * first + list(signatures)
+        buckets = {}
+        for i in xrange(first, len(texts)):
+            for key in self.band_keys(i):
+                buckets.setdefault(key, []).append(i)
+        # A function that is alone in a bucket has no neighbours there,
+        # so only the shared buckets need to be kept.
+        self.buckets = {}
+        for key, funcs in buckets.iteritems():
+            if len(funcs) > 1:
+                self.buckets[key] = set(funcs)
+
+    def band_keys(self, i):
+        signature = self.signatures[i]
+        return [hash((j,) + tuple(signature[j:j + self.band_size]))
+                for j in xrange(0, len(signature), self.band_size)]
+
+    def remove(self, i):
+        for key in self.band_keys(i):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(i)
+                if not bucket:
+                    del self.buckets[key]
+
+    def similarity(self, i, j):
+        """Estimate the Jaccard similarity of two functions' shingles."""
+        sig1 = self.signatures[i]
+        sig2 = self.signatures[j]
+        matches = sum(1 for a, b in zip(sig1, sig2) if a == b)
+        return float(matches) / len(sig1)
+
+    def nearest(self, i, count, accept=None):
+        """Find up to count of the indexed functions most similar to i.
+
+        Functions are ranked first by the number of buckets that they share
+        with i, and the best few by their estimated similarity.  Only those
+        for which `accept` returns true are considered, if it's given.
+        """
+        shared = {}
+        for key in self.band_keys(i):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                continue
+            for j in islice(bucket, MAX_BUCKET_SCAN):
+                if j != i and (accept is None or accept(j)):
+                    shared[j] = shared.get(j, 0) + 1
+        ranked = sorted(shared, key=lambda j: (-shared[j], j))[:count * 4]
+        ranked.sort(key=lambda j: (-self.similarity(i, j), j))
+        return ranked[:count]
+
+
+def print_percent_complete(done, total, action="Cromulated"):
     """Display simple textual progress indicator on stdout."""
     perc = 100.0 * done / total
-    status = "\rCromulated {:d} of {:d} functions ({:.1f}%)"
-    sys.stdout.write(status.format(done, total, perc))
+    status = "\r{} {:d} of {:d} functions ({:.1f}%)"
+    sys.stdout.write(status.format(action, done, total, perc))
     sys.stdout.flush()
 
 
-def main(args=None):
+def make_option_parser():
+    """Make the parser for our command-line options.
+
+    This is shared with other tools that run cromulate, so that they can
+    take the same options.
+    """
     usage = "usage: %prog [options] [file ...]"
     descr = "Improve compressibility of emscripten-generated javascript"
     parser = optparse.OptionParser(usage=usage, description=descr)
@@ -128,12 +881,38 @@ def main(args=None):
     parser.add_option("-l", "--compress-level", type=int, default=9,
                       metavar="N",
                       help="zlib compress level used when comparing functions")
+    parser.add_option("-k", "--sketch", action="store_true",
+                      help="shortlist candidates using similarity sketches")
+    parser.add_option("--shortlist", type=int, default=SHORTLIST_SIZE,
+                      metavar="N",
+                      help="number of sketch neighbours scored at each end")
+    parser.add_option("-a", "--lookahead", type=int, default=1, metavar="N",
+                      help="score against N functions at each end")
+    parser.add_option("-r", "--refine", type=int, default=0, metavar="N",
+                      help="make up to N passes of local search")
+    parser.add_option("--refine-context", type=int, default=REFINE_CONTEXT,
+                      metavar="BYTES",
+                      help="bytes of context used to judge each change")
+    parser.add_option("-p", "--previous", metavar="FILE",
+                      help="keep the order of unchanged functions in FILE")
+    parser.add_option("-o", "--save-order", metavar="FILE",
+                      help="write the order of the functions to FILE")
+    parser.add_option("-P", "--profile", metavar="FILE",
+                      help="put the functions named in FILE first")
+    parser.add_option("-j", "--jobs", type=int, default=1, metavar="N",
+                      help="number of processes used for scoring (0 for all)")
     parser.add_option("-c", "--stdout", action="store_true",
                       help="write output to stdout")
     parser.add_option("-q", "--quiet", action="store_true",
                       help="supress printing of progress messages")
+    return parser
 
+
+def main(args=None):
+    parser = make_option_parser()
     opts, files = parser.parse_args(args)
+    if len(files) > 1 and (opts.previous or opts.save_order):
+        parser.error("--previous and --save-order need a single file")
     if not files:
         files = [sys.stdin]
         opts.stdout = True
@@ -141,19 +920,23 @@ def main(args=None):
     else:
         files = [open(f, "r") for f in files]
 
-    on_progress = None
+    on_progress = on_report = None
     if not opts.quiet:
         on_progress = print_percent_complete
+        reports = []
+        on_report = reports.append
 
     for f in files:
-        output = cromulate(f, opts, on_progress)
+        output = cromulate(f, opts, on_progress, on_report)
         if not opts.quiet:
             sys.stdout.write("\n")
-        # XXX TODO: if we wanted to get really fancy, we could calculate
-        # the expected saving of the new ordering and then pass it through
-        # the cromulation again, iterating until we fail to improve the
-        # existing ordering in the file.  This would also guard against
-        # accidentally increasing the file size.
+            # Keep the report out of the way of the output.
+            for report in reports:
+                print_layout_report(report, sys.stderr if opts.stdout
+                                    else sys.stdout)
+            del reports[:]
+        if opts.save_order:
+            write_order(opts.save_order, output)
         if opts.stdout:
             sys.stdout.write(output)
         else:
@@ -0,0 +1,124 @@
+#
+#  Remove unreachable functions from emscripten-generated javascript.
+#
+#  A function in the asm module can only ever be called if the module
+#  exports it, if it appears in one of the FUNCTION_TABLE_* arrays used for
+#  indirect calls, or if it's called directly by another function that can
+#  be called.  This script builds the call graph from those references,
+#  starting from the exports and function tables, and removes every function
+#  that it doesn't reach.
+#
+#  The code is split up just as in fold_functions, and any identifier in a
+#  function that names another function counts as a call to it.  This errs
+#  on the side of keeping functions, e.g. if a local variable happens to
+#  share a name with a function.  Function tables are kept whole, since we
+#  can't know which of their entries will be called.
+#
+
+import os
+import sys
+import optparse
+import tempfile
+
+from cromulate import function_name
+from fold_functions import split_asm, join_asm, iter_identifiers
+
+
+def eliminate_dead_functions(data, on_remove=None):
+    """Remove unreachable functions from the code, returning the new code.
+
+    If on_remove is given, it's called with the name and size in bytes of
+    each function that was removed.
+    """
+    return join_asm(*eliminate_dead_parts(split_asm(data), on_remove))
+
+
+def eliminate_dead_parts(parts, on_remove=None):
+    """Remove unreachable functions from the parts returned by split_asm.
+
+    This is eliminate_dead_functions for callers that have already split up
+    the code, and returns the new parts.
+    """
+    pre_code, functions, asm_tail, post_code = parts
+    # Note that functions[0] is leading whitespace, not a real function.
+    bodies = {}
+    for func in functions[1:]:
+        bodies[function_name(func)] = func
+
+    # Walk the call graph from the exports and function tables.
+    reachable = set()
+    pending = [name for name in iter_identifiers(asm_tail) if name in bodies]
+    while pending:
+        name = pending.pop()
+        if name in reachable:
+            continue
+        reachable.add(name)
+        for callee in iter_identifiers(bodies[name]):
+            if callee in bodies and callee not in reachable:
+                pending.append(callee)
+
+    kept = [functions[0]]
+    for func in functions[1:]:
+        name = function_name(func)
+        if name in reachable:
+            kept.append(func)
+        elif on_remove is not None:
+            on_remove(name, len("function ") + len(func))
+    return pre_code, kept, asm_tail, post_code
+
+
+def main(args=None):
+    usage = "usage: %prog [options] [file ...]"
+    descr = "Remove unreachable functions from emscripten-generated javascript"
+    parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("-c", "--stdout", action="store_true",
+                      help="write output to stdout")
+    parser.add_option("-q", "--quiet", action="store_true",
+                      help="supress printing of the report")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="list each function that was removed")
+
+    opts, files = parser.parse_args(args)
+    if not files:
+        files = [sys.stdin]
+        opts.stdout = True
+        opts.quiet = True
+    else:
+        files = [open(f, "r") for f in files]
+
+    # Keep the report out of the way of the output.
+    report = sys.stderr if opts.stdout else sys.stdout
+
+    for f in files:
+        data = f.read()
+        removed = []
+        output = eliminate_dead_functions(data, lambda *r: removed.append(r))
+        if opts.verbose and not opts.quiet:
+            for name, size in sorted(removed, key=lambda r: (-r[1], r[0])):
+                report.write("%d %s\n" % (size, name))
+        if not opts.quiet:
+            report.write("%s: removed %d functions, saving %d bytes\n" % (
+                f.name, len(removed), len(data) - len(output)))
+        if opts.stdout:
+            sys.stdout.write(output)
+        else:
+            dirnm = os.path.dirname(f.name)
+            filenm = os.path.basename(f.name)
+            fd, tempnm = tempfile.mkstemp(dir=dirnm, prefix=filenm)
+            try:
+                os.write(fd, output)
+                os.close(fd)
+                os.rename(tempnm, f.name)
+            finally:
+                if os.path.exists(tempnm):
+                    os.unlink(tempnm)
+
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        exitcode = main()
+    except KeyboardInterrupt:
+        exitcode = 1
+    sys.exit(exitcode)
@@ -7,105 +7,381 @@
 #  to use a virtualized build environment, and gives us more fine-grained
 #  control over the loading of the memory data.
 #
-#  In a future iteration of this script, we will provide calling code with
-#  the opportunity to control loading of the memory initializer rather than
-#  have the compiled code load it automatically.  This could be helpful for
-#  e.g. downloading the initializer concurrently with compiling the script.
+#  Calling code can take control of loading the memory initializer by setting
+#  Module.loadMemoryInitializer to a function(url, onload, onerror, fallback),
+#  which must eventually pass the data to onload.  The `fallback` argument is
+#  the default loading function, taking the same first three arguments.  This
+#  lets the host page e.g. rebuild the initializer from a cached copy of an
+#  earlier release, or download it concurrently with compiling the script.
+#  The default loader also takes an optional fourth argument, a function that
+#  is called with each chunk of the file as it arrives if the loader streams
+#  it, in which case onload is passed an empty array.  Chunks may be reused
+#  once that function returns, so it must copy any that it wants to keep.
+#  Passing null to onload means that the heap is already initialized, as when
+#  it has been restored from a snapshot of another instance.
+#
+#  So that the host page can start that download before it has the script,
+#  the name of the memory file is also recorded under "memoryInitializer" in
+#  the artifacts.json manifest next to the script.
+#
+#  The source file is processed as a stream of chunks rather than being
+#  slurped into memory, and the allocated bytes are parsed directly into
+#  a bytearray that is written out in a single call at the end.  This works
+#  under both python2 and python3.
+#
+#  With the --sparse option the memory file contains only the non-zero
+#  segments of the initializer, prefixed by a table giving their offsets.
+#  Fresh heap memory is already zeroed, so the loader only needs to copy
+#  in those segments.  The format of the sparse file is:
+#
+#    [segment count][offset, length]*[segment data]*
+#
+#  Where the count, offsets and lengths are little-endian uint32 values and
+#  offsets are relative to Runtime.GLOBAL_BASE.
 #
 
 import os
-import sys
 import re
-import contextlib
-
-
-SOURCE_FILE = sys.argv[1]
-OUTPUT_FILE = SOURCE_FILE + ".new"
-MEMORY_FILE = SOURCE_FILE + ".mem"
+import sys
+import json
+import struct
+import optparse
 
-OUTPUT_FILEOBJ = open(OUTPUT_FILE, "w")
-MEMORY_FILEOBJ = open(MEMORY_FILE, "w")
 
-try:
-  with contextlib.nested(OUTPUT_FILEOBJ, MEMORY_FILEOBJ):
+# This regex locates memory allocations relative to Runtime.GLOBAL_BASE,
+# which AFAICT uniquely indicates inline memory-initializer data.  It
+# matches up to two sub-groups:
+#
+#  Group 1: the array of integers representing the allocated bytes
+#  Group 2: the offset of this allocation from GLOBAL_BASE
 
-    # Slurp in all of the input file.  Whatevz, memory usage...
+MEMORY_ALLOC_REGEX = re.compile(br'allocate\(\s*\[([0-9,\s]+)\],\s*"i8",\s*ALLOC_NONE,\s*Runtime.GLOBAL_BASE(\s*\+\s*[0-9e]+)?\);')
 
-    with open(SOURCE_FILE, "r") as f:
-        data = f.read().strip()
+# Any partial allocation at the end of a chunk must start with this prefix,
+# so we hold back everything from its last occurrence until more data arrives.
 
-    # This regex locates memory allocations relative to Runtime.GLOBAL_BASE,
-    # which AFAICT uniquely indicates inline memory-initializer data.  It 
-    # matches up to two sub-groups:
-    #
-    #  Group 1: the array of integers representing the allocated bytes
-    #  Group 2: the offset of this allocation from GLOBAL_BASE
+MEMORY_ALLOC_PREFIX = b"allocate("
 
-    MEMORY_ALLOC_REGEX = re.compile(r'allocate\(\s*\[([0-9,\s]+)\],\s*"i8",\s*ALLOC_NONE,\s*Runtime.GLOBAL_BASE(\s*\+\s*[0-9e]+)?\);')
+# The amount of data to read from the source file at a time.
 
-    # Find the first memory allocation.
-    # We're going to replace it with the definition of the
-    # async memory-initializer loader.
+CHUNK_SIZE = 1024 * 1024
 
-    match = MEMORY_ALLOC_REGEX.search(data)
-    if match is None:
-        raise ValueError("no global memory initialization found")
+# Emscripten doesn't output the memory-initializer-loading code if
+# there's no memory initializer, so we'll have to put it back.
+# It goes right before the final call to run().
 
-    OUTPUT_FILEOBJ.write(data[:match.start()])
-    OUTPUT_FILEOBJ.write("var memoryInitializer=\"")
-    OUTPUT_FILEOBJ.write(os.path.basename(MEMORY_FILE))
-    OUTPUT_FILEOBJ.write("\";")
-
-    # Iterate over all memory allocations, writing each byte into the separate
-    # memory file.  They are ommitted from the source file.
-
-    for i, match in enumerate(MEMORY_ALLOC_REGEX.finditer(data)):
-        # Ensure we write at the correct offset.  The memory initializer
-        # data can have gaps if there are chunks of zeros in it.
-        # Note that offset may be encoded like 123e4
-        offset = match.group(2)
-        if offset is not None:
-            idx = offset.find("e")
-            if idx == -1:
-                offset = int(offset)
-            else:
-                offset = int(offset[:idx]) * (10 ** int(offset[idx+1:]))
-            MEMORY_FILEOBJ.seek(offset)
-        for byte in match.group(1).split(","):
-            MEMORY_FILEOBJ.write(chr(int(byte.strip())))
-
-    # Emscripten doesn't output the memory-initializer-loading code if
-    # there's no memory initializer, so we'll have to put it back.
-    # It goes right before the final call to run().
-
-    FINAL_POSTAMBLE = "run()"
-    if data.endswith(";"):
-        FINAL_POSTAMBLE = "\n" + FINAL_POSTAMBLE + ";"
-    assert data.endswith("}" + FINAL_POSTAMBLE)
-
-    OUTPUT_FILEOBJ.write(data[match.end():-len(FINAL_POSTAMBLE)])
-    OUTPUT_FILEOBJ.write("""
+MEMORY_LOADER_CODE = b"""
         memoryInitializer = Module['memoryInitializerPrefixURL'] + memoryInitializer;
-        if (ENVIRONMENT_IS_NODE || ENVIRONMENT_IS_SHELL) {
+        if (!Module['loadMemoryInitializer'] && (ENVIRONMENT_IS_NODE || ENVIRONMENT_IS_SHELL)) {
           var data = Module['readBinary'](memoryInitializer);
           HEAPU8.set(data, Runtime.GLOBAL_BASE);
         } else {
           addRunDependency('memory initializer');
           var applyMemoryInitializer = function(data) {
-            if (data.byteLength) data = new Uint8Array(data);
-            HEAPU8.set(data, Runtime.GLOBAL_BASE);
+            if (data) {
+              if (data.byteLength) data = new Uint8Array(data);
+              HEAPU8.set(data, Runtime.GLOBAL_BASE);
+            }
             removeRunDependency('memory initializer');
           }
-          Browser.asyncLoad(memoryInitializer, applyMemoryInitializer, function() {
+          var loadMemoryInitializer = function(url, onload, onerror, onchunk) {
+            if (ENVIRONMENT_IS_NODE || ENVIRONMENT_IS_SHELL) {
+              onload(Module['readBinary'](url));
+            } else {
+              Browser.asyncLoad(url, onload, onerror);
+            }
+          };
+          (Module['loadMemoryInitializer'] || loadMemoryInitializer)(memoryInitializer, applyMemoryInitializer, function() {
             throw 'could not load memory initializer ' + memoryInitializer;
-          });
+          }, loadMemoryInitializer);
         }
-    """)
-    OUTPUT_FILEOBJ.write(FINAL_POSTAMBLE)
-
-except BaseException:
-    os.unlink(OUTPUT_FILE)
-    os.unlink(MEMORY_FILE)
-    raise
-else:
-    os.rename(OUTPUT_FILE, SOURCE_FILE)
+    """
+
+# In sparse mode the data is applied segment-by-segment using this function,
+# rather than being copied in whole with HEAPU8.set().
+
+DENSE_APPLY_CODE = b"HEAPU8.set(data, Runtime.GLOBAL_BASE)"
+SPARSE_APPLY_CODE = b"applyMemorySegments(data, Runtime.GLOBAL_BASE)"
+
+SPARSE_LOADER_CODE = b"""
+        var applyMemorySegments = function(data, base) {
+          var u32 = function(i) {
+            return (data[i] | (data[i+1] << 8) | (data[i+2] << 16) | (data[i+3] << 24)) >>> 0;
+          };
+          var count = u32(0);
+          var pos = 4 + count * 8;
+          for (var i = 0; i < count; i++) {
+            var offset = u32(4 + i * 8);
+            var length = u32(8 + i * 8);
+            HEAPU8.set(data.subarray(pos, pos + length), base + offset);
+            pos += length;
+          }
+        };"""
+
+# The manifest describing the release artifacts, which lives in the same
+# directory as the compiled script.
+
+MANIFEST_NAME = "artifacts.json"
+
+# Runs of zeros shorter than this are left inside a segment, since each
+# entry in the segment table costs eight bytes.
+
+MIN_SEGMENT_GAP = 32
+
+
+def extract_memory_initializer(source_filename, sparse=False,
+                               min_gap=MIN_SEGMENT_GAP):
+    output_filename = source_filename + ".new"
+    memory_filename = source_filename + ".mem"
+
+    try:
+        with open(source_filename, "rb") as source_file:
+            with open(output_filename, "wb") as output_file:
+                memdata = extract_memory_data(
+                    source_file, output_file,
+                    os.path.basename(memory_filename),
+                    sparse,
+                )
+        if sparse:
+            segments = find_segments(memdata, min_gap)
+            memdata = encode_segment_table(memdata, segments)
+        with open(memory_filename, "wb") as memory_file:
+            memory_file.write(memdata)
+    except BaseException:
+        for filename in (output_filename, memory_filename):
+            if os.path.exists(filename):
+                os.unlink(filename)
+        raise
+    else:
+        os.rename(output_filename, source_filename)
+    update_manifest(os.path.dirname(source_filename),
+                    memoryInitializer=os.path.basename(memory_filename))
+
+
+def update_manifest(directory, **items):
+    """Set top-level items in the artifacts.json manifest in directory.
+
+    The manifest is created if it doesn't exist, and any other items
+    already in it are left alone.
+    """
+    manifest_filename = os.path.join(directory, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    manifest.update(items)
+    with open(manifest_filename + ".new", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.rename(manifest_filename + ".new", manifest_filename)
+
+
+def extract_memory_data(source_file, output_file, memory_basename,
+                        sparse=False):
+    """Copy source to output, pulling out inline memory allocations.
+
+    The source is read in chunks of CHUNK_SIZE bytes.  Any text that cannot
+    be part of a memory allocation is written straight through to the output
+    file, the first allocation is replaced with a declaration naming the
+    external memory file, and the allocated bytes are collected into a
+    bytearray which is returned to the caller.  If `sparse` is true then
+    the emitted loader expects a memory file with a segment table.
+    """
+    memdata = bytearray()
+    memsize = 0
+    pos = 0
+    found = False
+    # Text between two allocations is dropped, so hold on to
+    # it until we know whether another allocation follows.
+    between = []
+    buf = source_file.read(CHUNK_SIZE).lstrip()
+    while True:
+        chunk = source_file.read(CHUNK_SIZE)
+        end = 0
+        for match in MEMORY_ALLOC_REGEX.finditer(buf):
+            if not found:
+                found = True
+                output_file.write(buf[:match.start()])
+                output_file.write(b"var memoryInitializer=\"")
+                output_file.write(memory_basename.encode("ascii"))
+                output_file.write(b"\";")
+            del between[:]
+            pos = copy_allocation(memdata, match, pos)
+            memsize = max(memsize, pos)
+            end = match.end()
+        if not chunk:
+            break
+        # Hold back anything that might be the start of an allocation that
+        # straddles the chunk boundary.  An allocation contains no semicolon
+        # until its very end, so one that has seen a semicolon is complete.
+        hold = buf.rfind(MEMORY_ALLOC_PREFIX, end)
+        if hold == -1 or buf.find(b";", hold) != -1:
+            hold = max(end, len(buf) - len(MEMORY_ALLOC_PREFIX))
+        if not found:
+            output_file.write(buf[end:hold])
+        else:
+            between.append(buf[end:hold])
+        buf = buf[hold:] + chunk
+
+    if not found:
+        raise ValueError("no global memory initialization found")
+
+    # Everything after the last allocation goes back into the output,
+    # with the memory-initializer-loading code added to it.
+    tail = b"".join(between) + buf[end:].rstrip()
+    output_file.write(add_memory_loader(tail, sparse))
+
+    del memdata[memsize:]
+    return memdata
+
+
+def extract_allocations(code, memory_basename):
+    """Pull the inline memory allocations out of a string of code.
+
+    This is the in-memory equivalent of extract_memory_data, for callers
+    that already have the code.  It returns a two-tuple (code, memdata)
+    giving the code with the first allocation replaced by a declaration
+    naming the external memory file and the rest removed, and the bytes
+    that were allocated.  The memory-initializer-loading code must be
+    added separately by add_memory_loader.
+    """
+    memdata = bytearray()
+    memsize = 0
+    pos = 0
+    first = last = None
+    for match in MEMORY_ALLOC_REGEX.finditer(code):
+        if first is None:
+            first = match
+        last = match
+        pos = copy_allocation(memdata, match, pos)
+        memsize = max(memsize, pos)
+    if first is None:
+        raise ValueError("no global memory initialization found")
+    code = b"".join((
+        code[:first.start()],
+        b"var memoryInitializer=\"",
+        memory_basename.encode("ascii"),
+        b"\";",
+        code[last.end():],
+    ))
+    del memdata[memsize:]
+    return code, memdata
+
+
+def copy_allocation(memdata, match, pos):
+    """Copy the bytes of an allocation into memdata, returning its end.
+
+    The memory initializer data can have gaps if there are chunks of zeros
+    in it, so each allocation is written at its own offset, which defaults
+    to pos.  The bytearray grows geometrically so that repeated appends stay
+    cheap, and may end up longer than the allocated data.
+    """
+    offset = parse_offset(match.group(2), pos)
+    values = bytearray(map(int, match.group(1).split(b",")))
+    end = offset + len(values)
+    if end > len(memdata):
+        memdata.extend(b"\x00" * max(end - len(memdata), len(memdata) // 2))
+    memdata[offset:end] = values
+    return end
+
+
+def add_memory_loader(code, sparse=False):
+    """Add the memory-initializer-loading code to the end of the code.
+
+    It goes right before the final call to run(), which must end the code.
+    If `sparse` is true then the loader expects a memory file with a
+    segment table.
+    """
+    final_postamble = b"run()"
+    if code.endswith(b";"):
+        final_postamble = b"\n" + final_postamble + b";"
+    assert code.endswith(b"}" + final_postamble)
+    loader = MEMORY_LOADER_CODE
+    if sparse:
+        loader = SPARSE_LOADER_CODE + MEMORY_LOADER_CODE.replace(
+            DENSE_APPLY_CODE, SPARSE_APPLY_CODE)
+    return code[:-len(final_postamble)] + loader + final_postamble
+
+
+def parse_offset(offset, default):
+    """Parse the offset of an allocation from GLOBAL_BASE.
+
+    Allocations without an explicit offset continue on directly from the
+    previous one.  Note that offset may be encoded like 123e4.
+    """
+    if offset is None:
+        return default
+    offset = offset.strip().lstrip(b"+").strip()
+    idx = offset.find(b"e")
+    if idx == -1:
+        return int(offset)
+    return int(offset[:idx]) * (10 ** int(offset[idx+1:]))
+
+
+def find_segments(memdata, min_gap=MIN_SEGMENT_GAP):
+    """Find the non-zero segments of a memory image.
+
+    This returns a list of (offset, length) pairs covering all the non-zero
+    bytes in the image.  Leading and trailing zeros are always omitted, while
+    runs of zeros between segments must be at least `min_gap` bytes long.
+    """
+    gap_re = re.compile(b"\\x00{%d,}" % (max(min_gap, 1),))
+    start = len(memdata) - len(memdata.lstrip(b"\x00"))
+    end = len(memdata.rstrip(b"\x00"))
+    segments = []
+    for match in gap_re.finditer(memdata, start, end):
+        segments.append((start, match.start() - start))
+        start = match.end()
+    if start < end:
+        segments.append((start, end - start))
+    return segments
+
+
+def encode_segment_table(memdata, segments):
+    """Encode the given segments of a memory image in sparse format."""
+    output = bytearray(struct.pack("<I", len(segments)))
+    for offset, length in segments:
+        output.extend(struct.pack("<II", offset, length))
+    for offset, length in segments:
+        output.extend(memdata[offset:offset + length])
+    return output
+
+
+def decode_segment_table(data):
+    """Decode a sparse-format memory file.
+
+    This returns a two-tuple (memdata, segments) giving the equivalent dense
+    memory image and the list of (offset, length) segments from the table.
+    """
+    count, = struct.unpack_from("<I", data, 0)
+    segments = []
+    for i in range(count):
+        segments.append(struct.unpack_from("<II", data, 4 + i * 8))
+    memdata = bytearray()
+    pos = 4 + count * 8
+    for offset, length in segments:
+        if offset > len(memdata):
+            memdata.extend(b"\x00" * (offset - len(memdata)))
+        memdata[offset:offset + length] = data[pos:pos + length]
+        pos += length
+    return memdata, segments
+
+
+def main(args=None):
+    usage = "usage: %prog [options] file"
+    descr = "Extract inline memory initializer from emscripten-compiled file"
+    parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("-s", "--sparse", action="store_true",
+                      help="write only non-zero segments, with a segment table")
+    parser.add_option("-g", "--min-gap", type=int, default=MIN_SEGMENT_GAP,
+                      metavar="N",
+                      help="minimum run of zeros that splits a segment")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("expected a single file argument")
+    extract_memory_initializer(args[0], opts.sparse, opts.min_gap)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,231 @@
+#
+#  Fold identical functions in emscripten-generated javascript.
+#
+#  RPython specializes functions for each of the types that they are used
+#  with, which often produces several asmjs functions whose code is exactly
+#  the same apart from their name.  This script keeps just the first copy of
+#  each such function, and points every call, function-table entry and
+#  export of the others at it.  Two functions are identical if their code
+#  matches once their own names (e.g. in recursive calls) are ignored.
+#  Folding some functions makes their callers use the same names, so they
+#  may in turn become identical, and we repeat until nothing more folds.
+#
+#  Like cromulate, we don't have to actually *parse* the code.  It's enough
+#  to split it into functions, and to find the identifiers within them.
+#  The function tables and exports follow the functions, up to the
+#  EMSCRIPTEN_END_ASM marker, and the only other references to functions
+#  are string keys in the code outside the asm module, which don't change.
+#  Export keys are left alone, so the folded functions are still exported
+#  under their original names.
+#
+#  Minified code may reuse the name of a function for a parameter or local
+#  of another function.  Those locals are never renamed, and a function is
+#  not folded into one whose name is a local of any function that calls it,
+#  since the call would then refer to the local instead.
+#
+
+import os
+import re
+import sys
+import optparse
+import tempfile
+
+from cromulate import MARKER_START_FUNCS, MARKER_END_FUNCS, split_functions, \
+                      function_name
+from analyze_code_size import PARAMS_RE, VAR_RE
+
+MARKER_END_ASM = "// EMSCRIPTEN_END_ASM"
+
+# Matches each identifier in the code, and any colon that follows it, which
+# marks it as the key of an export rather than a reference to a function.
+# Numbers are matched too, so that e.g. the tail of 0x1f isn't mistaken for
+# an identifier.
+
+IDENTIFIER_RE = re.compile(r"\d[\w.]*|(?P<name>[a-zA-Z_$][\w$]*)(?P<key>\s*:)?")
+
+
+def split_asm(data):
+    """Split the code into the parts that might refer to functions.
+
+    This returns a tuple (pre_code, functions, asm_tail, post_code), where
+    functions is as returned by cromulate.split_functions, and asm_tail is
+    the code between the functions and the end of the asm module.
+    """
+    pre_code, functions, post_code = split_functions(data)
+    if MARKER_END_ASM not in post_code:
+        raise ValueError("EMSCRIPTEN_END_ASM not found")
+    asm_tail, post_code = post_code.split(MARKER_END_ASM, 1)
+    return pre_code, functions, asm_tail, post_code
+
+
+def join_asm(pre_code, functions, asm_tail, post_code):
+    """Re-assemble the parts returned by split_asm."""
+    return "".join((
+        pre_code,
+        MARKER_START_FUNCS,
+        "function ".join(functions),
+        MARKER_END_FUNCS,
+        asm_tail,
+        MARKER_END_ASM,
+        post_code,
+    ))
+
+
+def iter_identifiers(code, keys=False):
+    """Generate each identifier in the code, optionally including keys."""
+    for match in IDENTIFIER_RE.finditer(code):
+        name = match.group("name")
+        if name is not None and (keys or match.group("key") is None):
+            yield name
+
+
+def rename_identifiers(code, renames, keys=False):
+    """Replace identifiers in the code according to a dict of renames.
+
+    Object keys such as the names of exports are only renamed if `keys`
+    is true.
+    """
+    def rename(match):
+        name = match.group("name")
+        if name is None or (match.group("key") is not None and not keys):
+            return match.group(0)
+        if name not in renames:
+            return match.group(0)
+        return renames[name] + (match.group("key") or "")
+    return IDENTIFIER_RE.sub(rename, code)
+
+
+def local_names(func):
+    """Get the set of the names of the parameters and locals of a function."""
+    names = set()
+    match = PARAMS_RE.match(func, len(function_name(func)))
+    if match is not None:
+        names.update(param.strip() for param in
+                     match.group("params").split(","))
+    for match in VAR_RE.finditer(func):
+        names.update(decl.partition("=")[0].strip() for decl in
+                     match.group("decls").split(","))
+    names.discard("")
+    return names
+
+
+def local_renames(renames, names):
+    """Leave the locals in `names` out of a dict of renames."""
+    if names.isdisjoint(renames):
+        return renames
+    return dict((name, renames[name]) for name in renames
+                if name not in names)
+
+
+def fold_functions(data, on_fold=None):
+    """Fold identical functions in the code, returning the new code.
+
+    If on_fold is given, it's called with the name of each folded function
+    and the name of the function that replaced it.
+    """
+    return join_asm(*fold_parts(split_asm(data), on_fold))
+
+
+def fold_parts(parts, on_fold=None):
+    """Fold identical functions in the parts returned by split_asm.
+
+    This is fold_functions for callers that have already split up the code,
+    and returns the new parts.
+    """
+    pre_code, functions, asm_tail, post_code = parts
+    # Note that functions[0] is leading whitespace, not a real function.
+    names = [None] + [function_name(func) for func in functions[1:]]
+    # Locals are never renamed, so these don't change as functions fold.
+    locals_ = [None] + [local_names(func) for func in functions[1:]]
+    renames = {}
+    while True:
+        folded = {}
+        canonical = {}
+        for name, func, local in zip(names[1:], functions[1:], locals_[1:]):
+            key = rename_identifiers(func, local_renames({name: "\0"}, local))
+            if key in canonical:
+                folded[name] = canonical[key]
+            else:
+                canonical[key] = name
+        # Don't fold a function into one whose name a caller uses for a
+        # local, or the call would end up referring to the local.
+        for func, local in zip(functions[1:], locals_[1:]):
+            if local.isdisjoint(folded.values()):
+                continue
+            for name in set(iter_identifiers(func)):
+                if name not in local and folded.get(name) in local:
+                    del folded[name]
+        if not folded:
+            break
+        for name in renames:
+            renames[name] = folded.get(renames[name], renames[name])
+        renames.update(folded)
+        kept = [0] + [i for i in xrange(1, len(functions))
+                      if names[i] not in folded]
+        functions = [functions[0]] + [
+            rename_identifiers(functions[i], local_renames(folded, locals_[i]))
+            for i in kept[1:]]
+        names = [names[i] for i in kept]
+        locals_ = [locals_[i] for i in kept]
+    if on_fold is not None:
+        for name in sorted(renames):
+            on_fold(name, renames[name])
+    asm_tail = rename_identifiers(asm_tail, renames)
+    return pre_code, functions, asm_tail, post_code
+
+
+def main(args=None):
+    usage = "usage: %prog [options] [file ...]"
+    descr = "Fold identical functions in emscripten-generated javascript"
+    parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("-c", "--stdout", action="store_true",
+                      help="write output to stdout")
+    parser.add_option("-q", "--quiet", action="store_true",
+                      help="supress printing of the report")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="list each function that was folded")
+
+    opts, files = parser.parse_args(args)
+    if not files:
+        files = [sys.stdin]
+        opts.stdout = True
+        opts.quiet = True
+    else:
+        files = [open(f, "r") for f in files]
+
+    # Keep the report out of the way of the output.
+    report = sys.stderr if opts.stdout else sys.stdout
+
+    for f in files:
+        data = f.read()
+        folds = []
+        output = fold_functions(data, lambda *fold: folds.append(fold))
+        if opts.verbose and not opts.quiet:
+            for name, replacement in folds:
+                report.write("%s => %s\n" % (name, replacement))
+        if not opts.quiet:
+            report.write("%s: folded %d functions, saving %d bytes\n" % (
+                f.name, len(folds), len(data) - len(output)))
+        if opts.stdout:
+            sys.stdout.write(output)
+        else:
+            dirnm = os.path.dirname(f.name)
+            filenm = os.path.basename(f.name)
+            fd, tempnm = tempfile.mkstemp(dir=dirnm, prefix=filenm)
+            try:
+                os.write(fd, output)
+                os.close(fd)
+                os.rename(tempnm, f.name)
+            finally:
+                if os.path.exists(tempnm):
+                    os.unlink(tempnm)
+
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        exitcode = main()
+    except KeyboardInterrupt:
+        exitcode = 1
+    sys.exit(exitcode)
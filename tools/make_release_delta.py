@@ -0,0 +1,309 @@
+#
+#  Generate binary deltas between two releases of the pypyjs artifacts.
+#
+#  Every release changes the compiled VM script and its memory file, but
+#  usually only a small part of each one.  Rather than have returning users
+#  download the whole of every artifact again, this script produces a
+#  compact delta from each artifact in an old release to the corresponding
+#  artifact in a new release, which the loader in pypyjs.js can apply to its
+#  cached copy of the old artifact.
+#
+#  A delta is an LZ77-style description of the new artifact, where the old
+#  artifact acts as a preset dictionary that sits in front of the new data.
+#  Matches may therefore copy from anywhere in the old artifact or from the
+#  part of the new artifact that has already been produced.  Since the old
+#  artifact can be many megabytes in size, we don't use the dense hash chains
+#  of the memory-initializer compressor here.  Instead we index only every
+#  DELTA_BLOCK_SIZE'th position of the data, look up each position of the
+#  new artifact in that index, and extend any hit in both directions.  Long
+#  runs of unchanged data are thereby found at the cost of a single lookup.
+#  The compressed memory file is split into independently-compressed blocks,
+#  so a change to the memory image only perturbs the blocks that contain it.
+#
+#  The format of a delta file is:
+#
+#    "PJSD"[source size][target size][operation]*
+#
+#  Where the sizes are unsigned LEB128 varints, and each operation starts
+#  with a varint whose low bit gives its kind and whose remaining bits give
+#  its length.  An insert operation (low bit 0) is followed by that many
+#  bytes of literal data.  A copy operation (low bit 1) is followed by a
+#  zigzag-encoded varint giving the start of the copy, relative to the end
+#  of the previous copy, as an offset into the old artifact concatenated with
+#  the new one.  Consecutive copies from an unchanged part of the artifact
+#  thus need only a byte or two.  The deltas are not otherwise compressed,
+#  since the web server will typically gzip them on the way out.
+#
+#  Alongside the deltas, this script maintains the artifacts.json manifest
+#  in the new release directory, under its "artifacts" key, leaving any other
+#  items in the manifest alone.  It gives the size and sha1 hash of each
+#  artifact in the release, and maps the sha1 hash of each older version for
+#  which a delta is available to the path of that delta.  The loader checks
+#  the hash of every artifact that it rebuilds from a delta, falling back to
+#  downloading the artifact in full if anything doesn't match.  The script
+#  may be run several times against different old releases, to accumulate
+#  deltas from each of them.
+#
+
+import os
+import sys
+import json
+import zlib
+import hashlib
+import optparse
+from array import array
+
+from extract_memory_initializer import MANIFEST_NAME
+from compress_memory_initializer import match_length
+
+
+# The artifacts for which we generate deltas, relative to the release's
+# lib directory.  Those that don't exist in both releases are skipped.
+
+DEFAULT_ARTIFACTS = (
+    "pypyjs.vm.js",
+    "pypyjs.vm.js.zmem",
+    "pypyjs.vm.js.mem",
+)
+
+DELTA_DIR_NAME = "deltas"
+DELTA_MAGIC = b"PJSD"
+
+# Positions are indexed every DELTA_BLOCK_SIZE bytes, keyed by a hash of the
+# DELTA_BLOCK_SIZE bytes that follow.  Any run of matching data that's at
+# least twice this long is guaranteed to be found.
+
+DELTA_BLOCK_SIZE = 16
+DELTA_HASH_BITS = 22
+
+# Copies shorter than this are emitted as inserts instead, since they
+# probably cost more to describe than the bytes that they would save.
+
+MIN_COPY_LENGTH = 8
+
+INSERT_OP = 0
+COPY_OP = 1
+
+
+def make_release_delta(old_dir, new_dir, artifacts=DEFAULT_ARTIFACTS,
+                       block_size=DELTA_BLOCK_SIZE, report=False):
+    """Generate deltas from the artifacts in old_dir to those in new_dir.
+
+    The deltas are written into a subdirectory of new_dir, and the manifest
+    in new_dir is updated to describe them.  Each delta is checked by
+    applying it before the manifest is written.
+    """
+    manifest_filename = os.path.join(new_dir, MANIFEST_NAME)
+    manifest = {"artifacts": {}}
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    entries = manifest.setdefault("artifacts", {})
+
+    for name in artifacts:
+        new_filename = os.path.join(new_dir, name)
+        if not os.path.exists(new_filename):
+            entries.pop(name, None)
+            continue
+        target = read_file(new_filename)
+        target_sha1 = hashlib.sha1(target).hexdigest()
+        entry = entries.get(name)
+        if entry is None or entry.get("sha1") != target_sha1:
+            entry = entries[name] = {"deltas": {}}
+        entry["sha1"] = target_sha1
+        entry["size"] = len(target)
+
+        old_filename = os.path.join(old_dir, name)
+        if not os.path.exists(old_filename):
+            continue
+        source = read_file(old_filename)
+        source_sha1 = hashlib.sha1(source).hexdigest()
+        if source_sha1 == target_sha1:
+            continue
+        delta = make_delta(source, target, block_size)
+        if apply_delta(source, delta) != target:
+            raise ValueError("delta for %s does not reproduce it" % (name,))
+        delta_path = "%s/%s.%s.delta" % (DELTA_DIR_NAME, name, source_sha1[:16])
+        delta_filename = os.path.join(new_dir, *delta_path.split("/"))
+        if not os.path.isdir(os.path.dirname(delta_filename)):
+            os.makedirs(os.path.dirname(delta_filename))
+        with open(delta_filename, "wb") as delta_file:
+            delta_file.write(delta)
+        entry["deltas"][source_sha1] = delta_path
+        if report:
+            print("%s: %d => %d bytes, delta %d bytes (%d gzipped)" % (
+                name, len(source), len(target), len(delta),
+                len(zlib.compress(bytes(delta), 9)),
+            ))
+
+    with open(manifest_filename + ".new", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.rename(manifest_filename + ".new", manifest_filename)
+
+
+def read_file(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+def make_delta(source, target, block_size=DELTA_BLOCK_SIZE):
+    """Generate a delta that produces target when applied to source."""
+    output = bytearray(DELTA_MAGIC)
+    write_varint(output, len(source))
+    write_varint(output, len(target))
+    base = len(source)
+    data = bytes(source) + bytes(target)
+    last_copy_end = 0
+    insert_start = base
+    for start, length, copy_start in find_delta_copies(data, base, block_size):
+        if insert_start < start:
+            write_varint(output, ((start - insert_start) << 1) | INSERT_OP)
+            output.extend(data[insert_start:start])
+        write_varint(output, (length << 1) | COPY_OP)
+        write_varint(output, zigzag(copy_start - last_copy_end))
+        last_copy_end = copy_start + length
+        insert_start = start + length
+    if insert_start < len(data):
+        write_varint(output, ((len(data) - insert_start) << 1) | INSERT_OP)
+        output.extend(data[insert_start:])
+    return output
+
+
+def find_delta_copies(data, base, block_size=DELTA_BLOCK_SIZE,
+                      min_length=MIN_COPY_LENGTH):
+    """Find copies that produce data[base:] from the data preceding it.
+
+    This generates three-tuples (start, length, copy_start) in increasing
+    order of start, where data[start:start + length] is a copy of the
+    (possibly overlapping) data[copy_start:copy_start + length].  Positions
+    that are a multiple of block_size are added to the index as they are
+    passed, so the new data can also copy from earlier parts of itself.
+    """
+    n = len(data)
+    hash_mask = (1 << DELTA_HASH_BITS) - 1
+    index = array("i", [-1]) * (1 << DELTA_HASH_BITS)
+
+    def block_hash(pos):
+        return zlib.crc32(data[pos:pos + block_size]) & hash_mask
+
+    indexed = 0
+    for pos in range(0, base - block_size + 1, block_size):
+        index[block_hash(pos)] = pos
+        indexed = pos + block_size
+
+    insert_start = i = base
+    while i <= n - block_size:
+        # Index the data that's now behind us, so it can be copied.
+        while indexed <= i - block_size:
+            index[block_hash(indexed)] = indexed
+            indexed += block_size
+        cand = index[block_hash(i)]
+        if cand < 0 or data[cand:cand + block_size] != data[i:i + block_size]:
+            i += 1
+            continue
+        # Extend the match backwards into any pending insert, and forwards
+        # as far as it will go.
+        back = 0
+        while back < i - insert_start and back < cand and \
+              data[cand - back - 1] == data[i - back - 1]:
+            back += 1
+        length = match_length(data, cand, i, block_size, n - i)
+        start = i - back
+        length += back
+        if length >= min_length:
+            yield start, length, cand - back
+            insert_start = i = start + length
+        else:
+            i += 1
+
+
+def apply_delta(source, delta):
+    """Apply a delta to source, returning the resulting bytearray.
+
+    This is the reference for the loader code in pypyjs.js.
+    """
+    if bytes(delta[:len(DELTA_MAGIC)]) != DELTA_MAGIC:
+        raise ValueError("not a delta file")
+    delta = bytearray(delta)
+    pos = len(DELTA_MAGIC)
+    source_size, pos = read_varint(delta, pos)
+    target_size, pos = read_varint(delta, pos)
+    if source_size != len(source):
+        raise ValueError("delta is for a different source")
+    output = bytearray(source)
+    last_copy_end = 0
+    while pos < len(delta):
+        op, pos = read_varint(delta, pos)
+        length = op >> 1
+        if op & 1 == INSERT_OP:
+            output.extend(delta[pos:pos + length])
+            pos += length
+        else:
+            offset, pos = read_varint(delta, pos)
+            start = last_copy_end + unzigzag(offset)
+            if start < 0 or start >= len(output):
+                raise ValueError("corrupt delta file")
+            end = start + length
+            # The copy may overlap the data that it produces.
+            while start < end:
+                chunk = output[start:min(end, len(output))]
+                output.extend(chunk)
+                start += len(chunk)
+            last_copy_end = end
+    if len(output) != source_size + target_size:
+        raise ValueError("corrupt delta file")
+    return output[source_size:]
+
+
+def write_varint(output, value):
+    while value >= 0x80:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("corrupt delta file")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+def zigzag(value):
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def unzigzag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+def main(args=None):
+    usage = "usage: %prog [options] old_lib_dir new_lib_dir"
+    descr = "Generate binary deltas between two releases of pypyjs"
+    parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("-a", "--artifact", action="append", dest="artifacts",
+                      metavar="NAME",
+                      help="artifact to generate a delta for (repeatable)")
+    parser.add_option("-b", "--block-size", type=int,
+                      default=DELTA_BLOCK_SIZE, metavar="N",
+                      help="index every N bytes when searching for copies")
+    parser.add_option("-v", "--report", action="store_true",
+                      help="print the size of each delta")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error("expected old and new lib directory arguments")
+    make_release_delta(args[0], args[1], opts.artifacts or DEFAULT_ARTIFACTS,
+                       opts.block_size, opts.report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,668 @@
+#
+#  Outline blocks of code from oversized functions in emscripten-generated
+#  javascript.
+#
+#  A handful of huge functions dominate the time it takes to compile the asm
+#  module, and they're the ones behind OdinMonkey's "compiled slowly"
+#  warnings, since much of the work of compiling a function grows faster
+#  than its size.  This script finds each function that's bigger than a
+#  given size, or whose estimated compile cost from analyze_code_size is
+#  bigger than a given cost, and moves blocks of its code out into new
+#  helper functions until it's back under the limit.  Helpers that are
+#  themselves too big are split up in turn.
+#
+#  Any block of statements can be outlined, as long as it uses no float
+#  locals.  Each local that the block uses is passed to the helper as an
+#  argument.  An asmjs function can only return a single value, so each
+#  local that the block assigns to is passed back in a new global variable
+#  of the asm module, and copied back into the local after the call.  If
+#  control can leave the block other than by falling off its end, i.e. by a
+#  return, or by a break or continue that targets a loop, switch or label
+#  outside of it, the helper returns instead, and sets another global to
+#  tell the caller which of these to carry out.  The arms of the big switch
+#  statements produced by the relooper end by breaking out of the switch,
+#  so such a trailing break is simply left where it is and the rest of the
+#  arm is outlined.  Blocks that are smaller than the code that would
+#  replace them are left alone.
+#
+#  As in fold_functions, we don't have to parse the code properly.  Function
+#  bodies in asmjs contain no strings, regexps or object literals, so braces
+#  always delimit blocks, and a simple scan over the tokens of a block is
+#  enough to tell where control can leave it.
+#
+#  The --node and --js options compile the asm module before and after
+#  outlining, using node or a SpiderMonkey shell respectively, to report the
+#  difference in compile time.  This also checks that the shell still
+#  accepts the outlined module as asmjs, which is an error otherwise.
+#
+
+import os
+import re
+import sys
+import json
+import shutil
+import optparse
+import tempfile
+import subprocess
+
+from cromulate import split_functions, function_name
+from fold_functions import MARKER_END_ASM, split_asm, join_asm, \
+                           iter_identifiers
+from analyze_code_size import PARAMS_RE, VAR_RE, FunctionMetrics
+
+# Functions bigger than this are split up by default.  Blocks smaller than
+# MIN_BLOCK_SIZE aren't worth the cost of a call.
+
+DEFAULT_MAX_SIZE = 32 * 1024
+MIN_BLOCK_SIZE = 1024
+
+# Helpers are named after the function that they came from, and the globals
+# that pass back their results after the kind of the result: "i" for int,
+# "d" for double, or "x" for which way control left the helper.
+
+HELPER_NAME = "%s$outline%d"
+RESULT_NAME = "outline$%s%d"
+RESULT_RE = re.compile(
+    r"(?<![\w$])outline\$(?P<kind>[idx])(?P<index>\d+)(?![\w$])")
+RESULT_KINDS = (("i", "0"), ("d", "0.0"), ("x", "0"))
+
+TOKEN_RE = re.compile(r"[(){};]|\d[\w.]*|[a-zA-Z_$][\w$]*")
+IDENTIFIER_START_RE = re.compile(r"[a-zA-Z_$]")
+BLOCK_RE = re.compile(r"[{}]|(?<![\w$])switch(?![\w$])")
+LABEL_DEF_RE = re.compile(
+    r"(?:^|[{};])\s*(?!default\b)(?P<name>[a-zA-Z_$][\w$]*)\s*:(?!:)")
+ASSIGN_RE = re.compile(r"(?<![\w$.])(?P<name>[a-zA-Z_$][\w$]*)\s*=(?!=)")
+EXPRESSION_END_RE = re.compile(r"[()\[\];}]")
+STATEMENT_END_RE = re.compile(r"\s*;?")
+MODULE_PARAMS_RE = re.compile(r"function\s*\(\s*[\w$]+\s*,\s*(?P<env>[\w$]+)")
+TRAILING_BREAK_RE = re.compile(r"(?:^|(?<=[;{}]))\s*break\s*;?\s*$")
+INT_RE = re.compile(r"^-?(?:0x[0-9a-fA-F]+|\d+)$")
+DOUBLE_RE = re.compile(r"^(?:[-+]?\d*\.\d*(?:[eE][-+]?\d+)?|\+[-+]?\d+)$")
+
+LOOP_KINDS = ("loop", "do")
+BREAK_KINDS = ("loop", "do", "switch")
+
+# Compile times are measured by running each shell on MEASURE_CODE this
+# many times, in a fresh process each time so that no caching is involved.
+# Node compiles asmjs functions lazily unless told otherwise.
+
+REPEAT = 3
+HEAP_SIZE = 16 * 1024 * 1024
+NODE_FLAGS = ("--no-asm-wasm-lazy-compilation",)
+ASMJS_FAILURES = (
+    "Invalid asm.js",
+    "Linking failure in asm.js",
+    "asm.js type error",
+    "asm.js link error",
+)
+
+
+def outline_functions(data, max_size=DEFAULT_MAX_SIZE, max_cost=None,
+                      min_size=MIN_BLOCK_SIZE, on_outline=None):
+    """Outline blocks from oversized functions, returning the new code.
+
+    If on_outline is given, it's called with the name of the function that
+    each block came from, the name of its new helper, and the size of the
+    block in bytes.
+    """
+    return join_asm(*outline_parts(split_asm(data), max_size, max_cost,
+                                   min_size, on_outline))
+
+
+def outline_parts(parts, max_size=DEFAULT_MAX_SIZE, max_cost=None,
+                  min_size=MIN_BLOCK_SIZE, on_outline=None):
+    """Outline blocks from oversized functions in the parts from split_asm.
+
+    This is outline_functions for callers that have already split up the
+    code, and returns the new parts.
+    """
+    pre_code, functions, asm_tail, post_code = parts
+    # Note that functions[0] is leading whitespace, not a real function.
+    names = set(function_name(func) for func in functions[1:])
+    results = dict((kind, 0) for kind, _ in RESULT_KINDS)
+    reserved = {}
+
+    def target_size(func):
+        # The size to cut func down to, or None if it's small enough.
+        target = None
+        if len(func) > max_size:
+            target = max_size
+        if max_cost is not None:
+            name = function_name(func)
+            cost = FunctionMetrics(name, func[len(name):]).cost
+            if cost > max_cost:
+                target = min(target or len(func), len(func) * max_cost // cost)
+        return target
+
+    output = [functions[0]]
+    for func in functions[1:]:
+        # Helpers go after the function they came from, and are checked
+        # in turn once it's done.
+        pieces = [func]
+        i = 0
+        while i < len(pieces):
+            func = pieces[i]
+            target = target_size(func)
+            while target is not None:
+                name = function_name(func)
+                func, helpers = outline_blocks(func, target, names, reserved,
+                                               max_size, min_size)
+                if not helpers:
+                    break
+                for helper, helper_func, size, outputs in helpers:
+                    pieces.append(helper_func)
+                    for kind in results:
+                        results[kind] = max(results[kind], outputs[kind])
+                    if on_outline is not None:
+                        on_outline(name, helper, size)
+                target = target_size(func)
+            pieces[i] = func
+            i += 1
+        output.extend(pieces)
+
+    decls = []
+    for kind, init in RESULT_KINDS:
+        for i in xrange(results[kind]):
+            decls.append("%s=%s" % (RESULT_NAME % (kind, i), init))
+    if decls:
+        if pre_code and not pre_code.endswith("\n"):
+            pre_code += "\n"
+        pre_code += "var %s;\n" % (",".join(decls),)
+    return pre_code, output, asm_tail, post_code
+
+
+def outline_blocks(func, target, names, reserved, max_size=DEFAULT_MAX_SIZE,
+                   min_size=MIN_BLOCK_SIZE):
+    """Move blocks out of func into new helpers until it's target bytes.
+
+    The biggest blocks are moved first, preferring those no bigger than
+    max_size so that the helpers won't need splitting up themselves.  This
+    returns the new code for func and a list of tuples (helper, helper_func,
+    size, outputs), where outputs gives the number of globals of each kind
+    needed to pass back results.  The helper names are added to names, and
+    reserved maps each helper to the outputs that it and its callers need.
+    """
+    name = function_name(func)
+    body_start = func.index("{") + 1
+    body_end = func.rindex("}")
+    types = local_types(func, body_start, body_end)
+    # If func is a helper, its results may be set by code that has since
+    # been moved out of it, so we can't just look for them in its code.
+    used_results = dict(reserved.get(name) or
+                        ((kind, 0) for kind, _ in RESULT_KINDS))
+    for match in RESULT_RE.finditer(func):
+        kind = match.group("kind")
+        used_results[kind] = max(used_results[kind],
+                                 int(match.group("index")) + 1)
+    blocks = [block for block in find_blocks(func, body_start, body_end)
+              if block[1] - block[0] >= min_size]
+    blocks.sort(key=lambda block: block[0] - block[1])
+    blocks = [block for block in blocks if block[1] - block[0] <= max_size] + \
+             [block for block in blocks if block[1] - block[0] > max_size]
+
+    trailer = func[len(func.rstrip()):]
+    size = len(func)
+    chosen = []
+    helpers = []
+    for start, end in blocks:
+        if size <= target:
+            break
+        if any(start < e and s < end for s, e, _ in chosen):
+            continue
+        count = 0
+        while HELPER_NAME % (name, count) in names:
+            count += 1
+        helper = HELPER_NAME % (name, count)
+        outlined = outline_block(func[start:end], helper, types,
+                                 used_results)
+        if outlined is None:
+            continue
+        call, helper_func, outputs = outlined
+        names.add(helper)
+        reserved[helper] = outputs
+        chosen.append((start, end, call))
+        helpers.append((helper, helper_func + trailer, end - start, outputs))
+        size -= end - start - len(call)
+
+    for start, end, call in sorted(chosen, reverse=True):
+        func = func[:start] + call + func[end:]
+    return func, helpers
+
+
+def outline_block(block, helper, types, used_results):
+    """Turn a block of code into a helper function.
+
+    This returns a tuple (call, helper_func, outputs) giving the code that
+    replaces the block, the code of the helper, and the number of globals
+    of each kind needed to pass back results, or None if the block can't be
+    outlined or isn't worth outlining.  The helper only uses the globals
+    that come after those counted by used_results.
+    """
+    exits = find_exits(block)
+    if exits is None:
+        return None
+    used = []
+    for name in iter_identifiers(block, keys=True):
+        if name in types and name not in used:
+            used.append(name)
+    if any(types[name] is None for name in used):
+        return None
+
+    return_kinds = set(return_type(value) for exit, value, _, _ in exits
+                       if exit == "return")
+    if len(return_kinds) > 1 or None in return_kinds:
+        return None
+    return_kind = return_kinds.pop() if return_kinds else "v"
+
+    # Locals that the block assigns to are passed back in globals, as is
+    # the value of any return statement.  If the block is from a helper, it
+    # might set that helper's results before leaving it, so we mustn't use
+    # any of the globals that the helper does.
+    outputs = dict(used_results)
+
+    def result_name(kind):
+        outputs[kind] += 1
+        return RESULT_NAME % (kind, outputs[kind] - 1)
+
+    assigned = set(match.group("name") for match in ASSIGN_RE.finditer(block))
+    stores = []
+    loads = []
+    for name in used:
+        if name in assigned:
+            result = result_name(types[name])
+            stores.append("%s=%s;" % (result, name))
+            loads.append("%s=%s;" % (name, result))
+    stores = "".join(stores)
+    if return_kind != "v":
+        return_value = result_name(return_kind)
+    if exits:
+        exit_code = result_name("x")
+
+    # Each way out of the block is replaced by a return from the helper,
+    # which tells the caller where to go next.
+    codes = {}
+    code = []
+    pos = 0
+    for exit, value, start, end in exits:
+        if exit not in codes:
+            codes[exit] = len(codes) + 1
+        code.append(block[pos:start])
+        code.append("{%s%s%s=%d;return}" % (
+            "%s=%s;" % (return_value, value) if value else "", stores,
+            exit_code, codes[exit]))
+        pos = end
+    code.append(block[pos:].rstrip())
+    code = "".join(code)
+    if code and not code.endswith((";", "}")):
+        code += ";"
+    code += stores
+    if exits:
+        code += "%s=0;" % (exit_code,)
+
+    call = ["%s(%s);" % (helper, ",".join(coerce(name, types[name])
+                                          for name in used)), "".join(loads)]
+    for exit, value in sorted(codes.items(), key=lambda item: item[1]):
+        if exit == "return" and return_kind != "v":
+            exit = "return %s" % (coerce(return_value, return_kind),)
+        call.append("if((%s|0)==%d)%s;" % (exit_code, value, exit))
+    call = "".join(call)
+    if len(call) >= len(block):
+        return None
+    helper_func = "%s(%s){%s%s}" % (
+        helper, ",".join(used),
+        "".join("%s=%s;" % (name, coerce(name, types[name])) for name in used),
+        code,
+    )
+    return call, helper_func, outputs
+
+
+def local_types(func, body_start, body_end):
+    """Map each parameter and local of a function to its type.
+
+    The type is "i" for int, "d" for double, or None for anything else,
+    i.e. float.
+    """
+    types = {}
+    name = function_name(func)
+    match = PARAMS_RE.match(func, len(name))
+    body = func[body_start:body_end]
+    if match is not None:
+        for param in match.group("params").split(","):
+            param = param.strip()
+            if not param:
+                continue
+            types[param] = None
+            p = re.escape(param)
+            if re.search(r"(?<![\w$.])%s\s*=\s*%s\s*\|\s*0" % (p, p), body):
+                types[param] = "i"
+            elif re.search(r"(?<![\w$.])%s\s*=\s*\+\s*%s(?![\w$])" % (p, p),
+                           body):
+                types[param] = "d"
+    for match in VAR_RE.finditer(body):
+        for decl in match.group("decls").split(","):
+            local, _, init = decl.partition("=")
+            init = init.strip()
+            if INT_RE.match(init):
+                types[local.strip()] = "i"
+            elif DOUBLE_RE.match(init):
+                types[local.strip()] = "d"
+            else:
+                types[local.strip()] = None
+    return types
+
+
+def return_type(value):
+    """Find the type of a returned value: "i", "d", "v" for none, or None."""
+    if not value:
+        return "v"
+    if value.startswith("+") or DOUBLE_RE.match(value):
+        return "d"
+    if INT_RE.match(value) or re.search(r"\|\s*0$", value):
+        return "i"
+    return None
+
+
+def coerce(name, kind):
+    return "+%s" % (name,) if kind == "d" else "%s|0" % (name,)
+
+
+def find_blocks(func, body_start, body_end):
+    """Find the blocks within a function body that might be outlined.
+
+    This generates a (start, end) pair for the code inside each pair of
+    braces, apart from those around a switch's cases, leaving out any
+    trailing break.
+    """
+    stack = []
+    after_switch = False
+    for match in BLOCK_RE.finditer(func, body_start, body_end):
+        token = match.group(0)
+        if token == "switch":
+            after_switch = True
+        elif token == "{":
+            stack.append((match.end(), after_switch))
+            after_switch = False
+        else:
+            start, is_switch = stack.pop()
+            if is_switch:
+                continue
+            end = match.start()
+            trailing_break = TRAILING_BREAK_RE.search(func[start:end])
+            if trailing_break is not None:
+                end = start + trailing_break.start()
+            if func[start:end].strip():
+                yield start, end
+
+
+def find_exits(block):
+    """Find the statements by which control can leave a block early.
+
+    These are any returns, and any break or continue that isn't within a
+    loop, switch or labelled statement that's also in the block.  This
+    returns a list of tuples (exit, value, start, end), where exit is e.g.
+    "return", "continue" or "break L1", value is the returned value if any,
+    and start and end give the extent of the statement.  It returns None if
+    the block can't be outlined at all.
+    """
+    labels = set(match.group("name") for match in LABEL_DEF_RE.finditer(block))
+    tokens = list(TOKEN_RE.finditer(block))
+    exits = []
+    # The kind of each enclosing block, and of the statement that the next
+    # token starts the body of, if any.
+    stack = []
+    pending = None
+    parens = 0
+    after_do = False
+    for i, match in enumerate(tokens):
+        token = match.group(0)
+        if token == "(":
+            parens += 1
+            continue
+        if token == ")":
+            parens -= 1
+            continue
+        if parens:
+            continue
+        follows_do = after_do
+        after_do = False
+        if token == "{":
+            stack.append(pending)
+            pending = None
+        elif token == "}":
+            if not stack:
+                return None
+            after_do = stack.pop() == "do"
+            pending = None
+        elif token == ";":
+            pending = None
+        elif token == "do":
+            pending = "do"
+        elif token in ("while", "for"):
+            if not follows_do:
+                pending = "loop"
+        elif token == "switch":
+            pending = "switch"
+        elif token == "var":
+            return None
+        elif token == "return":
+            end = statement_end(block, match.end())
+            value = block[match.end():end].strip()
+            exits.append(("return", value, match.start(),
+                          STATEMENT_END_RE.match(block, end).end()))
+        elif token in ("break", "continue"):
+            label = tokens[i + 1] if i + 1 < len(tokens) else None
+            if label is not None and \
+               IDENTIFIER_START_RE.match(label.group(0)):
+                if label.group(0) in labels:
+                    continue
+                exit = "%s %s" % (token, label.group(0))
+                end = label.end()
+            else:
+                kinds = BREAK_KINDS if token == "break" else LOOP_KINDS
+                if pending in kinds or any(kind in kinds for kind in stack):
+                    continue
+                exit = token
+                end = match.end()
+            exits.append((exit, None, match.start(),
+                          STATEMENT_END_RE.match(block, end).end()))
+    if stack or parens:
+        return None
+    return exits
+
+
+def statement_end(code, pos):
+    """Find the end of the expression statement starting at pos."""
+    depth = 0
+    for match in EXPRESSION_END_RE.finditer(code, pos):
+        char = match.group(0)
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif depth <= 0:
+            return match.start()
+    return len(code)
+
+
+def asm_module_source(data):
+    """Find the source of the function that creates the asm module."""
+    end = data.find(MARKER_END_ASM)
+    use_asm = max(data.rfind("'use asm'", 0, end),
+                  data.rfind('"use asm"', 0, end))
+    start = data.rfind("function", 0, use_asm)
+    if end < 0 or use_asm < 0 or start < 0:
+        raise ValueError("asm module not found")
+    source = data[start:end].rstrip()
+    if data[:start].rstrip().endswith("(") and source.endswith(")"):
+        source = source[:-1]
+    return source
+
+
+def asm_module_imports(source):
+    """Find the names that the asm module imports from its environment."""
+    match = MODULE_PARAMS_RE.match(source)
+    if match is None:
+        raise ValueError("asm module parameters not found")
+    env_re = re.compile(r"(?<![\w$.])%s\.(?P<name>[a-zA-Z_$][\w$]*)" % (
+        re.escape(match.group("env")),))
+    return sorted(set(m.group("name") for m in env_re.finditer(source)))
+
+
+def measure_compile_time(shell, data, flags=(), repeat=REPEAT):
+    """Time compiling and linking the asm module in data under a js shell.
+
+    This returns the fastest time in seconds, and fails if the shell
+    doesn't accept the module as asmjs.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filenames = []
+        source = asm_module_source(data)
+        for name, code in (("measure.js", MEASURE_CODE),
+                           ("module.js", source)):
+            filenames.append(os.path.join(tmpdir, name))
+            with open(filenames[-1], "w") as f:
+                f.write(code)
+        elapsed = None
+        for _ in range(repeat):
+            proc = subprocess.Popen([shell] + list(flags) + filenames +
+                                    [str(HEAP_SIZE),
+                                     ",".join(asm_module_imports(source))],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            output, errors = proc.communicate()
+            if proc.returncode != 0:
+                raise ValueError("%s failed: %s" % (shell, errors.strip()))
+            for line in (output + errors).splitlines():
+                if any(failure in line for failure in ASMJS_FAILURES):
+                    raise ValueError("%s rejected the asm module: %s" % (
+                        shell, line.strip()))
+            result = json.loads(output.strip().splitlines()[-1])
+            if elapsed is None or result["ms"] < elapsed:
+                elapsed = result["ms"]
+    finally:
+        shutil.rmtree(tmpdir)
+    return elapsed / 1000.0
+
+
+# This runs under both node and SpiderMonkey shells.  Every import of the
+# module is a function that returns zero, which also does for numeric
+# imports, since those are coerced to numbers when the module is linked.
+
+MEASURE_CODE = """
+var isNode = typeof process !== 'undefined' && typeof require === 'function';
+var args = isNode ? process.argv.slice(2) : scriptArgs;
+var source = isNode ?
+  require('fs').readFileSync(args[0], 'utf8') : read(args[0]);
+var write = isNode ? console.log : print;
+var now = typeof performance !== 'undefined' ?
+  function() { return performance.now(); } : Date.now;
+var stdlib = typeof globalThis !== 'undefined' ? globalThis : this;
+var env = {};
+args[2].split(',').forEach(function(name) {
+  if (name) env[name] = function() { return 0; };
+});
+var buffer = new ArrayBuffer(parseInt(args[1], 10));
+var start = now();
+var create = (0, eval)('(' + source + ')');
+create(stdlib, env, buffer);
+write(JSON.stringify({ms: now() - start}));
+"""
+
+
+def main(args=None):
+    usage = "usage: %prog [options] [file ...]"
+    descr = "Outline code from oversized functions in emscripten-generated " \
+            "javascript"
+    parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("-c", "--stdout", action="store_true",
+                      help="write output to stdout")
+    parser.add_option("-q", "--quiet", action="store_true",
+                      help="supress printing of the report")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="list each block that was outlined")
+    parser.add_option("-s", "--max-size", type=int, default=DEFAULT_MAX_SIZE,
+                      metavar="BYTES",
+                      help="split up functions bigger than this")
+    parser.add_option("-C", "--max-cost", type=int, metavar="N",
+                      help="also split up functions with a higher compile "
+                           "cost than this, as given by analyze_code_size")
+    parser.add_option("-m", "--min-size", type=int, default=MIN_BLOCK_SIZE,
+                      metavar="BYTES",
+                      help="don't outline blocks smaller than this")
+    parser.add_option("--node", metavar="NODE", nargs=1,
+                      help="time compiling the asm module using NODE")
+    parser.add_option("--js", metavar="JS", nargs=1,
+                      help="time compiling the asm module using the "
+                           "SpiderMonkey shell JS")
+    parser.add_option("-n", "--repeat", type=int, default=REPEAT,
+                      metavar="N",
+                      help="time the fastest of N compiles")
+
+    opts, files = parser.parse_args(args)
+    if not files:
+        files = [sys.stdin]
+        opts.stdout = True
+        opts.quiet = True
+    else:
+        files = [open(f, "r") for f in files]
+
+    shells = []
+    if opts.node:
+        shells.append((opts.node, NODE_FLAGS))
+    if opts.js:
+        shells.append((opts.js, ()))
+
+    # Keep the report out of the way of the output.
+    report = sys.stderr if opts.stdout else sys.stdout
+
+    for f in files:
+        data = f.read()
+        outlined = []
+        output = outline_functions(data, opts.max_size, opts.max_cost,
+                                   opts.min_size,
+                                   lambda *o: outlined.append(o))
+        if opts.verbose and not opts.quiet:
+            for name, helper, size in outlined:
+                report.write("%d %s => %s\n" % (size, name, helper))
+        if not opts.quiet:
+            report.write("%s: outlined %d blocks from %d functions, "
+                         "largest function %d => %d bytes\n" % (
+                             f.name, len(outlined),
+                             len(set(o[0] for o in outlined)),
+                             largest_function(data),
+                             largest_function(output)))
+        for shell, flags in shells:
+            before = measure_compile_time(shell, data, flags, opts.repeat)
+            after = measure_compile_time(shell, output, flags, opts.repeat)
+            report.write("%s: %s compile time %.1fms => %.1fms (%+.1f%%)\n" % (
+                f.name, os.path.basename(shell), before * 1000, after * 1000,
+                100.0 * (after - before) / max(before, 1e-6)))
+        if opts.stdout:
+            sys.stdout.write(output)
+        else:
+            dirnm = os.path.dirname(f.name)
+            filenm = os.path.basename(f.name)
+            fd, tempnm = tempfile.mkstemp(dir=dirnm, prefix=filenm)
+            try:
+                os.write(fd, output)
+                os.close(fd)
+                os.rename(tempnm, f.name)
+            finally:
+                if os.path.exists(tempnm):
+                    os.unlink(tempnm)
+
+    return 0
+
+
+def largest_function(data):
+    functions = split_functions(data)[1]
+    return max([len("function ") + len(func) for func in functions[1:]] or [0])
+
+
+if __name__ == "__main__":
+    try:
+        exitcode = main()
+    except KeyboardInterrupt:
+        exitcode = 1
+    sys.exit(exitcode)
@@ -0,0 +1,364 @@
+#
+#  Run the post-link processing of a compiled VM in a single pass.
+#
+#  The release build massages the compiled pypyjs.vm.js with a series of
+#  tools: extract_memory_initializer pulls out the memory image,
+#  compress_memory_initializer replaces it with a compressed version,
+#  fold_functions, eliminate_dead_functions and outline_functions shrink and
+#  split up the asm functions, and cromulate reorders them so that the file
+#  compresses better.  Run one after another, each of them reads the whole
+#  multi-megabyte script, splits it up with its own regexes, and writes it
+#  back out to disk.  This script instead reads the script once and splits
+#  it into the parts that the stages share: the code before the functions
+#  of the asm module, the functions themselves, the rest of the asm module,
+#  the code after it, and the memory image once it has been extracted.  It
+#  then runs the requested stages on those parts in memory, and writes the
+#  results out once at the end.  The output is the same as that of running
+#  the tools one after another with the corresponding options.
+#
+#  Emscripten only ever puts the memory allocations in the code before the
+#  asm module, so that's the only part that we search for them, rather than
+#  the whole file.
+#
+#  Each stage is timed, and the report gives the wall-clock and CPU time it
+#  took, the peak resident memory of the process once it had finished, and
+#  the size of the code that it left behind.  The --stats option writes the
+#  same numbers out as JSON.
+#
+
+import os
+import sys
+import json
+import time
+import shlex
+import optparse
+import tempfile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import cromulate
+from cromulate import MARKER_START_FUNCS, MARKER_END_FUNCS
+from fold_functions import MARKER_END_ASM, split_asm, join_asm, fold_parts
+from eliminate_dead_functions import eliminate_dead_parts
+from outline_functions import outline_parts
+from extract_memory_initializer import MIN_SEGMENT_GAP, extract_allocations, \
+                                       add_memory_loader, find_segments, \
+                                       encode_segment_table, update_manifest
+from compress_memory_initializer import DEFAULT_MATCHER, encode_zmem, \
+                                        add_zmem_decompressor
+
+
+class VMCode(object):
+    """The parts of a compiled VM that are shared by all the stages.
+
+    The code is held as the parts returned by fold_functions.split_asm.
+    Once the memory image has been extracted, memdata holds it as a dense
+    bytearray, and memory_name and memory_file give the name and contents
+    of the file that the code will load it from.
+    """
+
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.parts = split_asm(data)
+        self.memdata = None
+        self.memory_name = None
+        self.memory_file = None
+
+    @property
+    def parts(self):
+        return self.pre_code, self.functions, self.asm_tail, self.post_code
+
+    @parts.setter
+    def parts(self, parts):
+        self.pre_code, self.functions, self.asm_tail, self.post_code = parts
+
+    def size(self):
+        """Get the size of the code, without having to join it up."""
+        return sum((
+            len(self.pre_code),
+            len(MARKER_START_FUNCS),
+            sum(len(func) for func in self.functions),
+            len("function ") * (len(self.functions) - 1),
+            len(MARKER_END_FUNCS),
+            len(self.asm_tail),
+            len(MARKER_END_ASM),
+            len(self.post_code),
+        ))
+
+
+def postlink_vm(filename, opts, on_stage=None):
+    """Run the stages requested by opts over the VM script in filename.
+
+    The options are those of our command line, as returned by the parser
+    from make_option_parser.  If on_stage is given, it's called after each
+    stage with a dict of measurements as described in measure_stage.
+    """
+    stages = [("extract", extract_stage, opts.extract),
+              ("compress", compress_stage, opts.compress),
+              ("fold", fold_stage, opts.fold),
+              ("eliminate-dead", eliminate_dead_stage, opts.eliminate_dead),
+              ("outline", outline_stage, opts.outline_max_size is not None),
+              ("cromulate", cromulate_stage, opts.cromulate is not None)]
+
+    vm = measure_stage("read", on_stage, read_stage, filename)
+    for name, stage, enabled in stages:
+        if enabled:
+            measure_stage(name, on_stage, stage, vm, opts)
+    measure_stage("write", on_stage, write_stage, vm, opts)
+    return vm
+
+
+def measure_stage(name, on_stage, stage, *args):
+    """Run a stage, measuring how long it took and how much memory it used.
+
+    The stage function returns either the VMCode that it works on, or a
+    tuple of the VMCode and a short note on what it did.  If on_stage is
+    given, it's called with a dict giving the name of the stage, the note,
+    the wall-clock and CPU time in seconds, the peak resident memory of the
+    process in bytes if known, and the size of the code afterwards.  This
+    returns the VMCode.
+    """
+    start_times = os.times()
+    start = time.time()
+    result = stage(*args)
+    wall = time.time() - start
+    end_times = os.times()
+    vm, note = result if isinstance(result, tuple) else (result, None)
+    if on_stage is not None:
+        on_stage({
+            "stage": name,
+            "note": note,
+            "wall": wall,
+            "cpu": sum(end_times[:2]) - sum(start_times[:2]),
+            "peak_memory": peak_memory(),
+            "code_size": vm.size(),
+        })
+    return vm
+
+
+def peak_memory():
+    """Get the peak resident memory of this process in bytes, if known."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # It's in kilobytes on linux, but in bytes on OSX.
+    if sys.platform != "darwin":
+        maxrss *= 1024
+    return maxrss
+
+
+def read_stage(filename):
+    with open(filename, "rb") as f:
+        return VMCode(filename, f.read())
+
+
+def extract_stage(vm, opts):
+    # The file-based version strips whitespace from either end of the
+    # whole file, so we do too.
+    vm.memory_name = os.path.basename(vm.filename) + ".mem"
+    vm.pre_code, vm.memdata = extract_allocations(vm.pre_code.lstrip(),
+                                                  vm.memory_name)
+    vm.post_code = add_memory_loader(vm.post_code.rstrip(), opts.sparse)
+    vm.memory_file = vm.memdata
+    if opts.sparse:
+        segments = find_segments(vm.memdata, opts.min_gap)
+        vm.memory_file = encode_segment_table(vm.memdata, segments)
+    return vm, "%d bytes of memory" % (len(vm.memdata),)
+
+
+def compress_stage(vm, opts):
+    # Decoding a sparse memory file drops any trailing zeros from the image,
+    # and the loader code depends on its size, so we drop them too.
+    if opts.sparse:
+        segments = find_segments(vm.memdata, opts.min_gap)
+        if segments:
+            offset, length = segments[-1]
+            del vm.memdata[offset + length:]
+        else:
+            del vm.memdata[:]
+    else:
+        segments = find_segments(vm.memdata)
+    memdata = bytes(vm.memdata)
+    zmemdata = encode_zmem(memdata, segments, opts.matcher)
+    zmem_name = os.path.basename(vm.filename) + ".zmem"
+    vm.parts = add_zmem_decompressor(vm.parts, vm.memory_name, zmem_name,
+                                     len(memdata), len(zmemdata))
+    vm.memory_name = zmem_name
+    vm.memory_file = zmemdata
+    return vm, "%d => %d bytes of memory" % (len(memdata), len(zmemdata))
+
+
+def fold_stage(vm, opts):
+    folds = []
+    vm.parts = fold_parts(vm.parts, lambda *fold: folds.append(fold))
+    return vm, "folded %d functions" % (len(folds),)
+
+
+def eliminate_dead_stage(vm, opts):
+    removed = []
+    vm.parts = eliminate_dead_parts(vm.parts, lambda *r: removed.append(r))
+    return vm, "removed %d functions" % (len(removed),)
+
+
+def outline_stage(vm, opts):
+    outlined = []
+    vm.parts = outline_parts(vm.parts, opts.outline_max_size,
+                             on_outline=lambda *o: outlined.append(o))
+    return vm, "outlined %d blocks" % (len(outlined),)
+
+
+def cromulate_stage(vm, opts):
+    on_progress = on_report = None
+    if not opts.quiet:
+        on_progress = cromulate.print_percent_complete
+        on_report = cromulate.print_layout_report
+    # Cromulate doesn't distinguish the rest of the asm module from the
+    # code after it.
+    post_code = vm.asm_tail + MARKER_END_ASM + vm.post_code
+    functions = cromulate.cromulate_functions(
+        vm.pre_code, vm.functions, post_code, opts.cromulate_opts,
+        on_progress, on_report)
+    if not opts.quiet:
+        sys.stdout.write("\n")
+    changed = functions is not vm.functions
+    vm.functions = functions
+    return vm, "reordered" if changed else "kept original order"
+
+
+def write_stage(vm, opts):
+    dirnm = os.path.dirname(vm.filename)
+    output = join_asm(*vm.parts)
+    if opts.cromulate_opts is not None and opts.cromulate_opts.save_order:
+        cromulate.write_order(opts.cromulate_opts.save_order, output)
+    # Write the memory file first, so the script never refers to a file
+    # that doesn't exist yet.
+    if vm.memory_file is not None:
+        write_file(os.path.join(dirnm, vm.memory_name), vm.memory_file)
+        if not vm.memory_name.endswith(".mem"):
+            stale_filename = vm.filename + ".mem"
+            if os.path.exists(stale_filename):
+                os.unlink(stale_filename)
+    write_file(vm.filename, output)
+    if vm.memory_file is not None:
+        update_manifest(dirnm, memoryInitializer=vm.memory_name)
+    return vm
+
+
+def write_file(filename, data):
+    """Replace the contents of filename with data, atomically.
+
+    The file keeps its mode if it already exists, and otherwise gets the
+    mode that open() would give it, rather than the 0600 from mkstemp.
+    """
+    dirnm = os.path.dirname(filename)
+    filenm = os.path.basename(filename)
+    try:
+        mode = os.stat(filename).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    fd, tempnm = tempfile.mkstemp(dir=dirnm, prefix=filenm)
+    try:
+        os.write(fd, data)
+        os.close(fd)
+        os.chmod(tempnm, mode)
+        os.rename(tempnm, filename)
+    finally:
+        if os.path.exists(tempnm):
+            os.unlink(tempnm)
+
+
+def print_stage(stats, output=sys.stdout):
+    """Print the measurements from a single stage."""
+    memory = "-"
+    if stats["peak_memory"] is not None:
+        memory = "%.1fMB" % (stats["peak_memory"] / (1024.0 * 1024.0),)
+    output.write("%-16s %8.2fs %8.2fs %10s %10d  %s\n" % (
+        stats["stage"], stats["wall"], stats["cpu"], memory,
+        stats["code_size"], stats["note"] or ""))
+
+
+def make_option_parser():
+    usage = "usage: %prog [options] file"
+    descr = "Run the post-link processing of a compiled VM in a single pass"
+    parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("-e", "--extract", action="store_true",
+                      help="extract the memory initializer")
+    parser.add_option("-s", "--sparse", action="store_true",
+                      help="extract only non-zero segments of the memory")
+    parser.add_option("-g", "--min-gap", type=int, default=MIN_SEGMENT_GAP,
+                      metavar="N",
+                      help="minimum run of zeros that splits a segment")
+    parser.add_option("-z", "--compress", action="store_true",
+                      help="compress the extracted memory initializer")
+    parser.add_option("-m", "--matcher", choices=("zlib", "native"),
+                      default=DEFAULT_MATCHER,
+                      help="how to find LZ77 matches: zlib or native")
+    parser.add_option("-f", "--fold", action="store_true",
+                      help="fold identical functions")
+    parser.add_option("-d", "--eliminate-dead", action="store_true",
+                      help="remove unreachable functions")
+    parser.add_option("-o", "--outline-max-size", type=int, metavar="BYTES",
+                      help="split up functions bigger than this")
+    parser.add_option("-C", "--cromulate", metavar="ARGS",
+                      help="cromulate, with the given cromulate.py options")
+    parser.add_option("--stats", metavar="FILE",
+                      help="write the measurements of each stage to FILE")
+    parser.add_option("-q", "--quiet", action="store_true",
+                      help="supress printing of the report")
+    return parser
+
+
+def main(args=None):
+    parser = make_option_parser()
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("expected a single file argument")
+    if opts.sparse or opts.compress:
+        opts.extract = True
+    opts.cromulate_opts = None
+    if opts.cromulate is not None:
+        cromulate_parser = cromulate.make_option_parser()
+        opts.cromulate_opts, cromulate_args = \
+            cromulate_parser.parse_args(shlex.split(opts.cromulate))
+        if cromulate_args:
+            parser.error("--cromulate takes options, not files")
+        opts.quiet = opts.quiet or opts.cromulate_opts.quiet
+
+    stats = []
+    on_stage = stats.append
+    if not opts.quiet:
+        sys.stdout.write("%-16s %9s %9s %10s %10s\n" % (
+            "stage", "wall", "cpu", "peak mem", "code size"))
+
+        def on_stage(stage_stats):
+            stats.append(stage_stats)
+            print_stage(stage_stats)
+
+    postlink_vm(args[0], opts, on_stage)
+
+    total = {
+        "wall": sum(s["wall"] for s in stats),
+        "cpu": sum(s["cpu"] for s in stats),
+        "peak_memory": stats[-1]["peak_memory"],
+    }
+    if not opts.quiet:
+        print_stage(dict(total, stage="total", note=None,
+                         code_size=stats[-1]["code_size"]))
+    if opts.stats:
+        with open(opts.stats, "w") as stats_file:
+            json.dump({"file": args[0], "stages": stats, "total": total},
+                      stats_file, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        exitcode = main()
+    except KeyboardInterrupt:
+        exitcode = 1
+    sys.exit(exitcode)
@@ -8,6 +8,8 @@ from rpython.rlib import jit
 from rpython.rlib import rrandom
 from rpython.jit.codewriter.policy import JitPolicy
 
+from benchlib import report
+
 
 # The regex is built up from a combination individual Regex objects.
 # Each is responsiblef for implementing a specific operator.
@@ -126,29 +128,205 @@ def match(re, s):
     return result
 
 
+# The shapes of pattern that we can match against, which produce rather
+# different traces.  Each is built up from a size parameter, with the
+# given default.
+#
+#   gap:          (a|b)*a(a|b){size}a(a|b)*, a long chain of sequences
+#   literal:      (a|b)*w(a|b)*, for a literal word w of length size
+#   alternation:  (a|b)*(w1|w2|...)(a|b)*, for size short literal words
+#   nested:       repetitions of sequences, nested size deep
+
+PATTERN_SHAPES = ["gap", "literal", "alternation", "nested"]
+DEFAULT_SIZES = [20, 12, 8, 6]
+
+
+def any_char():
+    return Alternative(Char("a"), Char("b"))
+
+
+def literal(word):
+    pattern = Char(word[0])
+    for i in xrange(1, len(word)):
+        pattern = Sequence(pattern, Char(word[i]))
+    return pattern
+
+
+def make_word(seed, length):
+    # A deterministic but irregular word of a's and b's.
+    chars = []
+    for i in xrange(length):
+        if ((i + 1) * 7 + seed * 5) % 3:
+            chars.append("a")
+        else:
+            chars.append("b")
+    return "".join(chars)
+
+
+def nested(depth):
+    if depth == 0:
+        return any_char()
+    if depth % 2:
+        c = "a"
+    else:
+        c = "b"
+    return Repetition(Sequence(nested(depth - 1), Char(c)))
+
+
+def build_pattern(shape, size):
+    # The pattern must be dynamically constructed, or it gets eliminated
+    # at compile-time.
+    if shape == "gap":
+        pattern = Sequence(Repetition(any_char()), Char("a"))
+        for _ in xrange(size):
+            pattern = Sequence(pattern, any_char())
+        suffix = Sequence(Char("a"), Repetition(any_char()))
+        return Sequence(pattern, suffix)
+    if shape == "literal":
+        pattern = Sequence(Repetition(any_char()), literal(make_word(0, size)))
+        return Sequence(pattern, Repetition(any_char()))
+    if shape == "alternation":
+        words = literal(make_word(0, 3))
+        for i in xrange(1, size):
+            words = Alternative(words, literal(make_word(i, 2 + i % 3)))
+        pattern = Sequence(Repetition(any_char()), words)
+        return Sequence(pattern, Repetition(any_char()))
+    if shape == "nested":
+        return Sequence(nested(size), Char("a"))
+    raise RuntimeError("unknown pattern shape: " + shape)
+
+
+# The inputs are matched in batches, timing each one, so we can see how
+# long the JIT takes to warm up.  The warmup "knee" is the first of
+# KNEE_WINDOW consecutive batches that each take no more than
+# KNEE_TOLERANCE longer per input than the steady state.  The steady state
+# is measured over the last STEADY_FRACTION of the batches.
+
+DEFAULT_BATCHES = 100
+KNEE_WINDOW = 3
+KNEE_TOLERANCE = 0.25
+STEADY_FRACTION = 0.5
+
+
+class Options(object):
+
+    def __init__(self):
+        # NUM_INPUTS increases the number of loop iterations.
+        # INPUT_LENGTH increases the amount of work done per loop iteration.
+        self.num_inputs = 1000
+        self.input_length = 50
+        self.shape = "gap"
+        self.size = -1
+        self.batches = DEFAULT_BATCHES
+
+
+def parse_args(argv):
+    # Usage: rematcher [--pattern SHAPE] [--size N] [--batches N]
+    #                  [NUM_INPUTS [INPUT_LENGTH]]
+    options = Options()
+    positional = []
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if not arg.startswith("--"):
+            positional.append(arg)
+            i += 1
+            continue
+        if i + 1 >= len(argv):
+            raise RuntimeError("missing value for " + arg)
+        value = argv[i + 1]
+        if arg == "--pattern":
+            options.shape = value
+        elif arg == "--size":
+            options.size = int(value)
+        elif arg == "--batches":
+            options.batches = int(value)
+        else:
+            raise RuntimeError("unknown option " + arg)
+        i += 2
+    if len(positional) > 0:
+        options.num_inputs = int(positional[0])
+    if len(positional) > 1:
+        options.input_length = int(positional[1])
+    if len(positional) > 2:
+        raise RuntimeError("too many arguments")
+    if options.shape not in PATTERN_SHAPES:
+        raise RuntimeError("unknown pattern shape: " + options.shape)
+    if options.size < 0:
+        options.size = DEFAULT_SIZES[PATTERN_SHAPES.index(options.shape)]
+    if options.batches < 1:
+        raise RuntimeError("need at least one batch")
+    return options
+
+
+class WarmupCurve(object):
+
+    def __init__(self, counts, times):
+        # The number of inputs in each batch, and the time it took.
+        self.counts = counts
+        self.times = times
+        n = len(counts)
+
+        # The time per input in the steady state, averaged over whole
+        # batches so that it's not thrown off by a coarse clock.
+        steady_start = n - max(int(n * STEADY_FRACTION), 1)
+        steady_count = 0
+        steady_time = 0.0
+        for i in xrange(steady_start, n):
+            steady_count += counts[i]
+            steady_time += times[i]
+        self.steady_per_input = steady_time / max(steady_count, 1)
+
+        # Find the knee, and the time spent and inputs matched before it.
+        # The warmup cost is how much longer that took than it would have
+        # in the steady state.
+        window = min(KNEE_WINDOW, n)
+        limit = self.steady_per_input * (1.0 + KNEE_TOLERANCE)
+        self.knee = -1
+        run = 0
+        for i in xrange(n):
+            if times[i] <= limit * counts[i]:
+                run += 1
+                if run == window:
+                    self.knee = i - window + 1
+                    break
+            else:
+                run = 0
+        self.knee_inputs = 0
+        self.warmup_time = 0.0
+        for i in xrange(self.knee if self.knee >= 0 else n):
+            self.knee_inputs += counts[i]
+            self.warmup_time += times[i]
+        self.warmup_cost = self.warmup_time - \
+            self.knee_inputs * self.steady_per_input
+
+    def steady_throughput(self):
+        if self.steady_per_input <= 0.0:
+            return 0.0
+        return 1.0 / self.steady_per_input
+
+    def to_json(self, options):
+        # RPython has no json module, so we write it out by hand.
+        batches = []
+        for i in xrange(len(self.counts)):
+            batches.append("[%d, %f]" % (self.counts[i], self.times[i]))
+        return ('{"pattern": "%s", "size": %d, "inputs": %d, '
+                '"input_length": %d, "batches": [%s], "knee_batch": %d, '
+                '"knee_inputs": %d, "warmup_seconds": %f, '
+                '"warmup_cost": %f, "steady_throughput": %f}' % (
+                    options.shape, options.size, options.num_inputs,
+                    options.input_length, ", ".join(batches), self.knee,
+                    self.knee_inputs, self.warmup_time, self.warmup_cost,
+                    self.steady_throughput()))
+
+
 def entry_point(argv):
     # Adjust the amount of work we do based on command-line arguments.
-    # NUM_INPUTS increases the number of loop iterations.
-    # INPUT_LENGTH increases the amount of work done per loop iteration.
-    NUM_INPUTS = 1000
-    INPUT_LENGTH = 50
-    if len(argv) > 1:
-        NUM_INPUTS = int(argv[1])
-    if len(argv) > 2:
-        INPUT_LENGTH = int(argv[2])
-    if len(argv) > 3:
-        raise RuntimeError("too many arguments")
+    options = parse_args(argv)
+    NUM_INPUTS = options.num_inputs
+    INPUT_LENGTH = options.input_length
 
-    # Build up the regex pattern.
-    # Target pattern: (a|b)*a(a|b){20}a(a|b)*
-    # For now we use the same pattern every time, but it must be
-    # dynamically constructed or it gets eliminated at compile-time.
-    prefix = Sequence(Repetition(Alternative(Char("a"), Char("b"))), Char("a"))
-    suffix = Sequence(Char("a"), Repetition(Alternative(Char("a"), Char("b"))))
-    pattern = prefix
-    for _ in xrange(20):
-        pattern = Sequence(pattern,  Alternative(Char("a"), Char("b")))
-    pattern = Sequence(pattern, suffix)
+    pattern = build_pattern(options.shape, options.size)
 
     # Generate "random input" to match against the pattern.
     # Ideally this would come from the outside world, but stdio
@@ -165,17 +343,37 @@ def entry_point(argv):
                 s.append("b")
         inputs[i] = "".join(s)
 
-    # Run each input string through the regex.
-    # Time how long it takes for the total run.
-    print "Matching all strings against the regex..."
+    # Run each input string through the regex, timing each batch
+    # as well as the total run.
+    print "Matching all strings against the", options.shape, "regex..."
+    num_batches = min(options.batches, max(len(inputs), 1))
+    counts = [0] * num_batches
+    times = [0.0] * num_batches
+    num_matched = 0
+    i = 0
     ts = clock()
-    for i in xrange(len(inputs)):
-        # No output, we just want to exercise the loop.
-        matched = match(pattern, inputs[i])
+    for batch in xrange(num_batches):
+        end = len(inputs) * (batch + 1) // num_batches
+        tb = clock()
+        counts[batch] = end - i
+        while i < end:
+            # No output, we just want to exercise the loop.
+            num_matched += match(pattern, inputs[i])
+            i += 1
+        times[batch] = clock() - tb
     tdiff = clock() - ts
+    curve = WarmupCurve(counts, times)
     print "Done!"
     print "Matching time for %d strings: %f" % (len(inputs), tdiff)
     print "Performed %f matches per second." % (len(inputs) / tdiff,)
+    if curve.knee >= 0:
+        print "Warmed up after %d strings (%f seconds)." % (
+            curve.knee_inputs, curve.warmup_time)
+    else:
+        print "Never reached a steady state."
+    print "Steady state: %f matches per second." % (curve.steady_throughput(),)
+    print "warmup: " + curve.to_json(options)
+    report("rematcher-" + options.shape, len(inputs), tdiff, num_matched)
     return 0
 
 
@@ -0,0 +1,385 @@
+#
+#  Run the RPython benchmark suite across several builds, and compare them.
+#
+#  The benchmarks are the standalone RPython targets in this directory,
+#  which each print a result line as described in benchlib.py.  This script
+#  runs each of them in any of the following builds:
+#
+#    * untranslated, on top of a python interpreter with rpython importable
+#    * translated with the C backend, as DIR/<target>-c
+#    * translated with the JS backend, as DIR/<target>.js, run with node
+#
+#  The translated builds are produced by `make benchmarks`, which then runs
+#  this script on them.  Untranslated python is a couple of orders of
+#  magnitude slower than the others, so it runs UNTRANSLATED_SCALE times as
+#  many iterations, and builds are compared by their time per iteration.
+#  Each benchmark is run several times and the fastest run is kept.  Since
+#  the translated builds include the JIT, that run includes its warmup, as
+#  it would for a short-lived session.
+#
+#  The results are written as JSON, giving for each build and benchmark the
+#  iterations, the times of every run, the best time and time per iteration,
+#  and the checksum that it computed.  The report shows the time per
+#  iteration in each build, relative to the baseline build, and flags any
+#  builds that disagree about a checksum.  Given the JSON results of an
+#  earlier run, e.g. from a previous release, it also shows how each build
+#  and benchmark has changed since then.
+#
+#  Rematcher also times its inputs in batches, and reports its warmup curve
+#  as a line of JSON, giving the time of each batch, the point at which it
+#  settled into a steady state, and its throughput once it had.  These are
+#  kept in the results of its best run, and summarized in the report.
+#
+
+import os
+import re
+import sys
+import json
+import time
+import optparse
+import subprocess
+
+
+# Each benchmark is given as (name, target, iterations, args), where target
+# is the name of its module in this directory and args are any options to
+# pass it ahead of the iterations.  Rematcher is run with each of its
+# pattern shapes, since they warm up the JIT differently.
+
+BENCHMARKS = (
+    ("dispatch", "bench_dispatch", 10000000, ()),
+    ("floats", "bench_floats", 2000000, ()),
+    ("strings", "bench_strings", 5000000, ()),
+    ("containers", "bench_containers", 5000000, ()),
+    ("gc", "bench_gc", 20000, ()),
+    ("rematcher-gap", "rematcher", 100000, ("--pattern", "gap")),
+    ("rematcher-literal", "rematcher", 100000, ("--pattern", "literal")),
+    ("rematcher-alternation", "rematcher", 100000,
+     ("--pattern", "alternation")),
+    ("rematcher-nested", "rematcher", 100000, ("--pattern", "nested")),
+)
+
+UNTRANSLATED_SCALE = 0.01
+REPEAT = 3
+
+# The minimum width of each column of the report.
+
+COLUMN_WIDTH = 12
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+PYPY_DIR = os.path.join(os.path.dirname(TOOLS_DIR), "deps", "pypy")
+
+# The result line printed by each benchmark, as described in benchlib.py.
+
+RESULT_RE = re.compile(r"^benchmark: (?P<name>\S+)"
+                       r" iterations=(?P<iterations>\d+)"
+                       r" seconds=(?P<seconds>[0-9.]+)"
+                       r" checksum=(?P<checksum>\d+)\s*$", re.MULTILINE)
+
+# Benchmarks that time their work in batches, like rematcher, also print
+# a line of JSON describing how long the JIT took to warm up.
+
+WARMUP_RE = re.compile(r"^warmup: (?P<json>\{.*\})\s*$", re.MULTILINE)
+
+
+def untranslated_build(python):
+    """Get the build that runs targets untranslated on the given python."""
+    env = dict(os.environ)
+    path = [PYPY_DIR, TOOLS_DIR]
+    if env.get("PYTHONPATH"):
+        path.append(env["PYTHONPATH"])
+    env["PYTHONPATH"] = os.pathsep.join(path)
+
+    def command(target):
+        return [python, os.path.join(TOOLS_DIR, target + ".py")]
+
+    return ("untranslated", command, UNTRANSLATED_SCALE, env)
+
+
+def native_build(build_dir):
+    """Get the build that runs targets translated with the C backend."""
+    def command(target):
+        return [os.path.join(build_dir, target + "-c")]
+
+    return ("native", command, 1.0, None)
+
+
+def js_build(build_dir, shell="node"):
+    """Get the build that runs targets translated with the JS backend."""
+    def command(target):
+        return [shell, os.path.join(build_dir, target + ".js")]
+
+    return ("js", command, 1.0, None)
+
+
+def run_benchmarks(builds, benchmarks=BENCHMARKS, scale=1.0, repeat=REPEAT,
+                   on_result=None):
+    """Run each of the benchmarks in each of the builds.
+
+    Each build is a tuple (label, command, scale, env) as returned by the
+    *_build functions above.  This returns a dict mapping the label of each
+    build to a dict of results for each benchmark, as described in
+    run_benchmark.  If on_result is given, it's called with the label, the
+    name of the benchmark and its results as each one finishes.
+    """
+    results = {}
+    for label, command, build_scale, env in builds:
+        build_results = results[label] = {}
+        for name, target, iterations, target_args in benchmarks:
+            iterations = max(int(iterations * scale * build_scale), 1)
+            result = run_benchmark(command(target) + list(target_args), name,
+                                   iterations, repeat, env)
+            build_results[name] = result
+            if on_result is not None:
+                on_result(label, name, result)
+    return results
+
+
+def run_benchmark(command, name, iterations, repeat=REPEAT, env=None):
+    """Run a single benchmark, returning a dict of its results.
+
+    The dict gives the number of iterations, the time of each run in
+    seconds, the best of those times and the resulting time per iteration,
+    and the checksum that the benchmark computed.  If the benchmark reports
+    on its warmup, that of the best run is included too.
+    """
+    times = []
+    warmups = []
+    checksum = None
+    for _ in xrange(repeat):
+        proc = subprocess.Popen(command + [str(iterations)], env=env,
+                                stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise ValueError("%s exited with status %d" % (
+                " ".join(command), proc.returncode))
+        for match in RESULT_RE.finditer(output):
+            if match.group("name") == name:
+                break
+        else:
+            raise ValueError("%s printed no result for %s" % (
+                " ".join(command), name))
+        if int(match.group("iterations")) != iterations:
+            raise ValueError("%s ran the wrong number of iterations" % (
+                " ".join(command),))
+        times.append(float(match.group("seconds")))
+        checksum = int(match.group("checksum"))
+        match = WARMUP_RE.search(output)
+        warmups.append(json.loads(match.group("json")) if match else None)
+    best = min(times)
+    result = {
+        "iterations": iterations,
+        "times": times,
+        "best": best,
+        "per_iteration": best / iterations,
+        "checksum": checksum,
+    }
+    if warmups[times.index(best)] is not None:
+        result["warmup"] = warmups[times.index(best)]
+    return result
+
+
+def checksum_mismatches(results, name):
+    """Find builds that disagree about the checksum for a benchmark.
+
+    Builds can only be compared if they ran the same number of iterations.
+    This returns a sorted list of the labels of any builds whose checksum
+    differs from that of another build with the same iterations.
+    """
+    checksums = {}
+    for label in results:
+        result = results[label].get(name)
+        if result is not None:
+            checksums.setdefault(result["iterations"], {})[label] = \
+                result["checksum"]
+    mismatches = []
+    for by_label in checksums.itervalues():
+        if len(set(by_label.itervalues())) > 1:
+            mismatches.extend(by_label)
+    return sorted(mismatches)
+
+
+def format_time(seconds):
+    for unit, scale in (("s", 1.0), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return "%.2f%s" % (seconds / scale, unit)
+    return "%.2fns" % (seconds / 1e-9,)
+
+
+def print_report(results, baseline=None, previous=None, output=sys.stdout):
+    """Print a comparison of the results of each build.
+
+    Times are per iteration, and each build is also given relative to the
+    baseline build if that was run.  If previous results are given, the
+    change in the time of each build and benchmark since then is shown too.
+    """
+    labels = [label for label in ("untranslated", "native", "js")
+              if label in results]
+    labels.extend(sorted(set(results) - set(labels)))
+    names = [name for name, _, _, _ in BENCHMARKS
+             if any(name in results[label] for label in labels)]
+    if baseline not in results:
+        baseline = None
+    others = [label for label in labels if label != baseline]
+
+    # Each column is as wide as its heading needs.
+    columns = [(label, None) for label in labels]
+    if baseline is not None:
+        columns.extend((label, baseline) for label in others)
+    headings = [label if base is None else "%s/%s" % (label, base)
+                for label, base in columns]
+    widths = [max(COLUMN_WIDTH, len(heading) + 2) for heading in headings]
+    name_width = max([len("benchmark")] + [len(name) for name in names])
+
+    output.write("%-*s" % (name_width, "benchmark"))
+    for heading, width in zip(headings, widths):
+        output.write(heading.rjust(width))
+    output.write("\n")
+    for name in names:
+        output.write("%-*s" % (name_width, name))
+        for (label, base), width in zip(columns, widths):
+            result = results[label].get(name)
+            cell = "-"
+            if base is None:
+                if result is not None:
+                    cell = format_time(result["per_iteration"])
+            elif result is not None and name in results[base]:
+                cell = "%.2fx" % (result["per_iteration"] /
+                                  max(results[base][name]["per_iteration"],
+                                      1e-12),)
+            output.write(cell.rjust(width))
+        mismatches = checksum_mismatches(results, name)
+        if mismatches:
+            output.write("  checksum mismatch: %s" % (", ".join(mismatches),))
+        output.write("\n")
+
+    warmups = []
+    for name in names:
+        for label in labels:
+            warmup = results[label].get(name, {}).get("warmup")
+            if warmup is None:
+                continue
+            if warmup["knee_batch"] < 0:
+                knee = "no steady state after %d inputs" % (
+                    warmup["knee_inputs"],)
+            else:
+                knee = "knee after %d inputs, %s (%s over steady)" % (
+                    warmup["knee_inputs"],
+                    format_time(warmup["warmup_seconds"]),
+                    format_time(max(warmup["warmup_cost"], 0.0)))
+            warmups.append("%-*s %-14s %s, steady %.1f/s\n" % (
+                name_width, name, label, knee, warmup["steady_throughput"]))
+    if warmups:
+        output.write("\nJIT warmup:\n")
+        output.write("".join(warmups))
+
+    if previous is None:
+        return
+    changes = []
+    for label in labels:
+        for name in names:
+            result = results[label].get(name)
+            old = previous.get(label, {}).get(name)
+            if result is None or old is None:
+                continue
+            before = old["per_iteration"]
+            after = result["per_iteration"]
+            changes.append("%-*s %-14s %10s => %10s (%+.1f%%)\n" % (
+                name_width, name, label, format_time(before),
+                format_time(after),
+                100.0 * (after - before) / max(before, 1e-12)))
+    output.write("\nChanges since previous results:\n")
+    output.write("".join(changes) or "(nothing to compare)\n")
+
+
+def main(args=None):
+    usage = "usage: %prog [options]"
+    descr = "Run the RPython benchmark suite across several builds"
+    parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("-u", "--untranslated", action="store_true",
+                      help="run the targets untranslated")
+    parser.add_option("--python", default="python", metavar="PYTHON",
+                      help="python interpreter for untranslated runs")
+    parser.add_option("--native", metavar="DIR",
+                      help="run the targets translated with the C backend "
+                           "in DIR")
+    parser.add_option("--js", metavar="DIR",
+                      help="run the targets translated with the JS backend "
+                           "in DIR")
+    parser.add_option("--js-shell", default="node", metavar="SHELL",
+                      help="javascript shell for running JS builds")
+    parser.add_option("-b", "--benchmark", action="append",
+                      dest="benchmarks", metavar="NAME",
+                      help="run only the named benchmark (repeatable)")
+    parser.add_option("-s", "--scale", type=float, default=1.0,
+                      metavar="FACTOR",
+                      help="multiply the iterations of every benchmark")
+    parser.add_option("-r", "--repeat", type=int, default=REPEAT,
+                      metavar="N",
+                      help="keep the fastest of N runs")
+    parser.add_option("--baseline", default="native", metavar="BUILD",
+                      help="build to compare the others against")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="write the results as JSON to FILE")
+    parser.add_option("-c", "--compare", metavar="FILE",
+                      help="compare against earlier JSON results in FILE")
+    parser.add_option("-q", "--quiet", action="store_true",
+                      help="supress printing of progress and the report")
+
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.error("unexpected arguments")
+
+    builds = []
+    if opts.untranslated:
+        builds.append(untranslated_build(opts.python))
+    if opts.native:
+        builds.append(native_build(opts.native))
+    if opts.js:
+        builds.append(js_build(opts.js, opts.js_shell))
+    if not builds:
+        parser.error("no builds given")
+
+    benchmarks = BENCHMARKS
+    if opts.benchmarks:
+        known = set(name for name, _, _, _ in BENCHMARKS)
+        for name in opts.benchmarks:
+            if name not in known:
+                parser.error("unknown benchmark: %s" % (name,))
+        benchmarks = [b for b in BENCHMARKS if b[0] in opts.benchmarks]
+
+    previous = None
+    if opts.compare:
+        with open(opts.compare, "r") as f:
+            previous = json.load(f)["results"]
+
+    on_result = None
+    if not opts.quiet:
+        def on_result(label, name, result):
+            sys.stdout.write("%s %s: %s per iteration\n" % (
+                label, name, format_time(result["per_iteration"])))
+            sys.stdout.flush()
+
+    results = run_benchmarks(builds, benchmarks, opts.scale, opts.repeat,
+                             on_result)
+
+    if opts.output:
+        with open(opts.output + ".new", "w") as f:
+            json.dump({
+                "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "scale": opts.scale,
+                "repeat": opts.repeat,
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+        os.rename(opts.output + ".new", opts.output)
+    if not opts.quiet:
+        sys.stdout.write("\n")
+        print_report(results, opts.baseline, previous)
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        exitcode = main()
+    except KeyboardInterrupt:
+        exitcode = 1
+    sys.exit(exitcode)
@@ -0,0 +1,96 @@
+#
+#  Tests for compress_memory_initializer.py and make_release_delta.py.
+#  Run them with e.g.
+#
+#      python -m unittest discover -s tools -p "test_*.py"
+#
+
+import unittest
+
+from compress_memory_initializer import encode_zmem, decode_zmem
+from extract_memory_initializer import find_segments
+from benchmark_memory_compression import synthetic_memory_image
+from make_release_delta import make_delta, apply_delta
+
+IMAGE_SIZE = 48 * 1024
+BLOCK_SIZE = 8 * 1024
+
+
+def make_image(seed):
+    # End on a non-zero byte, since the decoder leaves off trailing zeros.
+    return bytes(synthetic_memory_image(IMAGE_SIZE, seed)) + b"\x01"
+
+
+class ZmemTest(unittest.TestCase):
+
+    def round_trip(self, memdata, segments, **kwds):
+        kwds.setdefault("block_size", BLOCK_SIZE)
+        zmemdata = encode_zmem(memdata, segments, **kwds)
+        self.assertEqual(bytes(decode_zmem(zmemdata)),
+                         memdata.rstrip(b"\x00"))
+        return zmemdata
+
+    def test_dense(self):
+        memdata = make_image(1)
+        self.round_trip(memdata, [(0, len(memdata))])
+
+    def test_sparse_segments(self):
+        memdata = make_image(2)
+        segments = find_segments(memdata)
+        self.assertTrue(len(segments) > 1)
+        self.round_trip(memdata, segments)
+
+    def test_leading_zeros(self):
+        memdata = b"\x00" * 5000 + make_image(3)
+        self.round_trip(memdata, find_segments(memdata))
+
+    def test_single_block(self):
+        memdata = make_image(4)
+        self.round_trip(memdata, find_segments(memdata), block_size=0)
+
+    def test_matchers(self):
+        memdata = make_image(5)
+        segments = find_segments(memdata)
+        for matcher in ("zlib", "native"):
+            self.round_trip(memdata, segments, matcher=matcher)
+
+    def test_all_zeros(self):
+        memdata = b"\x00" * IMAGE_SIZE
+        self.assertEqual(find_segments(memdata), [])
+        self.round_trip(memdata, [])
+
+
+class ReleaseDeltaTest(unittest.TestCase):
+
+    def round_trip(self, source, target):
+        delta = make_delta(source, target)
+        self.assertEqual(bytes(apply_delta(source, delta)), target)
+        return delta
+
+    def test_small_change(self):
+        source = make_image(6)
+        target = source[:1000] + b"changed" + source[1200:30000] + \
+                 source[31000:] + b"appended"
+        delta = self.round_trip(source, target)
+        self.assertTrue(len(delta) < len(target) // 10)
+
+    def test_identical(self):
+        source = make_image(7)
+        self.round_trip(source, source)
+
+    def test_unrelated(self):
+        self.round_trip(make_image(8), make_image(9))
+
+    def test_empty(self):
+        self.round_trip(b"", make_image(10))
+        self.round_trip(make_image(11), b"")
+
+    def test_wrong_source(self):
+        source = make_image(12)
+        delta = make_delta(source, source[100:])
+        self.assertRaises(ValueError, apply_delta, source[1:], delta)
+        self.assertRaises(ValueError, apply_delta, source, b"junk")
+
+
+if __name__ == "__main__":
+    unittest.main()
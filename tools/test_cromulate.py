@@ -0,0 +1,200 @@
+#
+#  Tests for cromulate.py.  Run them with e.g.
+#
+#      python -m unittest discover -s tools -p "test_*.py"
+#
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from cromulate import cromulate_functions, make_option_parser, \
+                      split_functions, join_functions, function_name, \
+                      order_group, read_order
+
+FUNCTIONS = [
+    "f%d(a){a=a|0;return (a+%d)*%d|0}" % (i, i, i % 3 + 1)
+    for i in range(8)
+]
+
+# Statements from which to build larger functions, so that some of them
+# are similar to each other.
+
+STATEMENTS = [
+    "a=HEAP32[b+%d>>2]|0;",
+    "b=a+%d|0;",
+    "if((a|0)>(%d|0)){b=b+1|0}",
+    "c=+HEAPF64[a+%d>>3];",
+    "L%d:while(1){a=a+1|0;if((a|0)==(b|0)){break}}",
+    "HEAP32[a+%d>>2]=b;",
+    "switch(a|0){case %d:{b=0;break}default:{b=1}}",
+]
+
+
+def make_code(functions):
+    return "".join((
+        "var asm=(function(global,env,buffer){\n",
+        "// EMSCRIPTEN_START_FUNCS\n",
+        "function ",
+        "\nfunction ".join(functions),
+        "\n// EMSCRIPTEN_END_FUNCS\n",
+        "return {}\n",
+        "})();\n",
+    ))
+
+
+def make_functions(count, seed=0):
+    rng = random.Random(seed)
+    functions = []
+    for i in range(count):
+        body = "".join(rng.choice(STATEMENTS).replace("%d", str(i % 5))
+                       for _ in range(rng.randint(2, 8)))
+        functions.append("g%d(a,b){a=a|0;b=b|0;var c=0.0;%sreturn b|0}" % (
+            i, body * rng.randint(1, 4)))
+    return functions
+
+
+CODE = make_code(FUNCTIONS)
+
+
+class CromulateProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def cromulate(self, profile, *args):
+        filename = os.path.join(self.tempdir, "profile.txt")
+        with open(filename, "w") as f:
+            f.write("".join(name + "\n" for name in profile))
+        opts, _ = make_option_parser().parse_args(["-P", filename] +
+                                                  list(args))
+        reports = []
+        pre_code, functions, post_code = split_functions(CODE)
+        output = cromulate_functions(pre_code, functions, post_code, opts,
+                                     on_report=reports.append)
+        self.assertEqual(output[0], functions[0])
+        self.assertEqual(sorted(output[1:]), sorted(functions[1:]))
+        self.assertEqual(len(reports), 1)
+        return [function_name(func) for func in output[1:]], reports[0]
+
+    def test_profile_matches_nothing(self):
+        for args in ([], ["--sketch"]):
+            names, report = self.cromulate(["_nothere"], *args)
+            self.assertEqual(len(names), len(FUNCTIONS))
+            self.assertEqual(report["missing"], ["_nothere"])
+
+    def test_profile_all_hot(self):
+        profile = [function_name(func) for func in FUNCTIONS]
+        for args in ([], ["--sketch"]):
+            names, report = self.cromulate(profile, *args)
+            self.assertEqual(len(names), len(FUNCTIONS))
+            self.assertEqual(report["missing"], [])
+
+    def test_profile_hot_first(self):
+        for args in ([], ["--sketch"]):
+            names, _ = self.cromulate(["f5", "f2"], *args)
+            self.assertEqual(sorted(names[:2]), ["f2", "f5"])
+
+    def test_order_empty_group(self):
+        opts, _ = make_option_parser().parse_args([])
+        functions = split_functions(CODE)[1]
+        self.assertEqual(order_group(functions, [], opts), [])
+
+
+
+class CromulatePreviousTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_keeps_worse_previous_order(self):
+        # Pairs of identical functions compress best side by side, so a
+        # previous order that puts them further apart than deflate can see
+        # compresses worse.
+        rng = random.Random(0)
+        functions = []
+        for i in range(20):
+            body = "".join("HEAP32[a+%d>>2]=%d;" % (rng.randint(0, 9999),
+                                                   rng.randint(0, 99999))
+                           for _ in range(100))
+            functions.append("p%d(a,b){%sreturn b|0}" % (i, body))
+            functions.append("q%d(a,b){%sreturn b|0}" % (i, body))
+        previous_functions = functions[0::2] + functions[1::2]
+        previous = os.path.join(self.tempdir, "previous.js")
+        with open(previous, "w") as f:
+            f.write(make_code(previous_functions))
+        opts, _ = make_option_parser().parse_args(["-k", "-p", previous])
+        reports = []
+        pre_code, functions, post_code = split_functions(
+            make_code(functions))
+        output = cromulate_functions(pre_code, functions, post_code, opts,
+                                     on_report=reports.append)
+        self.assertEqual([function_name(func) for func in output[1:]],
+                         [function_name(func) for func in previous_functions])
+        self.assertEqual(len(reports), 1)
+        self.assertTrue(reports[0]["new"]["compressed"] >
+                        reports[0]["original"]["compressed"])
+
+
+class CromulateJobsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def assertSameOrder(self, code, *args):
+        # Compare the orders themselves, since cromulate_functions could
+        # hide a difference by falling back to the original order.
+        pre_code, functions, post_code = split_functions(code)
+        group = list(range(1, len(functions)))
+        orders = []
+        outputs = []
+        for jobs in ("1", "4"):
+            opts, _ = make_option_parser().parse_args(["-j", jobs] +
+                                                      list(args))
+            previous_order = None
+            if opts.previous:
+                previous_order = read_order(opts.previous)
+            orders.append(order_group(functions, group, opts,
+                                      previous_order))
+            outputs.append(cromulate_functions(pre_code, functions,
+                                               post_code, opts))
+        self.assertEqual(sorted(orders[0]), group)
+        self.assertNotEqual(orders[0], group)
+        self.assertEqual(orders[0], orders[1])
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_window(self):
+        self.assertSameOrder(make_code(make_functions(40)), "-w", "10")
+
+    def test_window_lookahead(self):
+        self.assertSameOrder(make_code(make_functions(40)), "-w", "10",
+                             "-a", "2")
+
+    def test_sketch(self):
+        self.assertSameOrder(make_code(make_functions(60)), "-k", "-w", "0")
+
+    def test_sketch_refine(self):
+        self.assertSameOrder(make_code(make_functions(60)), "-k", "-w", "0",
+                             "-r", "1")
+
+    def test_previous(self):
+        functions = make_functions(60)
+        previous = os.path.join(self.tempdir, "previous.js")
+        with open(previous, "w") as f:
+            f.write(join_functions("", [""] + functions[::-1][10:], ""))
+        self.assertSameOrder(make_code(functions), "-k", "-p", previous)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+#
+#  Tests for eliminate_dead_functions.py.  Run them with e.g.
+#
+#      python -m unittest discover -s tools -p "test_*.py"
+#
+
+import unittest
+
+from cromulate import function_name
+from fold_functions import split_asm
+from eliminate_dead_functions import eliminate_dead_functions
+
+
+def make_code(functions, tail):
+    return "".join((
+        "var asm=(function(global,env,buffer){\n",
+        "// EMSCRIPTEN_START_FUNCS\n",
+        "function ",
+        "\nfunction ".join(functions),
+        "\n// EMSCRIPTEN_END_FUNCS\n",
+        tail,
+        "\n// EMSCRIPTEN_END_ASM\n",
+        "})();\n",
+    ))
+
+
+class EliminateDeadFunctionsTest(unittest.TestCase):
+
+    def eliminate(self, functions, tail):
+        removed = []
+        code = eliminate_dead_functions(make_code(functions, tail),
+                                        lambda *r: removed.append(r))
+        kept = [function_name(func) for func in split_asm(code)[1][1:]]
+        return kept, sorted(name for name, _ in removed)
+
+    def test_export_roots(self):
+        kept, removed = self.eliminate([
+            "_main(){return _a()|0}",
+            "_a(){return _b()|0}",
+            "_b(){return 1}",
+            "_dead(){return _b()|0}",
+        ], "return {_main:_main}")
+        self.assertEqual(kept, ["_main", "_a", "_b"])
+        self.assertEqual(removed, ["_dead"])
+
+    def test_function_table_roots(self):
+        kept, removed = self.eliminate([
+            "_a(x){x=x|0;return x|0}",
+            "_b(x){x=x|0;return _c(x)|0}",
+            "_c(x){x=x|0;return x+1|0}",
+            "_dead(x){x=x|0;return x|0}",
+            "b0(x){x=x|0;abort(0);return 0}",
+        ], "var FUNCTION_TABLE_ii=[b0,_a,_b,b0];\n"
+           "return {dynCall_ii:dynCall_ii}")
+        self.assertEqual(kept, ["_a", "_b", "_c", "b0"])
+        self.assertEqual(removed, ["_dead"])
+
+    def test_export_key_is_not_a_root(self):
+        kept, removed = self.eliminate([
+            "_x(){return 1}",
+            "_y(){return 2}",
+        ], "return {_x:_y}")
+        self.assertEqual(kept, ["_y"])
+        self.assertEqual(removed, ["_x"])
+
+    def test_dead_mutual_recursion(self):
+        kept, removed = self.eliminate([
+            "_main(){return 0}",
+            "_even(n){n=n|0;return ((n|0)==0?1:_odd(n-1|0)|0)|0}",
+            "_odd(n){n=n|0;return ((n|0)==0?0:_even(n-1|0)|0)|0}",
+        ], "return {_main:_main}")
+        self.assertEqual(kept, ["_main"])
+        self.assertEqual(removed, ["_even", "_odd"])
+
+    def test_local_shadowing_function(self):
+        # We can't tell a local from a call, so the function is kept.
+        functions = [
+            "_main(_a){_a=_a|0;return _a+1|0}",
+            "_a(){return 1}",
+        ]
+        code = make_code(functions, "return {_main:_main}")
+        self.assertEqual(eliminate_dead_functions(code), code)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+#
+#  Tests for fold_functions.py.  Run them with e.g.
+#
+#      python -m unittest discover -s tools -p "test_*.py"
+#
+
+import unittest
+
+from fold_functions import fold_functions
+
+
+def make_code(*functions):
+    return "".join((
+        "var asm=(function(global,env,buffer){\n",
+        "// EMSCRIPTEN_START_FUNCS\n",
+        "function ",
+        "\nfunction ".join(functions),
+        "\n// EMSCRIPTEN_END_FUNCS\n",
+        "return {_h:h,_Xa:Xa,_Ya:Ya}\n",
+        "// EMSCRIPTEN_END_ASM\n",
+        "})();\n",
+    ))
+
+
+class FoldFunctionsTest(unittest.TestCase):
+
+    def fold(self, *functions):
+        folds = []
+        code = fold_functions(make_code(*functions),
+                              lambda name, to: folds.append((name, to)))
+        return code, folds
+
+    def test_fold(self):
+        code, folds = self.fold(
+            "Xa(a){a=a|0;return a+1|0}",
+            "Ya(a){a=a|0;return a+1|0}",
+            "h(b){b=b|0;return Ya(b)|0}",
+        )
+        self.assertEqual(folds, [("Ya", "Xa")])
+        self.assertNotIn("function Ya(", code)
+        self.assertIn("function h(b){b=b|0;return Xa(b)|0}", code)
+        self.assertIn("_Ya:Xa", code)
+
+    def test_local_named_like_folded_function(self):
+        code, folds = self.fold(
+            "Xa(a){a=a|0;return a+1|0}",
+            "Ya(a){a=a|0;return a+1|0}",
+            "h(Ya){Ya=Ya|0;return Xa(Ya)|0}",
+            "k(a){a=a|0;var Ya=0;Ya=Xa(a)|0;return Ya|0}",
+        )
+        self.assertEqual(folds, [("Ya", "Xa")])
+        self.assertIn("function h(Ya){Ya=Ya|0;return Xa(Ya)|0}", code)
+        self.assertIn("function k(a){a=a|0;var Ya=0;Ya=Xa(a)|0;return Ya|0}",
+                      code)
+
+    def test_local_named_like_fold_target(self):
+        code, folds = self.fold(
+            "Xa(a){a=a|0;return a+1|0}",
+            "Ya(a){a=a|0;return a+1|0}",
+            "h(Xa){Xa=Xa|0;return Ya(Xa)|0}",
+        )
+        self.assertEqual(folds, [])
+        self.assertIn("function Ya(", code)
+        self.assertIn("function h(Xa){Xa=Xa|0;return Ya(Xa)|0}", code)
+
+
+if __name__ == "__main__":
+    unittest.main()